@@ -13,6 +13,13 @@ from document_processors import DocumentProcessorFactory
 from document_templates import DocumentTemplateFactory
 from load_templates import load_all_templates
 from multi_document_processor import MultiDocumentProcessor
+from ocr_cache import get_ocr_cache
+from api_scheduler import get_api_scheduler
+from llm_cache import get_llm_cache
+from resilience import get_resilience
+from rate_limiter import get_rate_limiter
+from model_router import get_model_router
+from document_store import RESTORE_ENABLED, get_document_store
 
 # Load environment variables
 load_dotenv()
@@ -261,8 +268,8 @@ def main():
         
         # File uploader semplificato
         uploaded_file = st.file_uploader(
-            "Carica PDF o file di testo",
-            type=["pdf", "txt"],
+            "Carica PDF, immagine o file di testo",
+            type=["pdf", "txt", "jpg", "jpeg", "png"],
             help="Carica il documento da cui estrarre le informazioni"
         )
         
@@ -283,18 +290,33 @@ def main():
                     st.session_state.document_text = document_text
                     st.success("✅ Testo estratto")
                     
+                elif uploaded_file.type in ("image/jpeg", "image/png"):
+                    image_bytes, image_mime = processor.preprocess_input(uploaded_file.getvalue(), uploaded_file.name)
+                    
+                    with st.spinner("🔄 OCR immagine..."):
+                        document_text = processor.pages_to_text(
+                            processor.extract_pages_from_image(image_bytes, image_mime)
+                        )
+                    
+                    if document_text.strip():
+                        st.session_state.document_text = document_text
+                        st.success("✅ Testo estratto")
+                    else:
+                        st.error("❌ Impossibile estrarre testo")
+                        st.session_state.document_text = None
+                    
                 elif uploaded_file.type == "application/pdf":
-                    pdf_bytes = uploaded_file.getvalue()
+                    pdf_bytes, _ = processor.preprocess_input(uploaded_file.getvalue(), uploaded_file.name)
                     
                     with st.spinner("🔄 Elaborazione PDF..."):
-                        pypdf2_text, ocr_text = processor.extract_text_from_pdf(pdf_bytes)
+                        pypdf2_text, merged_text = processor.extract_text_from_pdf(pdf_bytes)
                     
                     # Selezione metodo semplificata
                     options = []
+                    if merged_text.strip():
+                        options.append(("🧩 Digitale + OCR (pagine scansionate)", merged_text))
                     if pypdf2_text.strip():
-                        options.append(("🔤 Testo digitale", pypdf2_text))
-                    if ocr_text.strip():
-                        options.append(("📷 OCR", ocr_text))
+                        options.append(("🔤 Solo testo digitale", pypdf2_text))
                     
                     if options:
                         choice = st.radio(
@@ -328,6 +350,11 @@ def main():
             st.info("👈 Carica prima un documento")
         else:
             processor = DocumentProcessorFactory.create_processor(document_type, client)
+            processor.bypass_llm_cache = st.checkbox(
+                "♻️ Ignora risposte in cache",
+                value=False,
+                help="Ripete la chiamata all'AI anche se lo stesso testo è già stato elaborato"
+            )
             
             # Extract information button
             if st.button("🔍 Estrai Informazioni", type="primary", use_container_width=True):
@@ -416,7 +443,15 @@ def main():
         
         # Initialize multi-document processor in session state
         if 'multi_processor' not in st.session_state:
-            st.session_state.multi_processor = MultiDocumentProcessor(client)
+            if RESTORE_ENABLED:
+                # L'identificativo nell'URL permette di ritrovare i documenti dopo un ricaricamento della pagina
+                st.session_state.multi_processor = MultiDocumentProcessor(client, session_id=st.query_params.get("sessione"))
+                st.query_params["sessione"] = st.session_state.multi_processor.session_id
+                restored = st.session_state.multi_processor.restore_documents()
+                if restored:
+                    st.info(f"♻️ Ripristinati {restored} documenti caricati in precedenza in questa sessione")
+            else:
+                st.session_state.multi_processor = MultiDocumentProcessor(client)
         
         multi_processor = st.session_state.multi_processor
         
@@ -440,8 +475,8 @@ def main():
         
         # Multiple file uploader
         uploaded_files = st.file_uploader(
-            "Carica i tuoi documenti (PDF o TXT)",
-            type=["pdf", "txt"],
+            "Carica i tuoi documenti (PDF, TXT o immagini)",
+            type=["pdf", "txt", "jpg", "jpeg", "png"],
             accept_multiple_files=True,
             help="Carica documenti aziendali di qualsiasi tipo",
             key="multi_doc_uploader"
@@ -452,17 +487,25 @@ def main():
             st.success(f"📁 {len(uploaded_files)} documento/i caricato/i")
             
             # Process each file with auto-type detection
+            batch_files = []
             for i, uploaded_file in enumerate(uploaded_files):
                 col1, col2, col3 = st.columns([2, 1, 1])
                 
                 with col1:
-                    # Auto-suggest document type
-                    if uploaded_file.type == "text/plain":
-                        file_content = uploaded_file.getvalue().decode("utf-8")
-                    else:
-                        file_content = ""
-                    
-                    suggested_type = multi_processor.suggest_document_type(uploaded_file.name, file_content)
+                    # Auto-suggest document type (PDFs from the text layer of their first pages),
+                    # computed once per uploaded file rather than on every rerun
+                    type_suggestions = st.session_state.setdefault('type_suggestions', {})
+                    if uploaded_file.file_id not in type_suggestions:
+                        if uploaded_file.type == "text/plain":
+                            file_content = uploaded_file.getvalue().decode("utf-8")
+                        else:
+                            file_content = ""
+                        pdf_bytes = uploaded_file.getvalue() if uploaded_file.name.lower().endswith('.pdf') else None
+                        type_suggestions[uploaded_file.file_id] = multi_processor.rank_document_types(
+                            uploaded_file.name, file_content, pdf_bytes
+                        )
+                    candidates = type_suggestions[uploaded_file.file_id]
+                    suggested_type = candidates[0].document_type
                     
                     # Find index of suggested type
                     available_types = DocumentProcessorFactory.get_available_types()
@@ -477,8 +520,12 @@ def main():
                         index=suggested_index,
                         format_func=lambda x: x.replace('_', ' ').title(),
                         key=f"doc_type_{i}_{uploaded_file.name}",
-                        help=f"Tipo suggerito: {suggested_type.replace('_', ' ').title()}"
+                        help="Tipo suggerito: " + ", ".join(
+                            f"{candidate.document_type.replace('_', ' ').title()} ({candidate.confidence:.0%})"
+                            for candidate in candidates[:3]
+                        )
                     )
+                    batch_files.append((uploaded_file.getvalue(), uploaded_file.name, doc_type))
                 
                 with col2:
                     st.write(f"**{uploaded_file.size / 1024:.1f} KB**")
@@ -493,6 +540,14 @@ def main():
                             if extracted_info:
                                 st.success(f"✅ Elaborato!")
                                 st.rerun()
+            
+            # Elaborazione contemporanea di tutti i file caricati, nell'ordine di caricamento
+            if len(batch_files) > 1 and st.button(f"🚀 Elabora tutti ({len(batch_files)})", key="process_all_btn"):
+                results = multi_processor.process_documents(batch_files)
+                processed = sum(1 for extracted_info in results if extracted_info)
+                if processed:
+                    st.success(f"✅ Elaborati {processed}/{len(batch_files)} documenti")
+                    st.rerun()
         
         # Show processed documents with quick stats
         if summary["total_documents"] > 0:
@@ -525,6 +580,9 @@ def main():
                     # Simple info count
                     info_count = len([k for k, v in doc['extracted_info'].items() if v])
                     st.caption(f"Informazioni estratte: {info_count}")
+                    duplicate_of = multi_processor.duplicate_of(doc)
+                    if duplicate_of:
+                        st.caption(f"♻️ Quasi identico a {duplicate_of}: escluso da conflitti e combinazione")
                     st.markdown("---")
         
         # Manual selection section - simplified
@@ -728,6 +786,80 @@ def main():
                     st.markdown(f"• {template.replace('_', ' ').title()}")
             else:
                 st.markdown("• Nessun template caricato")
+        
+        ocr_stats = get_ocr_cache().get_stats()
+        st.markdown("**♻️ Cache OCR:**")
+        st.caption(
+            f"Hit: {ocr_stats['hits']} • Miss: {ocr_stats['misses']} • "
+            f"Hit rate: {ocr_stats['hit_rate']:.0%} • Voci: {ocr_stats['entries']} "
+            f"({ocr_stats['size_bytes'] / (1024 * 1024):.1f} / {ocr_stats['max_size_bytes'] / (1024 * 1024):.0f} MB)"
+        )
+        
+        llm_stats = get_llm_cache().get_stats()
+        st.markdown("**🧠 Cache risposte AI:**")
+        st.caption(
+            f"Hit: {llm_stats['hits']} • Miss: {llm_stats['misses']} • "
+            f"Hit rate: {llm_stats['hit_rate']:.0%} • Voci: {llm_stats['entries']} "
+            f"({llm_stats['size_bytes'] / (1024 * 1024):.1f} / {llm_stats['max_size_bytes'] / (1024 * 1024):.0f} MB)"
+            + ("" if llm_stats['enabled'] else " • disattivata")
+        )
+        
+        document_store = get_document_store()
+        if document_store is not None:
+            store_stats = document_store.get_stats()
+            st.markdown("**🗄️ Archivio documenti:**")
+            st.caption(
+                f"Backend: {store_stats['backend']} • Sessioni: {store_stats['sessions']} • "
+                f"Documenti: {store_stats['documents']} ({store_stats['size_bytes'] / (1024 * 1024):.1f} / "
+                f"{store_stats['max_size_bytes'] / (1024 * 1024):.0f} MB, max "
+                f"{store_stats['session_max_bytes'] / (1024 * 1024):.0f} MB per sessione) • "
+                f"Testi letti: {store_stats['loads']} • Testi eliminati: {store_stats['evictions']}"
+            )
+        
+        scheduler_stats = get_api_scheduler().get_stats()
+        st.markdown("**⏱️ Chiamate API:**")
+        st.caption(
+            f"In coda: {scheduler_stats['queued']} • In corso: {scheduler_stats['in_flight']}/{scheduler_stats['max_workers']} • "
+            f"Completate: {scheduler_stats['completed']} • Timeout: {scheduler_stats['timed_out']} • "
+            f"Risposte tardive scartate: {scheduler_stats['late_responses'] + scheduler_stats['expired_in_queue']}"
+        )
+        
+        limiter_stats = get_rate_limiter().get_stats()
+        if limiter_stats['enabled']:
+            st.caption(
+                f"Limite: {limiter_stats['requests_per_second']:g} req/s, {limiter_stats['tokens_per_minute']:,.0f} token/min"
+                f"{' (condiviso tra repliche)' if limiter_stats['shared'] else ''} • In attesa: {limiter_stats['waiting']} • "
+                f"Rallentate: {limiter_stats['delayed']}/{limiter_stats['acquired']} • "
+                f"Attesa media: {limiter_stats['average_wait']:.2f}s (max {limiter_stats['max_wait']:.1f}s) • "
+                f"429 ricevuti: {limiter_stats['throttled']}"
+            )
+        
+        breaker_labels = {"closed": "🟢 operativa", "half_open": "🟡 in verifica", "open": "🔴 sospesa"}
+        for endpoint, endpoint_stats in get_resilience().get_stats().items():
+            p95 = endpoint_stats['p95_latency']
+            st.caption(
+                f"{endpoint.upper()}: {breaker_labels[endpoint_stats['breaker_state']]} • "
+                f"Retry: {endpoint_stats['retries']} • Errori: {endpoint_stats['failures']} • "
+                f"Bloccate dal circuit breaker: {endpoint_stats['short_circuited']} • "
+                f"Scadute in coda (rate limit): {endpoint_stats['rate_limited']} • "
+                f"p95: {f'{p95:.1f}s' if p95 is not None else 'n/d'}"
+            )
+        
+        route_stats = get_model_router().get_stats()
+        if route_stats:
+            st.markdown("**🧭 Modelli per tipo di documento:**")
+            for route in route_stats:
+                success_rate = route['success_rate']
+                p95 = route['p95_latency']
+                st.caption(
+                    f"{route['document_type']} → {route['model']} ({route['tier']}"
+                    f"{', sotto soglia: si usa il livello superiore' if route['escalated'] else ''}) • "
+                    f"Chiamate: {route['calls']} • "
+                    f"Successo: {f'{success_rate:.0%}' if success_rate is not None else 'n/d'} • "
+                    f"Latenza media: {route['average_latency']:.1f}s (p95 {f'{p95:.1f}s' if p95 is not None else 'n/d'}) • "
+                    f"Token medi: {route['average_prompt_tokens']:,.0f} in / {route['average_completion_tokens']:,.0f} out • "
+                    f"Troncate: {route['truncated']}"
+                )
     
     st.markdown("💡 **Suggerimento:** Segui la barra di progresso in alto per completare tutti i passaggi")
 
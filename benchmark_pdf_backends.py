@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Benchmark dei backend di estrazione testo PDF (src/pdf_text_backends.py).
+
+Confronta throughput (pagine/secondo) e picco di memoria di ogni backend
+installato, sia in modalità seriale sia con il pool di processi.
+Ogni caso viene eseguito in un processo separato, così il picco di memoria
+(ru_maxrss) non è contaminato dai casi precedenti.
+
+Uso:
+    python benchmark_pdf_backends.py [file.pdf | cartella ...] [--repeat N] [--workers N]
+
+Senza argomenti vengono usati i PDF in samples/ (se esiste) o nella root del progetto.
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# Aggiungi i path necessari
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(current_dir, 'src')
+
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+from pdf_text_backends import get_available_backends, get_text_backend, new_process_pool
+
+
+def _collect_pdfs(paths):
+    """Espande file e cartelle in una lista di PDF"""
+    if not paths:
+        samples_dir = os.path.join(current_dir, 'samples')
+        paths = [samples_dir] if os.path.isdir(samples_dir) else [current_dir]
+
+    pdf_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            pdf_files.extend(sorted(glob.glob(os.path.join(path, '*.pdf'))))
+        elif path.lower().endswith('.pdf'):
+            pdf_files.append(path)
+    return pdf_files
+
+
+def _max_rss_mb(usage) -> float:
+    # Linux riporta ru_maxrss in KB, macOS in byte
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss / divisor
+
+
+def _run_case(backend_name, pdf_files, parallel, workers, repeat, result_queue):
+    """Eseguito in un processo dedicato: estrae tutti i PDF e misura tempi e memoria"""
+    backend = get_text_backend(backend_name)
+    documents = []
+    for pdf_file in pdf_files:
+        with open(pdf_file, 'rb') as f:
+            documents.append(f.read())
+
+    # Pool dedicato al caso misurato: il pool condiviso dell'applicazione non viene toccato
+    pool = new_process_pool(workers) if parallel else None
+    total_pages = 0
+    total_chars = 0
+    start_time = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            for pdf_bytes in documents:
+                if parallel:
+                    pages = backend.extract_pages(pdf_bytes, executor=pool)
+                else:
+                    pages = backend.extract_page_range(pdf_bytes, 0, backend.page_count(pdf_bytes))
+                total_pages += len(pages)
+                total_chars += sum(len(page) for page in pages)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    result_queue.put({
+        'elapsed': elapsed,
+        'pages': total_pages,
+        'chars': total_chars,
+        'peak_mb': _max_rss_mb(resource.getrusage(resource.RUSAGE_SELF)),
+        'children_peak_mb': _max_rss_mb(resource.getrusage(resource.RUSAGE_CHILDREN)),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backend estrazione testo PDF")
+    parser.add_argument('paths', nargs='*', help="PDF o cartelle da usare (default: samples/)")
+    parser.add_argument('--repeat', type=int, default=3, help="Ripetizioni per ogni caso")
+    parser.add_argument('--workers', type=int, default=None, help="Processi del pool in modalità parallela")
+    args = parser.parse_args()
+
+    pdf_files = _collect_pdfs(args.paths)
+    if not pdf_files:
+        print("❌ Nessun PDF trovato. Passa uno o più file/cartelle come argomento.")
+        return 1
+
+    backends = get_available_backends()
+    print(f"📄 {len(pdf_files)} PDF, {args.repeat} ripetizioni, backend: {', '.join(backends)}")
+    print()
+    print(f"{'Backend':<12} {'Modalità':<10} {'Pagine':>8} {'Tempo (s)':>10} {'Pag/s':>9} {'Picco MB':>9} {'Worker MB':>10}")
+    print("-" * 74)
+
+    for backend_name in backends:
+        for parallel in (False, True):
+            result_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_run_case,
+                args=(backend_name, pdf_files, parallel, args.workers, args.repeat, result_queue)
+            )
+            process.start()
+            result = result_queue.get()
+            process.join()
+
+            pages_per_second = result['pages'] / result['elapsed'] if result['elapsed'] else 0.0
+            mode = "parallelo" if parallel else "seriale"
+            print(f"{backend_name:<12} {mode:<10} {result['pages']:>8} {result['elapsed']:>10.2f} "
+                  f"{pages_per_second:>9.1f} {result['peak_mb']:>9.1f} {result['children_peak_mb']:>10.1f}")
+
+    print()
+    print("ℹ️  La modalità parallela si attiva solo sui documenti con almeno "
+          "PARALLEL_MIN_PAGES pagine; sotto soglia coincide con quella seriale.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
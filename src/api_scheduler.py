@@ -0,0 +1,203 @@
+"""
+Scheduler condiviso per le chiamate bloccanti alle API Mistral.
+
+In precedenza ogni tentativo di estrazione creava un ThreadPoolExecutor dentro
+un blocco `with`: all'uscita il blocco attendeva comunque il worker, quindi i
+timeout non limitavano davvero la latenza e le chiamate abbandonate restavano
+in esecuzione. Qui un unico pool limitato esegue tutte le chiamate:
+
+- ogni richiesta ha una scadenza reale: allo scadere il chiamante riprende
+  subito il controllo e la risposta tardiva viene scartata;
+- una richiesta rimasta in coda oltre la propria scadenza non parte affatto;
+- CallBudget limita il tempo totale speso per un documento, tentativi inclusi;
+- get_stats espone profondità della coda e chiamate in corso.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+MAX_WORKERS = int(os.environ.get("API_SCHEDULER_WORKERS", "8"))
+MAX_QUEUE = int(os.environ.get("API_SCHEDULER_MAX_QUEUE", "64"))
+
+
+class DeadlineExceeded(TimeoutError):
+    """The call did not complete before its deadline"""
+
+
+class BudgetExhausted(DeadlineExceeded):
+    """The document's time budget ran out before the call could start"""
+
+
+class SchedulerSaturated(RuntimeError):
+    """Too many calls are already waiting for a worker"""
+
+
+class CallBudget:
+    """Tempo totale a disposizione per tutte le chiamate relative a un documento"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def cancel(self) -> None:
+        """Expire the budget now: calls not yet started with it are refused"""
+        self.deadline = time.monotonic()
+
+
+class ApiCallScheduler:
+    """Bounded worker pool enforcing per-call deadlines"""
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_queue: int = MAX_QUEUE):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="api-call")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.expired_in_queue = 0
+        self.late_responses = 0
+        self.rejected = 0
+
+    def _run(self, deadline: float, fn: Callable, args, kwargs) -> Any:
+        with self._lock:
+            self.queued -= 1
+            if time.monotonic() >= deadline:
+                # Il chiamante ha già rinunciato: non occupare l'API per una risposta che verrà scartata
+                self.expired_in_queue += 1
+                raise DeadlineExceeded("Scadenza superata prima dell'avvio della chiamata")
+            self.in_flight += 1
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def submit(self, fn: Callable, *args, timeout: float, **kwargs) -> Future:
+        """Queue a call that must start within timeout seconds; returns its Future"""
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerSaturated(f"Coda chiamate API piena ({self.queued} in attesa)")
+            self.queued += 1
+        try:
+            return self._executor.submit(self._run, time.monotonic() + timeout, fn, args, kwargs)
+        except BaseException:
+            with self._lock:
+                self.queued -= 1
+            raise
+
+    def call(self, fn: Callable, *args, timeout: float, budget: Optional[CallBudget] = None, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) and wait at most timeout seconds (capped by the budget).
+
+        Raises DeadlineExceeded when the deadline passes; the late response is dropped.
+        """
+        if budget is not None:
+            timeout = min(timeout, budget.remaining())
+            if timeout <= 0:
+                raise BudgetExhausted("Budget di tempo del documento esaurito")
+
+        future = self.submit(fn, *args, timeout=timeout, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            self._abandon(future)
+            raise DeadlineExceeded(f"Nessuna risposta entro {timeout:.1f}s") from None
+
+    def call_all(self, fn: Callable, calls: Iterable[tuple], timeout: float,
+                 budget: Optional[CallBudget] = None) -> List[Any]:
+        """Run fn(*args) for every args tuple concurrently, waiting at most timeout in total.
+
+        Returns one entry per call, in order: the result, or the exception for failed
+        and late calls (DeadlineExceeded; the late response is dropped).
+        """
+        if budget is not None:
+            timeout = min(timeout, budget.remaining())
+            if timeout <= 0:
+                raise BudgetExhausted("Budget di tempo del documento esaurito")
+
+        futures = []
+        for args in calls:
+            try:
+                futures.append(self.submit(fn, *args, timeout=timeout))
+            except SchedulerSaturated as e:
+                futures.append(e)
+
+        pending = [future for future in futures if isinstance(future, Future)]
+        _, not_done = wait(pending, timeout=timeout)
+
+        results = []
+        for future in futures:
+            if not isinstance(future, Future):
+                results.append(future)
+            elif future in not_done:
+                self._abandon(future)
+                results.append(DeadlineExceeded(f"Nessuna risposta entro {timeout:.1f}s"))
+            elif future.exception() is not None:
+                results.append(future.exception())
+            else:
+                results.append(future.result())
+        return results
+
+    def _abandon(self, future: Future):
+        """Give up on a call past its deadline"""
+        with self._lock:
+            self.timed_out += 1
+        if future.cancel():
+            # Mai partita: _run non verrà eseguito, il posto in coda va restituito qui
+            with self._lock:
+                self.queued -= 1
+        else:
+            # Già in esecuzione: il risultato arriverà ma nessuno lo userà
+            future.add_done_callback(self._count_late_response)
+
+    def _count_late_response(self, future: Future):
+        if not future.cancelled() and future.exception() is None:
+            with self._lock:
+                self.late_responses += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "max_workers": self.max_workers,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "expired_in_queue": self.expired_in_queue,
+                "late_responses": self.late_responses,
+                "rejected": self.rejected,
+            }
+
+
+_scheduler: Optional[ApiCallScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_api_scheduler() -> ApiCallScheduler:
+    """Scheduler condiviso da tutte le sessioni del processo"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ApiCallScheduler()
+        return _scheduler
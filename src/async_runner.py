@@ -0,0 +1,46 @@
+"""
+Event loop condiviso per la pipeline asincrona di estrazione.
+
+Le chiamate Mistral asincrone (httpx) sono legate al loop su cui vengono
+create: un unico loop in un thread dedicato serve tutte le sessioni del
+processo, e run_sync permette al codice sincrono (Streamlit) di attendere
+una coroutine senza creare un loop o un thread per richiesta.
+"""
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Coroutine, Optional
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Shared event loop, started in a daemon thread on first use"""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="async-pipeline", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+
+def run_sync(coroutine: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+    """Run a coroutine on the shared loop and wait for its result from synchronous code.
+
+    On timeout the coroutine is cancelled (pending HTTP requests included) before re-raising.
+    """
+    loop = get_event_loop()
+    if threading.current_thread() is _loop_thread:
+        coroutine.close()
+        raise RuntimeError("run_sync non può essere chiamato dal thread del loop: usa await")
+
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
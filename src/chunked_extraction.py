@@ -0,0 +1,137 @@
+"""
+Estrazione a blocchi (map-reduce) per documenti lunghi.
+
+Statuti e bilanci superano facilmente la dimensione gestibile in un solo
+prompt: la chiamata va in timeout oppure il testo viene troncato. Qui il
+documento viene diviso in blocchi entro un budget di token, rispettando i
+confini di pagina (marcatori "--- PAGINA n ---") e, dentro pagine troppo
+lunghe, quelli degli articoli; ogni blocco viene estratto separatamente e i
+JSON parziali vengono fusi con regole per campo.
+"""
+
+from collections import Counter
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Stima grossolana ma stabile: ~4 caratteri per token per testo italiano
+CHARS_PER_TOKEN = 4
+
+# Regole di fusione dei valori parziali
+MERGE_FIRST = "first"              # primo valore non vuoto (ordine del documento)
+MERGE_LONGEST = "longest"          # valore più lungo (descrizioni)
+MERGE_MOST_COMMON = "most_common"  # valore più frequente, a parità il primo
+MERGE_UNION = "union"              # unione delle liste senza duplicati
+
+_PAGE_BOUNDARY = re.compile(r'(?m)^(?=--- PAGINA \d+ ---$)')
+_ARTICLE_BOUNDARY = re.compile(r'(?im)^(?=[ \t]*(?:art\.|articolo)[ \t]*\d+)')
+_PARAGRAPH_BOUNDARY = re.compile(r'\n[ \t]*\n')
+_LINE_BOUNDARY = re.compile(r'\n')
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate token count of a text"""
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _split(text: str, pattern) -> List[str]:
+    return [part for part in pattern.split(text) if part.strip()]
+
+
+def _split_segment(segment: str, max_chars: int) -> List[str]:
+    """Divide un segmento troppo lungo al confine più significativo disponibile"""
+    if len(segment) <= max_chars:
+        return [segment]
+    for pattern in (_ARTICLE_BOUNDARY, _PARAGRAPH_BOUNDARY, _LINE_BOUNDARY):
+        parts = _split(segment, pattern)
+        if len(parts) > 1:
+            return [piece for part in parts for piece in _split_segment(part, max_chars)]
+    # Nessun confine utile (es. una riga enorme): taglio netto
+    return [segment[i:i + max_chars] for i in range(0, len(segment), max_chars)]
+
+
+def split_into_chunks(text: str, max_tokens: int) -> List[str]:
+    """Split text into chunks of at most max_tokens, cutting at page, then article, boundaries"""
+    max_chars = max(1, max_tokens * CHARS_PER_TOKEN)
+    segments = [piece for page in _split(text, _PAGE_BOUNDARY) for piece in _split_segment(page.strip(), max_chars)]
+
+    # Accorpa segmenti consecutivi finché il blocco resta nel budget
+    chunks = []
+    current = ""
+    for segment in segments:
+        if current and len(current) + 2 + len(segment) > max_chars:
+            chunks.append(current)
+            current = segment
+        else:
+            current = f"{current}\n\n{segment}" if current else segment
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, (str, list, dict)) and not value) or (
+        isinstance(value, str) and not value.strip())
+
+
+def _comparable(value: Any) -> str:
+    """Forma normalizzata per riconoscere valori equivalenti"""
+    if isinstance(value, str):
+        return " ".join(value.split()).casefold()
+    return json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).casefold()
+
+
+def _merge_values(values: List[Any], rule: str) -> Any:
+    if rule == MERGE_UNION:
+        merged = []
+        seen = set()
+        for value in values:
+            for item in (value if isinstance(value, list) else [value]):
+                key = _comparable(item)
+                if key not in seen:
+                    seen.add(key)
+                    merged.append(item)
+        return merged
+    if rule == MERGE_FIRST:
+        return values[0]
+    if rule == MERGE_LONGEST:
+        return max(values, key=lambda value: len(_comparable(value)))
+    # MERGE_MOST_COMMON: Counter mantiene l'ordine di inserimento, a parità vince il primo
+    counts = Counter(_comparable(value) for value in values)
+    best = max(counts.values())
+    return next(value for value in values if counts[_comparable(value)] == best)
+
+
+def merge_partial_results(default_structure: Dict[str, Any], partials: List[Dict[str, Any]],
+                          rules: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, Any], Dict[str, List[Any]]]:
+    """Merge per-chunk JSON results in document order.
+
+    Lists are merged with MERGE_UNION and other values with MERGE_MOST_COMMON unless
+    rules says otherwise. Returns (merged, conflicts), where conflicts maps each
+    non-list field that received different values to those values.
+    """
+    rules = rules or {}
+    merged = dict(default_structure)
+    conflicts = {}
+
+    keys = list(default_structure)
+    for partial in partials:
+        keys.extend(key for key in partial if key not in keys)
+
+    for key in keys:
+        values = [partial[key] for partial in partials if key in partial and not _is_empty(partial[key])]
+        if not values:
+            continue
+        is_list = isinstance(default_structure.get(key), list) or all(isinstance(v, list) for v in values)
+        rule = rules.get(key, MERGE_UNION if is_list else MERGE_MOST_COMMON)
+        merged[key] = _merge_values(values, rule)
+
+        if rule != MERGE_UNION:
+            distinct = []
+            for value in values:
+                if _comparable(value) not in {_comparable(v) for v in distinct}:
+                    distinct.append(value)
+            if len(distinct) > 1:
+                conflicts[key] = distinct
+
+    return merged, conflicts
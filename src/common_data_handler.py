@@ -83,7 +83,15 @@ class CommonDataHandler:
         form_data["codice_fiscale"] = st.text_input("Codice fiscale", extracted_data.get("codice_fiscale", ""))
         
         # Gestione standardizzata del capitale sociale
-        capitale_data = CommonDataHandler._process_capitale_sociale(extracted_data.get("capitale_sociale", ""))
+        capitale_raw = extracted_data.get("capitale_sociale", "")
+        if not isinstance(capitale_raw, dict) and any(
+                extracted_data.get(f"capitale_{part}") for part in ("deliberato", "sottoscritto", "versato")):
+            # Visura: importi distinti estratti separatamente, il capitale sociale completa quelli mancanti
+            capitale_raw = {
+                part: extracted_data.get(f"capitale_{part}") or capitale_raw or "10.000,00"
+                for part in ("deliberato", "sottoscritto", "versato")
+            }
+        capitale_data = CommonDataHandler._process_capitale_sociale(capitale_raw)
         
         col1, col2, col3 = st.columns(3)
         with col1:
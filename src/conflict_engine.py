@@ -0,0 +1,421 @@
+"""
+Rilevamento locale dei conflitti tra i documenti elaborati.
+
+Prima ogni analisi dei conflitti inviava al modello tutti i JSON estratti solo
+per trovare i valori diversi. Qui il confronto avviene in locale:
+
+- i valori vengono normalizzati per tipo di campo (nomi e denominazioni,
+  codici fiscali e partite IVA, indirizzi, date, importi), così "ACME S.r.l." e
+  "Acme SRL" o "01/02/2020" e "2020-02-01" non sono conflitti;
+- le differenze residue vengono valutate con confronto approssimato (difflib),
+  cifra di controllo dei codici, maggioranza e autorevolezza della fonte
+  (la visura prevale sulla fattura per i dati societari, il documento di
+  identità per quelli personali);
+- ogni conflitto ha una confidenza (0-1) per il valore raccomandato: sopra
+  CONFLICT_AUTO_RESOLVE_CONFIDENCE è risolto in automatico, altrimenti è
+  ambiguo e solo allora viene chiesto un parere al modello.
+
+I dati delle persone (documenti di identità) si confrontano solo tra documenti
+che riguardano la stessa persona (stesso codice fiscale o stesso nome). Gli
+elenchi (soci, amministratori, righe) non vengono confrontati campo per campo.
+
+Variabili d'ambiente: CONFLICT_FUZZY_THRESHOLD, CONFLICT_AUTO_RESOLVE_CONFIDENCE.
+"""
+
+from decimal import Decimal, InvalidOperation
+from difflib import SequenceMatcher
+import os
+import re
+import unicodedata
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from fiscal_codes import is_valid_codice_fiscale, is_valid_partita_iva, normalize_code
+
+FUZZY_THRESHOLD = float(os.environ.get("CONFLICT_FUZZY_THRESHOLD", "0.88"))
+AUTO_RESOLVE_CONFIDENCE = float(os.environ.get("CONFLICT_AUTO_RESOLVE_CONFIDENCE", "0.85"))
+
+# Confidenze per tipo di risoluzione
+CONFIDENCE_CHECKSUM = 0.95     # un solo valore con cifra di controllo corretta
+CONFIDENCE_AUTHORITY = 0.6     # nessun altro criterio: vale la fonte più autorevole
+
+KIND_CODE, KIND_NAME, KIND_ADDRESS, KIND_DATE, KIND_AMOUNT, KIND_TEXT = (
+    "code", "name", "address", "date", "amount", "text")
+
+PERSON_DOCUMENT_TYPES = {"riconoscimento"}
+
+# Autorevolezza delle fonti (indice più basso = più autorevole)
+COMPANY_AUTHORITY = ["visura", "statuto", "verbale_assemblea", "bilancio", "contratto", "fattura", "generico"]
+PERSON_AUTHORITY = ["riconoscimento", "visura", "verbale_assemblea", "statuto", "contratto", "fattura", "bilancio",
+                    "generico"]
+
+_IGNORED_FIELDS = {"note", "tipo_documento"}
+
+_MONTHS = {name: number for number, name in enumerate(
+    ["gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno", "luglio", "agosto",
+     "settembre", "ottobre", "novembre", "dicembre"], 1)}
+_NUMERIC_DATE = re.compile(r'^(\d{1,2})[/\-.](\d{1,2})[/\-.](\d{2,4})$')
+_ISO_DATE = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})')
+_TEXT_DATE = re.compile(r'^(\d{1,2})\s*(?:°|º)?\s+([a-z]+)\s+(\d{4})$')
+
+_COMPANY_FORMS = [
+    (re.compile(r'\bsocieta\s+a\s+responsabilita\s+limitata(\s+semplificata)?\b'), lambda m: "srls" if m.group(1) else "srl"),
+    (re.compile(r'\bsocieta\s+per\s+azioni\b'), lambda m: "spa"),
+    (re.compile(r'\bs\s?r\s?l\s?s\b'), lambda m: "srls"),
+    (re.compile(r'\bs\s?r\s?l\b'), lambda m: "srl"),
+    (re.compile(r'\bs\s?p\s?a\b'), lambda m: "spa"),
+    (re.compile(r'\bs\s?a\s?s\b'), lambda m: "sas"),
+    (re.compile(r'\bs\s?n\s?c\b'), lambda m: "snc"),
+]
+_ADDRESS_ABBREVIATIONS = [
+    (re.compile(r'\bv\.?\s*le\b'), "viale"),
+    (re.compile(r'\bp\.?\s*z?za\b'), "piazza"),
+    (re.compile(r'\bc\.?\s*so\b'), "corso"),
+    (re.compile(r'\bv\.(?=\s|\w)'), "via "),
+    (re.compile(r'\bl\.?\s*go\b'), "largo"),
+    (re.compile(r'\bn\.?\s*(?=\d)|\bnum(?:ero)?\.?\s*(?=\d)|\bcivico\s*(?=\d)'), ""),
+]
+
+
+class ConflictValue(NamedTuple):
+    """Valore di un campo in un documento"""
+    value: Any
+    normalized: str
+    source_document: str
+    document_type: str
+
+
+class FieldConflict:
+    """Valori diversi dello stesso campo, con il valore raccomandato e la sua confidenza"""
+
+    def __init__(self, field_name: str, kind: str, values: List[ConflictValue], recommended: ConflictValue,
+                 confidence: float, conflict_type: str, reason: str):
+        self.field_name = field_name
+        self.kind = kind
+        self.values = values
+        self.recommended = recommended
+        self.confidence = confidence
+        self.conflict_type = conflict_type
+        self.reason = reason
+        self.ai_recommendation: Optional[str] = None
+
+    @property
+    def ambiguous(self) -> bool:
+        return self.confidence < AUTO_RESOLVE_CONFIDENCE
+
+    def find_value(self, value: Any) -> Optional[ConflictValue]:
+        """The document value equal to value once normalized, if any"""
+        normalized = normalize_value(self.field_name.split(' (', 1)[0], value)
+        return next((candidate for candidate in self.values if candidate.normalized == normalized), None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Conflict in the format shown by the conflict resolution UI"""
+        if not self.ambiguous:
+            level = "BASSO"
+        else:
+            level = "ALTO" if self.confidence <= CONFIDENCE_AUTHORITY else "MEDIO"
+        return {
+            "field_name": self.field_name,
+            "conflict_type": self.conflict_type,
+            "confidence_level": level,
+            "confidence": round(self.confidence, 2),
+            "description": self.reason,
+            "values": [{
+                "value": value.value,
+                "source_document": value.source_document,
+                "document_type": value.document_type,
+                "confidence": ("valore raccomandato: " + self.reason) if value == self.recommended
+                              else "valore alternativo",
+            } for value in self.values],
+            "recommended_value": self.recommended.value,
+            "recommended_source": self.recommended.source_document,
+            "ai_recommendation": self.ai_recommendation or
+                                 f"{self.recommended.value} (da {self.recommended.source_document}, "
+                                 f"confidenza {self.confidence:.0%})",
+            "resolved_locally": not self.ambiguous,
+        }
+
+
+# --- Normalizzazione ----------------------------------------------------------
+
+def _strip_accents(text: str) -> str:
+    return "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+
+
+def _clean(text: Any) -> str:
+    return re.sub(r'\s+', ' ', _strip_accents(str(text)).lower()).strip()
+
+
+def normalize_name(value: Any) -> str:
+    """Lowercase name without accents, punctuation or company-form variants; tokens in sorted order"""
+    text = _clean(value).replace('.', '').replace("'", ' ')
+    for pattern, replacement in _COMPANY_FORMS:
+        text = pattern.sub(replacement, text)
+    tokens = re.findall(r'[a-z0-9&]+', text)
+    return " ".join(sorted(tokens))
+
+
+def normalize_address(value: Any) -> str:
+    text = _clean(value)
+    for pattern, replacement in _ADDRESS_ABBREVIATIONS:
+        text = pattern.sub(replacement, text)
+    return " ".join(re.findall(r'[a-z0-9]+', text))
+
+
+def normalize_date(value: Any) -> str:
+    """ISO date (YYYY-MM-DD) when the value is a recognisable date, otherwise the cleaned text"""
+    text = _clean(value)
+    match = _NUMERIC_DATE.match(text)
+    if match:
+        day, month, year = (int(group) for group in match.groups())
+        if year < 100:
+            year += 2000 if year < 50 else 1900
+    else:
+        match = _ISO_DATE.match(text)
+        if match:
+            year, month, day = (int(group) for group in match.groups())
+        else:
+            match = _TEXT_DATE.match(text)
+            if not match or match.group(2) not in _MONTHS:
+                return text
+            day, month, year = int(match.group(1)), _MONTHS[match.group(2)], int(match.group(3))
+    if not (1 <= month <= 12 and 1 <= day <= 31):
+        return text
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def normalize_amount(value: Any) -> str:
+    """Amount as a plain decimal ("10000.00"), Italian and English separators accepted"""
+    text = re.sub(r'(?i)eur(o)?|€|\s', '', str(value))
+    if ',' in text and '.' in text:
+        text = text.replace('.', '').replace(',', '.') if text.rfind(',') > text.rfind('.') else text.replace(',', '')
+    elif ',' in text:
+        text = text.replace(',', '.')
+    elif re.fullmatch(r'\d{1,3}(\.\d{3})+', text):
+        text = text.replace('.', '')
+    try:
+        return str(Decimal(text).quantize(Decimal("0.01")))
+    except InvalidOperation:
+        return _clean(value)
+
+
+_NORMALIZERS = {
+    KIND_CODE: normalize_code,
+    KIND_NAME: normalize_name,
+    KIND_ADDRESS: normalize_address,
+    KIND_DATE: normalize_date,
+    KIND_AMOUNT: normalize_amount,
+    KIND_TEXT: _clean,
+}
+
+
+def field_kind(field_name: str) -> str:
+    """Kind of a (possibly dotted) field name, used to choose its normalizer"""
+    name = field_name.rsplit('.', 1)[-1].lower()
+    if name in ("codice_fiscale", "partita_iva", "numero_rea") or name.startswith(("codice_fiscale", "partita_iva")):
+        return KIND_CODE
+    if name.startswith("data") or name.endswith(("_data", "_date")) or "scadenza" in name:
+        return KIND_DATE
+    if name.startswith(("capitale", "importo", "totale", "prezzo", "imponibile", "iva_", "valore", "utile")):
+        return KIND_AMOUNT
+    if any(part in name for part in ("sede", "indirizzo", "residenza", "domicilio")):
+        return KIND_ADDRESS
+    if any(part in name for part in ("nome", "cognome", "denominazione", "ragione_sociale", "luogo", "comune",
+                                     "citta", "presidente", "segretario", "amministratore")):
+        return KIND_NAME
+    return KIND_TEXT
+
+
+def normalize_value(field_name: str, value: Any) -> str:
+    return _NORMALIZERS[field_kind(field_name)](value)
+
+
+def similarity(a: str, b: str) -> float:
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def _numbers(text: str) -> Tuple[str, ...]:
+    return tuple(re.findall(r'\d+', text))
+
+
+def _valid_code(field_name: str, code: str) -> bool:
+    if field_name.rsplit('.', 1)[-1].startswith("partita_iva"):
+        return is_valid_partita_iva(code)
+    return is_valid_codice_fiscale(code)
+
+
+# --- Raccolta dei valori ------------------------------------------------------
+
+def flatten_fields(info: Dict[str, Any]) -> Dict[str, Any]:
+    """Scalar fields of an extracted JSON; nested objects become dotted names, lists are skipped"""
+    fields = {}
+    for key, value in info.items():
+        if key in _IGNORED_FIELDS:
+            continue
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                if sub_key not in _IGNORED_FIELDS and not isinstance(sub_value, (dict, list)) and str(sub_value).strip():
+                    fields[f"{key}.{sub_key}"] = sub_value
+        elif not isinstance(value, list) and value is not None and str(value).strip():
+            fields[key] = value
+    return fields
+
+
+def person_key(info: Dict[str, Any]) -> Optional[str]:
+    """Identity of the person described by an identity document: codice fiscale, else full name"""
+    code = normalize_code(str(info.get("codice_fiscale") or ""))
+    if is_valid_codice_fiscale(code):
+        return code
+    name = normalize_name(f"{info.get('nome') or ''} {info.get('cognome') or ''}")
+    return name or None
+
+
+def document_scope(document: Dict[str, Any]) -> Optional[str]:
+    """Group of documents whose fields are compared with each other (None = not comparable)"""
+    if document.get("document_type") in PERSON_DOCUMENT_TYPES:
+        key = person_key(document.get("extracted_info") or {})
+        return f"persona:{key}" if key else None
+    return "societa"
+
+
+class ConflictEngine:
+    """Deterministic conflict detection between processed documents"""
+
+    def __init__(self, fuzzy_threshold: float = FUZZY_THRESHOLD):
+        self.fuzzy_threshold = fuzzy_threshold
+
+    def detect(self, documents: Iterable[Dict[str, Any]]) -> List[FieldConflict]:
+        """Conflicts between documents (processed_documents entries), most doubtful first"""
+        return ConflictIndex(self).sync(documents)
+
+    def evaluate(self, field_name: str, values: List[ConflictValue], scope: str = "societa") -> Optional[FieldConflict]:
+        """FieldConflict for the values of one field, or None when they agree once normalized"""
+        clusters: Dict[str, List[ConflictValue]] = {}
+        for value in values:
+            clusters.setdefault(value.normalized, []).append(value)
+        if len(clusters) < 2:
+            return None
+
+        kind = field_kind(field_name)
+        authority = PERSON_AUTHORITY if scope.startswith("persona:") else COMPANY_AUTHORITY
+        display_name = field_name if scope == "societa" else f"{field_name} ({scope.split(':', 1)[1].upper()})"
+
+        def rank(value: ConflictValue) -> int:
+            return authority.index(value.document_type) if value.document_type in authority else len(authority)
+
+        ordered = sorted(clusters.values(), key=lambda cluster: (-len(cluster), min(rank(v) for v in cluster)))
+        by_authority = min(values, key=rank)
+
+        # Codici: se un solo valore ha la cifra di controllo corretta, gli altri sono errori di lettura
+        if kind == KIND_CODE:
+            valid = [cluster for normalized, cluster in clusters.items() if _valid_code(field_name, normalized)]
+            if len(valid) == 1:
+                return FieldConflict(display_name, kind, values, min(valid[0], key=rank), CONFIDENCE_CHECKSUM,
+                                     "FORMATO_DIVERSO", "unico valore con cifra di controllo corretta")
+
+        # Nomi, indirizzi, testi: differenze minime (refusi OCR, abbreviazioni residue); i numeri
+        # (civici, CAP) devono coincidere, altrimenti è un valore diverso e non un refuso
+        if kind in (KIND_NAME, KIND_ADDRESS, KIND_TEXT) and len({_numbers(key) for key in clusters}) == 1:
+            keys = list(clusters)
+            closest = min(similarity(a, b) for i, a in enumerate(keys) for b in keys[i + 1:])
+            if closest >= self.fuzzy_threshold:
+                return FieldConflict(display_name, kind, values, by_authority, closest, "FORMATO_DIVERSO",
+                                     f"valori quasi identici (somiglianza {closest:.0%}): "
+                                     f"prevale la fonte più autorevole ({by_authority.document_type})")
+
+        # Maggioranza tra i documenti
+        majority = ordered[0]
+        share = len(majority) / len(values)
+        if share > 0.5:
+            return FieldConflict(display_name, kind, values, min(majority, key=rank), share, "VALORE_DIVERSO",
+                                 f"valore presente in {len(majority)} documenti su {len(values)}")
+
+        return FieldConflict(display_name, kind, values, by_authority, CONFIDENCE_AUTHORITY, "VALORE_DIVERSO",
+                             f"valori diversi: proposto quello della fonte più autorevole ({by_authority.document_type})")
+
+
+class ConflictIndex:
+    """Field values of the processed documents, kept up to date one document at a time.
+
+    Adding a document only re-evaluates the fields it contributes to, removing one
+    retracts its values; with an unchanged set of documents the cached conflicts
+    are returned as they are.
+    """
+
+    def __init__(self, engine: Optional[ConflictEngine] = None):
+        self.engine = engine or ConflictEngine()
+        # (ambito, campo) -> {id documento: valore}
+        self._groups: Dict[Tuple[str, str], Dict[int, ConflictValue]] = {}
+        self._documents: Dict[int, Dict[str, Any]] = {}
+        self._contributions: Dict[int, List[Tuple[str, str]]] = {}
+        self._conflicts: Dict[Tuple[str, str], FieldConflict] = {}
+        self._dirty: set = set()
+        self._cached: Optional[List[FieldConflict]] = None
+        # Incrementata a ogni modifica: permette di riusare analisi costruite sui conflitti
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def add_document(self, document: Dict[str, Any]):
+        """Index the field values of a processed_documents entry"""
+        doc_id = id(document)
+        if doc_id in self._documents:
+            return
+        # Il riferimento al documento impedisce il riuso del suo id finché è indicizzato
+        self._documents[doc_id] = document
+        keys = []
+        scope = document_scope(document)
+        if scope is not None:
+            for field_name, value in flatten_fields(document.get("extracted_info") or {}).items():
+                key = (scope, field_name)
+                self._groups.setdefault(key, {})[doc_id] = ConflictValue(
+                    value, normalize_value(field_name, value), document.get("file_name", ""),
+                    document.get("document_type", ""))
+                keys.append(key)
+        self._contributions[doc_id] = keys
+        self._touch(keys)
+
+    def remove_document(self, document: Dict[str, Any]):
+        """Retract the values contributed by a document"""
+        doc_id = id(document)
+        if self._documents.pop(doc_id, None) is None:
+            return
+        keys = self._contributions.pop(doc_id, [])
+        for key in keys:
+            group = self._groups.get(key, {})
+            group.pop(doc_id, None)
+            if not group:
+                self._groups.pop(key, None)
+        self._touch(keys)
+
+    def sync(self, documents: Iterable[Dict[str, Any]]) -> List[FieldConflict]:
+        """Bring the index in line with documents (adding and removing the differences); returns conflicts()"""
+        documents = list(documents)
+        current = {id(document) for document in documents}
+        for doc_id in [doc_id for doc_id in self._documents if doc_id not in current]:
+            self.remove_document(self._documents[doc_id])
+        for document in documents:
+            self.add_document(document)
+        return self.conflicts()
+
+    def conflicts(self) -> List[FieldConflict]:
+        """Current conflicts, most doubtful first; only fields touched since the last call are re-evaluated"""
+        if self._cached is not None:
+            return self._cached
+        for key in self._dirty:
+            values = list(self._groups.get(key, {}).values())
+            conflict = self.engine.evaluate(key[1], values, key[0]) if len(values) > 1 else None
+            if conflict is None:
+                self._conflicts.pop(key, None)
+            else:
+                self._conflicts[key] = conflict
+        self._dirty.clear()
+        self._cached = sorted(self._conflicts.values(), key=lambda conflict: conflict.confidence)
+        return self._cached
+
+    def _touch(self, keys: Iterable[Tuple[str, str]]):
+        keys = list(keys)
+        self._dirty.update(keys)
+        if keys:
+            self._cached = None
+            self.version += 1
@@ -0,0 +1,256 @@
+"""
+Riconoscimento del tipo di documento da nome del file e contenuto.
+
+suggest_document_type cercava decine di parole chiave una alla volta nel testo
+completo, in un ordine fisso: vinceva la prima corrispondenza anche debole
+(una sola "assemblea ordinaria" bastava per "statuto", "rea" trovava anche
+"area"). Qui:
+
+- tutte le parole chiave sono cercate in un'unica passata con un automa
+  Aho-Corasick, a parole intere;
+- ogni parola chiave ha un peso per tipo di documento; le ripetizioni
+  aumentano il punteggio con rendimento decrescente e le parole
+  nell'intestazione della prima pagina valgono doppio (i documenti dichiarano
+  il loro tipo nel titolo: "STATUTO", "VERBALE DI ASSEMBLEA");
+- il testo è letto pagina per pagina e la lettura si ferma appena un tipo ha
+  punteggio e distacco sufficienti, entro DOCUMENT_CLASSIFIER_MAX_PAGES;
+- il risultato è la classifica dei tipi con la quota di punteggio di ciascuno
+  come confidenza.
+
+Variabili d'ambiente: DOCUMENT_CLASSIFIER_MAX_PAGES,
+DOCUMENT_CLASSIFIER_MIN_SCORE, DOCUMENT_CLASSIFIER_CONFIDENCE.
+"""
+
+from collections import Counter, deque
+import os
+import threading
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from pdf_text_backends import get_text_backend
+
+MAX_PAGES = int(os.environ.get("DOCUMENT_CLASSIFIER_MAX_PAGES", "50"))
+# Decisione presa quando il primo tipo ha almeno MIN_SCORE punti e questa quota del totale
+MIN_SCORE = float(os.environ.get("DOCUMENT_CLASSIFIER_MIN_SCORE", "8"))
+CONFIDENT_SHARE = float(os.environ.get("DOCUMENT_CLASSIFIER_CONFIDENCE", "0.6"))
+
+# Caratteri per "pagina" quando il testo non ha separatori di pagina
+PAGE_CHARS = 3000
+# Intestazione della prima pagina in cui le parole chiave valgono TITLE_BOOST volte
+TITLE_CHARS = 300
+TITLE_BOOST = 2.0
+# Ogni ripetizione aggiunge REPEAT_BONUS volte il peso, fino a MAX_REPEATS ripetizioni
+REPEAT_BONUS = 0.2
+MAX_REPEATS = 10
+# Peso di una parola chiave trovata nel nome del file
+FILENAME_WEIGHT = 6.0
+FALLBACK_TYPE = "generico"
+
+KEYWORDS: Dict[str, Dict[str, float]] = {
+    "visura": {
+        "visura": 4, "camera di commercio": 3, "registro delle imprese": 3, "registro imprese": 3,
+        "numero rea": 4, "rea": 1.5, "cciaa": 3, "infocamere": 4, "codice ateco": 2,
+        "data iscrizione": 1.5, "titolari di cariche": 3, "elenco soci": 2, "sede legale": 0.5,
+    },
+    "bilancio": {
+        "bilancio di esercizio": 4, "stato patrimoniale": 4, "conto economico": 4, "nota integrativa": 4,
+        "rendiconto finanziario": 3, "totale attivo": 3, "ricavi delle vendite": 3,
+        "utile (perdita) dell'esercizio": 3, "patrimonio netto": 2, "immobilizzazioni": 1.5,
+        "ammortamenti": 1.5, "bilancio": 1.5, "ricavi": 0.5, "patrimonio": 0.5,
+    },
+    "statuto": {
+        "statuto sociale": 4, "statuto": 3, "durata della società": 3, "clausola compromissoria": 3,
+        "trasferimento delle partecipazioni": 3, "scioglimento e liquidazione": 2.5,
+        "decisioni dei soci": 2, "articolo 1": 2, "art. 1": 2, "titolo i": 2, "oggetto sociale": 1.5,
+        "recesso del socio": 2, "amministrazione della società": 1.5, "articolo": 0.5,
+        "capitale sociale": 0.5,
+    },
+    "verbale_assemblea": {
+        "verbale di assemblea": 4, "verbale dell'assemblea": 4, "verbale assemblea": 4,
+        "assume la presidenza": 3.5, "dichiara validamente costituita": 3.5, "si è riunita": 3,
+        "dichiara aperta": 3, "approva all'unanimità": 3, "null'altro essendovi": 3,
+        "ordine del giorno": 2.5, "soci presenti": 2, "la seduta": 2, "segretario": 1.5,
+        "all'unanimità": 1.5, "alle ore": 1.5, "assemblea ordinaria": 1.5, "assemblea straordinaria": 1.5,
+        "delibera": 1, "l'assemblea": 1,
+    },
+    "fattura": {
+        "numero fattura": 4, "fattura n": 3, "fattura": 3, "codice destinatario": 3.5,
+        "totale documento": 3, "imponibile": 2.5, "regime iva": 2, "scadenza pagamento": 2,
+        "aliquota": 1.5, "iva": 1, "partita iva": 0.5, "p.iva": 0.5,
+    },
+    "contratto": {
+        "oggetto del contratto": 4, "si conviene e si stipula": 4, "parte contraente": 3,
+        "contratto di": 2.5, "tra le parti": 2.5, "premesso che": 2.5, "letto, confermato e sottoscritto": 2,
+        "contratto": 2, "clausola": 1, "le parti": 1, "accordo": 1, "sottoscrizione": 1,
+    },
+    "riconoscimento": {
+        "carta d'identità": 4, "carta di identità": 4, "carta d'identita": 4, "patente di guida": 4,
+        "passaporto": 4, "nato/a il": 3, "statura": 3, "rilasciato da": 2, "rilasciata da": 2,
+        "luogo di nascita": 2, "data di scadenza": 1.5, "cittadinanza": 1.5, "codice fiscale": 0.5,
+        "nato": 0.5,
+    },
+}
+
+FILENAME_KEYWORDS: Dict[str, List[str]] = {
+    "visura": ["visura", "camerale", "cciaa"],
+    "bilancio": ["bilancio", "balance", "financial"],
+    "statuto": ["statuto", "statute", "bylaws"],
+    "verbale_assemblea": ["verbale", "assemblea", "minutes"],
+    "fattura": ["fattura", "invoice", "bill"],
+    "contratto": ["contratto", "contract", "agreement"],
+    "riconoscimento": ["carta_identita", "carta", "patente", "passaporto", "documento_identita"],
+}
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton: every occurrence of every pattern in one pass over the text"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(pattern)
+
+        # Link di fallimento in ampiezza: il suffisso più lungo che è anche prefisso di un pattern
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def scan(self, text: str, state: int = 0) -> Tuple[int, List[Tuple[int, int, str]]]:
+        """Run the automaton over text from state; returns (final state, [(start, end, pattern)])"""
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        for index, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for pattern in output[state]:
+                    matches.append((index - len(pattern) + 1, index, pattern))
+        return state, matches
+
+
+class Classification(NamedTuple):
+    """Tipo di documento candidato con punteggio e quota del punteggio totale"""
+    document_type: str
+    score: float
+    confidence: float
+
+
+def _is_boundary(text: str, index: int) -> bool:
+    return index < 0 or index >= len(text) or not text[index].isalnum()
+
+
+class DocumentClassifier:
+    """Weighted keyword scoring over the first pages of a document"""
+
+    def __init__(self, keywords: Optional[Dict[str, Dict[str, float]]] = None,
+                 filename_keywords: Optional[Dict[str, List[str]]] = None):
+        self.keywords = keywords or KEYWORDS
+        self.filename_keywords = filename_keywords or FILENAME_KEYWORDS
+        # Parola chiave -> [(tipo, peso)]: la stessa parola può pesare su più tipi
+        self._weights: Dict[str, List[Tuple[str, float]]] = {}
+        for document_type, weights in self.keywords.items():
+            for keyword, weight in weights.items():
+                self._weights.setdefault(keyword, []).append((document_type, weight))
+        self._automaton = KeywordAutomaton(self._weights)
+
+    def _filename_scores(self, file_name: str) -> Dict[str, float]:
+        name = file_name.lower()
+        return {document_type: FILENAME_WEIGHT for document_type, keywords in self.filename_keywords.items()
+                if any(keyword in name for keyword in keywords)}
+
+    def _score(self, counts: Counter, in_title: Set[str], prior: Dict[str, float]) -> Dict[str, float]:
+        scores = dict(prior)
+        for keyword, count in counts.items():
+            factor = 1 + REPEAT_BONUS * min(count - 1, MAX_REPEATS)
+            if keyword in in_title:
+                factor *= TITLE_BOOST
+            for document_type, weight in self._weights[keyword]:
+                scores[document_type] = scores.get(document_type, 0.0) + weight * factor
+        return scores
+
+    @staticmethod
+    def _ranking(scores: Dict[str, float]) -> List[Classification]:
+        total = sum(scores.values())
+        if total <= 0:
+            return [Classification(FALLBACK_TYPE, 0.0, 0.0)]
+        return [Classification(document_type, round(score, 2), score / total)
+                for document_type, score in sorted(scores.items(), key=lambda item: -item[1]) if score > 0]
+
+    def classify(self, file_name: str = "", pages: Iterable[str] = (),
+                 max_pages: Optional[int] = None) -> List[Classification]:
+        """Ranked candidate types; pages are read lazily and reading stops at a confident decision"""
+        max_pages = MAX_PAGES if max_pages is None else max_pages
+        prior = self._filename_scores(file_name)
+        counts: Counter = Counter()
+        in_title = set()
+        ranking = self._ranking(prior)
+        for page_number, page in enumerate(pages):
+            if page_number >= max_pages:
+                break
+            text = page.lower().replace("’", "'")
+            # Stato ripartito a ogni pagina: le parole chiave non attraversano il salto pagina
+            _, matches = self._automaton.scan(text)
+            for start, end, keyword in matches:
+                if not (_is_boundary(text, start - 1) and _is_boundary(text, end + 1)):
+                    continue
+                counts[keyword] += 1
+                if page_number == 0 and start < TITLE_CHARS:
+                    in_title.add(keyword)
+            ranking = self._ranking(self._score(counts, in_title, prior))
+            top = ranking[0]
+            if top.score >= MIN_SCORE and top.confidence >= CONFIDENT_SHARE:
+                break
+        return ranking
+
+
+def text_pages(text: str) -> Iterator[str]:
+    """Pages of a plain text: split on form feeds, otherwise in PAGE_CHARS blocks"""
+    if "\f" in text:
+        yield from text.split("\f")
+        return
+    for start in range(0, len(text), PAGE_CHARS):
+        yield text[start:start + PAGE_CHARS]
+
+
+def pdf_text_pages(pdf_bytes: bytes, pages_per_read: int = 2) -> Iterator[str]:
+    """Text layer of a PDF, read a few pages at a time (nothing beyond what the classifier consumes)"""
+    try:
+        backend = get_text_backend()
+        total_pages = backend.page_count(pdf_bytes)
+        for start in range(0, total_pages, pages_per_read):
+            yield from backend.extract_page_range(pdf_bytes, start, min(start + pages_per_read, total_pages))
+    except Exception:
+        # PDF illeggibile o senza layer di testo: resta la classificazione dal nome del file
+        return
+
+
+_default_classifier = None
+_default_classifier_lock = threading.Lock()
+
+
+def get_document_classifier() -> DocumentClassifier:
+    """Classificatore condiviso (l'automa si costruisce una volta sola)"""
+    global _default_classifier
+    with _default_classifier_lock:
+        if _default_classifier is None:
+            _default_classifier = DocumentClassifier()
+        return _default_classifier
@@ -0,0 +1,65 @@
+"""
+Impronte dei documenti caricati, per riconoscere i duplicati.
+
+Lo stesso PDF caricato due volte (con un altro nome o in un caricamento
+successivo) veniva elaborato di nuovo, con OCR ed estrazione pagati due volte,
+e la copia produceva falsi conflitti. Due livelli:
+
+- duplicato esatto: stesso SHA-256 dei byte del file; il risultato già
+  ottenuto viene riusato senza elaborare il file;
+- quasi duplicato (lo stesso documento riscansionato): testi con similarità
+  di Jaccard sugli shingle di SHINGLE_WORDS parole di almeno
+  NEAR_DUPLICATE_THRESHOLD. La similarità è stimata con uno sketch bottom-k
+  (gli SKETCH_SIZE hash di shingle più piccoli), abbastanza compatto da essere
+  salvato con il documento.
+
+Variabili d'ambiente: DOCUMENT_DEDUP (0 = disattivata), NEAR_DUPLICATE_THRESHOLD.
+"""
+
+import hashlib
+import os
+import re
+from typing import List, Sequence
+
+DEDUP_ENABLED = os.environ.get("DOCUMENT_DEDUP", "1") != "0"
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+
+# Shingle corti: un errore OCR altera solo gli shingle che contengono la parola sbagliata
+SHINGLE_WORDS = 3
+SKETCH_SIZE = 128
+# Sotto questo numero di parole il testo non basta per un confronto affidabile
+MIN_WORDS = 20
+
+_WORD_PATTERN = re.compile(r"[0-9a-zà-ÿ]+")
+
+
+def content_hash(file_bytes: bytes) -> str:
+    """SHA-256 esadecimale dei byte del file"""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def text_sketch(text: str) -> List[int]:
+    """Bottom-k sketch of the word shingles of a text (empty for texts too short to compare)"""
+    words = _WORD_PATTERN.findall((text or "").lower())
+    if len(words) < MIN_WORDS:
+        return []
+    hashes = {
+        int.from_bytes(hashlib.blake2b(" ".join(words[i:i + SHINGLE_WORDS]).encode("utf-8"),
+                                       digest_size=8).digest(), "big")
+        for i in range(len(words) - SHINGLE_WORDS + 1)
+    }
+    return sorted(hashes)[:SKETCH_SIZE]
+
+
+def estimate_similarity(sketch_a: Sequence[int], sketch_b: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the shingle sets behind two sketches"""
+    if not sketch_a or not sketch_b:
+        return 0.0
+    set_a, set_b = set(sketch_a), set(sketch_b)
+    # I k hash più piccoli dell'unione sono un campione uniforme dell'unione degli shingle
+    sample = sorted(set_a | set_b)[:min(len(set_a), len(set_b))]
+    return sum(1 for value in sample if value in set_a and value in set_b) / len(sample)
+
+
+def is_near_duplicate(sketch_a: Sequence[int], sketch_b: Sequence[int]) -> bool:
+    return estimate_similarity(sketch_a, sketch_b) >= NEAR_DUPLICATE_THRESHOLD
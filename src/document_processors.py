@@ -1,16 +1,102 @@
 from abc import ABC, abstractmethod
-import json
-from typing import Dict, List, Any, Optional
+import base64
+from collections import deque
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager
+import os
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, Any, Optional
 from mistralai import Mistral
-import PyPDF2
-import io
 import streamlit as st
+from ocr_cache import get_ocr_cache
+from text_quality import score_page_text
+from pdf_text_backends import get_text_backend
+from upload_session import get_upload_session
+from image_preprocessing import image_mime_type, preprocess_identity_document
+from async_runner import run_sync
+from api_scheduler import BudgetExhausted, CallBudget, DeadlineExceeded
+from resilience import CircuitOpen, get_resilience
+from rate_limiter import PRIORITY_NORMAL, RateLimitTimeout, get_rate_limiter
+from model_router import get_model_router
+from llm_cache import cached_chat_complete, cached_chat_complete_async, contains_json_object
+from json_utils import json_schema_response_format, parse_json_object
+from visura_rules import FieldMatch, confident_fields, extract_visura_fields
+from fiscal_codes import is_valid_personal_codice_fiscale
+from chunked_extraction import (MERGE_LONGEST, estimate_tokens, merge_partial_results,
+                                split_into_chunks)
+
+OCR_MODEL = "mistral-ocr-latest"
+
+# Timeout iniziali di OCR e chat: con abbastanza latenze osservate il livello di resilienza
+# li ricava dal p95 per endpoint
+OCR_TIMEOUT = 120
+CHAT_TIMEOUT = 10
+# Tempo massimo complessivo (tentativi e pause inclusi) per le chiamate di estrazione di un documento
+EXTRACTION_BUDGET = float(os.environ.get("EXTRACTION_BUDGET_SECONDS", "45"))
+# Timeout iniziale di ciascun blocco nell'estrazione a blocchi (i blocchi girano in parallelo)
+CHUNK_TIMEOUT = 30
+
+# Pool condiviso per le chiamate di rete che si sovrappongono al parsing locale
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+
+def _get_io_executor() -> ThreadPoolExecutor:
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mistral-io")
+        return _io_executor
+
+
+def take_pages(pages: Iterable[Dict[str, Any]], max_chars: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Consume a page iterator until max_chars of text are collected, then stop it (None = all pages)"""
+    taken = []
+    total_chars = 0
+    for page in pages:
+        taken.append(page)
+        total_chars += len(page.get("text") or "")
+        if max_chars is not None and total_chars >= max_chars:
+            break
+    # Chiude il generatore: le chiamate OCR non ancora avviate vengono annullate
+    if hasattr(pages, "close"):
+        pages.close()
+    return taken
+
 
 class DocumentProcessor(ABC):
     """Base class for document processors"""
     
+    # Caratteri di testo sufficienti per l'estrazione (None = documento completo)
+    max_text_chars = None
+    
+    # Upload, signed URL e OCR partono in parallelo al parsing locale (CONCURRENT_EXTRACTION=0 per disattivare)
+    concurrent_extraction = os.environ.get("CONCURRENT_EXTRACTION", "1") != "0"
+    
+    # Pipeline asincrona su event loop condiviso, senza messaggi intermedi nell'interfaccia (ASYNC_PIPELINE=1 per attivare)
+    async_pipeline = os.environ.get("ASYNC_PIPELINE", "0") == "1"
+    
+    # Ignora le risposte in cache e ripeti la chiamata (la nuova risposta sostituisce la voce)
+    bypass_llm_cache = False
+    
+    # Priorità delle chiamate nella coda del rate limiter condiviso
+    api_priority = PRIORITY_NORMAL
+    
+    # Testi oltre il budget di token vengono estratti a blocchi in parallelo (CHUNKED_EXTRACTION=0 per disattivare)
+    chunked_extraction = os.environ.get("CHUNKED_EXTRACTION", "1") != "0"
+    chunk_token_budget = int(os.environ.get("CHUNK_TOKEN_BUDGET", "6000"))
+    # Regole di fusione per campo dei risultati parziali (default: unione per le liste, valore più frequente per gli altri)
+    chunk_merge_rules: Dict[str, str] = {}
+    
+    # Chiavi degli oggetti nelle liste della struttura di default, per lo schema delle risposte strutturate
+    list_item_fields: Dict[str, List[str]] = {}
+    
     def __init__(self, mistral_client: Mistral):
         self.client = mistral_client
+        # Upload condivisi per hash del contenuto: OCR e Document Annotation riusano lo stesso file
+        self.upload_session = get_upload_session(mistral_client)
     
     @abstractmethod
     def get_extraction_prompt(self, text: str) -> str:
@@ -27,126 +113,378 @@ class DocumentProcessor(ABC):
         """Get the document type name for display"""
         pass
     
+    def get_quality_keywords(self) -> List[str]:
+        """Keywords expected on a readable page of this document type (used to score the text layer)"""
+        return []
+    
+    def get_response_format(self, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Schema-constrained JSON response format built from the default structure (optionally only some fields)"""
+        structure = self.get_default_structure()
+        if fields is not None:
+            structure = {key: structure[key] for key in fields if key in structure}
+        return json_schema_response_format(type(self).__name__, structure, self.list_item_fields)
+    
+    def extract_rule_based_fields(self, text: str) -> Dict[str, FieldMatch]:
+        """Fixed-format fields matched without the model, with their confidence (none by default)"""
+        return {}
+    
+    def get_fields_extraction_prompt(self, text: str, fields: List[str]) -> str:
+        """Prompt asking only for the given fields (default: the full extraction prompt)"""
+        return self.get_extraction_prompt(text)
+    
+    def _prompt_for(self, text: str, fields: Optional[List[str]] = None) -> str:
+        return self.get_extraction_prompt(text) if fields is None else self.get_fields_extraction_prompt(text, fields)
+    
+    def _missing_fields(self, default_info: Dict[str, Any], rule_fields: Dict[str, str]) -> Optional[List[str]]:
+        """Fields still to ask the model for, or None when no rule matched (full prompt)"""
+        if not rule_fields:
+            return None
+        return [key for key in default_info if key not in rule_fields]
+    
+    def preprocess_input(self, file_bytes: bytes, file_name: str) -> tuple[bytes, Optional[str]]:
+        """Return the bytes to send to OCR and, for image uploads, their MIME type (None for PDF/text)"""
+        return file_bytes, image_mime_type(file_name)
+    
     def extract_text_from_pdf(self, pdf_bytes: bytes) -> tuple[str, str]:
-        """Extract text using both PyPDF2 and Mistral OCR with improved OCR settings"""
-        # PyPDF2 extraction
-        pypdf2_text = ""
-        try:
-            reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    pypdf2_text += page_text + "\n"
-        except Exception as e:
-            st.error(f"Errore PyPDF2: {e}")
-            pypdf2_text = ""
+        """Extract the PyPDF2 text and the merged text (text layer where readable, Mistral OCR elsewhere)"""
+        text_layer_pages, ocr_pages = self._extract_pdf_page_sources(pdf_bytes)
+        pypdf2_text = "".join(page_text + "\n" for page_text in text_layer_pages if page_text)
+        merged_text = self.pages_to_text(self._merge_pages(text_layer_pages, ocr_pages))
+        return pypdf2_text, merged_text
+    
+    def extract_pages_from_pdf(self, pdf_bytes: bytes) -> List[Dict[str, Any]]:
+        """Extract a single merged page list, running OCR only on pages whose text layer fails the quality check"""
+        return list(self.iter_pdf_pages(pdf_bytes))
+    
+    def iter_pdf_pages(self, pdf_bytes: bytes) -> Iterator[Dict[str, Any]]:
+        """Yield merged pages in order as soon as each one is available; consumers may stop early"""
+        return self._iter_pdf_pages(pdf_bytes, {})
+    
+    def _extract_pdf_page_sources(self, pdf_bytes: bytes) -> tuple[List[str], List[Optional[str]]]:
+        """Return per-page PyPDF2 text and per-page OCR markdown (None where OCR was not needed)"""
+        sources = {}
+        for _ in self._iter_pdf_pages(pdf_bytes, sources):
+            pass
+        return sources.get("text_layer_pages", []), sources.get("ocr_pages", [])
+    
+    def _iter_pdf_pages(self, pdf_bytes: bytes, sources: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Page generator; when fully consumed, fills sources with the raw text-layer and OCR pages"""
+        ocr_cache = get_ocr_cache()
+        cache_params = self._ocr_cache_params()
+        cached = ocr_cache.get(pdf_bytes, OCR_MODEL, **cache_params)
+        if cached is not None:
+            st.caption("♻️ Risultato OCR recuperato dalla cache")
+            sources["text_layer_pages"] = cached.get("text_layer_pages", [])
+            sources["ocr_pages"] = cached.get("ocr_pages", [])
+            yield from self._merge_pages(sources["text_layer_pages"], sources["ocr_pages"])
+            return
+        
+        executor = _get_io_executor()
+        # Upload tenuto aperto per tutte le chiamate OCR del documento: parte alla prima pagina
+        # che ne ha bisogno, così i PDF con testo digitale leggibile non vengono mai caricati
+        upload_future = None
+        
+        keywords = self.get_quality_keywords()
+        text_layer_pages = []
+        ocr_pages = []
+        ocr_futures = []
+        ocr_requested = False
+        pending = deque()  # (indice pagina, future OCR o None), nell'ordine delle pagine
+        ocr_errors = []
+        
+        def resolve(index: int, ocr_future: Optional[Future]) -> Dict[str, Any]:
+            if ocr_future is not None:
+                try:
+                    ocr_pages[index] = ocr_future.result().get(index)
+                except Exception as e:
+                    if not ocr_errors:
+                        st.error(f"Errore Mistral OCR: {e}")
+                    ocr_errors.append(e)
+            return self._merge_page(index, text_layer_pages, ocr_pages)
         
-        # Mistral OCR extraction with optimized settings
-        ocr_text = ""
         try:
-            uploaded_pdf = self.client.files.upload(
-                file={
-                    "file_name": "document.pdf",
-                    "content": pdf_bytes
-                },
-                purpose="ocr"
-            )
+            # Layer di testo a blocchi di pagine (backend configurabile, parallelo sui documenti lunghi).
+            # Per ogni blocco le pagine illeggibili vanno subito all'OCR, senza attendere il resto del documento
+            try:
+                for chunk in get_text_backend().iter_page_chunks(pdf_bytes):
+                    first_index = len(text_layer_pages)
+                    text_layer_pages.extend(chunk)
+                    ocr_pages.extend([None] * len(chunk))
+                    
+                    ocr_indexes = [first_index + i for i, page_text in enumerate(chunk)
+                                   if score_page_text(page_text, keywords)["needs_ocr"]]
+                    ocr_future = None
+                    if ocr_indexes:
+                        if upload_future is None and self.concurrent_extraction:
+                            upload_future = executor.submit(self._upload_for_ocr, pdf_bytes)
+                        ocr_future = executor.submit(self._run_mistral_ocr, pdf_bytes, ocr_indexes)
+                        ocr_futures.append(ocr_future)
+                        ocr_requested = True
+                    for index in range(first_index, len(text_layer_pages)):
+                        pending.append((index, ocr_future if index in ocr_indexes else None))
+                    
+                    # Restituisci subito tutte le pagine già pronte, senza bloccare
+                    while pending and (pending[0][1] is None or pending[0][1].done()):
+                        yield resolve(*pending.popleft())
+            except Exception as e:
+                st.error(f"Errore estrazione testo PDF: {e}")
             
-            # Use enhanced OCR settings for better text extraction
-            ocr_response = self.client.ocr.process(
-                model="mistral-ocr-latest",
-                document={
-                    "type": "document_url",
-                    "document_url": self.client.files.get_signed_url(file_id=uploaded_pdf.id).url
-                }
-            )
+            while pending:
+                yield resolve(*pending.popleft())
             
-            # Combina il markdown di tutte le pagine con separatori
-            pages_text = []
-            for i, page in enumerate(ocr_response.pages):
-                page_content = page.markdown.strip()
-                if page_content:
-                    pages_text.append(f"--- PAGINA {i+1} ---\n{page_content}")
+            # Se il layer di testo non è leggibile non conosciamo le pagine: OCR completo
+            if not text_layer_pages:
+                ocr_requested = True
+                try:
+                    ocr_markdown = self._run_mistral_ocr(pdf_bytes, None)
+                    ocr_pages = [ocr_markdown.get(i) for i in range(max(ocr_markdown, default=-1) + 1)]
+                    text_layer_pages = [""] * len(ocr_pages)
+                    for index in range(len(ocr_pages)):
+                        yield self._merge_page(index, text_layer_pages, ocr_pages)
+                except Exception as e:
+                    st.error(f"Errore Mistral OCR: {e}")
+                    ocr_errors.append(e)
             
-            ocr_text = "\n\n".join(pages_text)
+            if not ocr_requested:
+                st.caption("⚡ Testo digitale leggibile su tutte le pagine: OCR non necessario")
+            else:
+                ocr_count = sum(1 for markdown in ocr_pages if markdown is not None)
+                st.caption(f"📷 OCR eseguito su {ocr_count} di {len(ocr_pages)} pagine")
             
-            # Se il testo OCR è molto breve, potrebbe essere un documento di identità
-            # In questo caso, proviamo a estrarre anche informazioni strutturate
-            if len(ocr_text.strip()) < 200 and isinstance(self, DocumentoRiconoscimentoProcessor):
-                ocr_text += self._extract_identity_document_patterns(ocr_text)
-                
+            sources["text_layer_pages"] = text_layer_pages
+            sources["ocr_pages"] = ocr_pages
+            if not ocr_errors:
+                ocr_cache.put(pdf_bytes, OCR_MODEL, text_layer_pages, ocr_pages, **cache_params)
+        finally:
+            # Il consumatore può fermarsi prima della fine: annulla le chiamate OCR non ancora partite
+            for ocr_future in ocr_futures:
+                ocr_future.cancel()
+            if upload_future is not None:
+                upload_future.add_done_callback(lambda future: self._release_upload(pdf_bytes, future))
+    
+    def _ocr_cache_params(self) -> Dict[str, Any]:
+        """Settings that decide which pages go to OCR: part of the OCR cache key"""
+        return {"text_backend": get_text_backend().name, "quality_keywords": self.get_quality_keywords()}
+    
+    def _upload_for_ocr(self, pdf_bytes: bytes) -> tuple[str, str]:
+        """Return (file_id, signed_url) from the upload session; every call must be paired with a release"""
+        return self.upload_session.acquire(pdf_bytes)
+    
+    def _release_upload(self, pdf_bytes: bytes, upload_future: Future):
+        """Release a speculative upload that turned out not to be needed"""
+        if not upload_future.cancelled() and upload_future.exception() is None:
+            self.upload_session.release(pdf_bytes)
+    
+    def _run_mistral_ocr(self, pdf_bytes: bytes, page_indexes: Optional[List[int]] = None,
+                         document_url: Optional[str] = None) -> Dict[int, str]:
+        """Run Mistral OCR on the given 0-based pages (all pages if None) and return {page_index: markdown}"""
+        if document_url is None:
+            _, document_url = self._upload_for_ocr(pdf_bytes)
+            try:
+                return self._run_mistral_ocr(pdf_bytes, page_indexes, document_url=document_url)
+            finally:
+                self.upload_session.release(pdf_bytes)
+        
+        ocr_params = {}
+        if page_indexes is not None:
+            ocr_params["pages"] = page_indexes
+        
+        # Use enhanced OCR settings for better text extraction
+        ocr_response = self._ocr_process(
+            model=OCR_MODEL,
+            document={
+                "type": "document_url",
+                "document_url": document_url
+            },
+            **ocr_params
+        )
+        
+        ocr_markdown = {}
+        for position, page in enumerate(ocr_response.pages):
+            index = getattr(page, "index", None)
+            if index is None:
+                index = page_indexes[position] if page_indexes is not None else position
+            ocr_markdown[index] = page.markdown
+        return ocr_markdown
+    
+    def _ocr_process(self, **params):
+        """client.ocr.process with the shared retry policy, circuit breaker and rate limit, in the calling thread"""
+        def make_api_call(timeout):
+            get_rate_limiter().acquire(priority=self.api_priority, timeout=timeout)
+            return self.client.ocr.process(**params, timeout_ms=int(timeout * 1000))
+        
+        return get_resilience().call(
+            make_api_call,
+            "ocr", OCR_TIMEOUT, min_timeout=OCR_TIMEOUT / 2, max_timeout=OCR_TIMEOUT * 2, via_scheduler=False
+        )
+    
+    @staticmethod
+    def _image_document(image_bytes: bytes, image_mime: str) -> Dict[str, str]:
+        """OCR document parameter for an image, sent inline as a data URL (no upload needed)"""
+        encoded = base64.b64encode(image_bytes).decode("ascii")
+        return {"type": "image_url", "image_url": f"data:{image_mime};base64,{encoded}"}
+    
+    def extract_pages_from_image(self, image_bytes: bytes, image_mime: str) -> List[Dict[str, Any]]:
+        """OCR a JPEG/PNG upload into a page list (a single page)"""
+        ocr_cache = get_ocr_cache()
+        cached = ocr_cache.get(image_bytes, OCR_MODEL)
+        if cached is not None:
+            st.caption("♻️ Risultato OCR recuperato dalla cache")
+            return self._merge_pages(cached.get("text_layer_pages", []), cached.get("ocr_pages", []))
+        
+        try:
+            ocr_response = self._ocr_process(
+                model=OCR_MODEL,
+                document=self._image_document(image_bytes, image_mime)
+            )
         except Exception as e:
             st.error(f"Errore Mistral OCR: {e}")
-            ocr_text = ""
+            return []
         
-        return pypdf2_text, ocr_text
+        ocr_pages = [page.markdown for page in ocr_response.pages]
+        text_layer_pages = [""] * len(ocr_pages)
+        ocr_cache.put(image_bytes, OCR_MODEL, text_layer_pages, ocr_pages)
+        return self._merge_pages(text_layer_pages, ocr_pages)
     
-    def extract_structured_info_with_ocr(self, pdf_bytes: bytes) -> Dict[str, Any]:
-        """Extract structured information directly using Mistral OCR Document Annotation"""
+    def _merge_page(self, index: int, text_layer_pages: List[str], ocr_pages: List[Optional[str]]) -> Dict[str, Any]:
+        """Pick the OCR markdown for a page when available, the text layer otherwise"""
+        ocr_markdown = ocr_pages[index] if index < len(ocr_pages) else None
+        if ocr_markdown is not None and ocr_markdown.strip():
+            return {"page_number": index + 1, "text": ocr_markdown, "source": "ocr"}
+        page_text = text_layer_pages[index] if index < len(text_layer_pages) else ""
+        return {"page_number": index + 1, "text": page_text, "source": "text_layer"}
+    
+    def _merge_pages(self, text_layer_pages: List[str], ocr_pages: List[Optional[str]]) -> List[Dict[str, Any]]:
+        """Merge text-layer and OCR pages into one ordered page list"""
+        return [self._merge_page(i, text_layer_pages, ocr_pages)
+                for i in range(max(len(text_layer_pages), len(ocr_pages)))]
+    
+    def pages_to_text(self, pages: List[Dict[str, Any]]) -> str:
+        """Combine a page list into the text used for extraction"""
+        # Combina il testo di tutte le pagine con separatori
+        pages_text = []
+        for page in pages:
+            page_content = (page.get("text") or "").strip()
+            if page_content:
+                pages_text.append(f"--- PAGINA {page['page_number']} ---\n{page_content}")
+        
+        document_text = "\n\n".join(pages_text)
+        
+        # Se il testo è molto breve, potrebbe essere un documento di identità
+        # In questo caso, proviamo a estrarre anche informazioni strutturate
+        if len(document_text.strip()) < 200 and isinstance(self, DocumentoRiconoscimentoProcessor):
+            document_text += self._extract_identity_document_patterns(document_text)
+        
+        return document_text
+    
+    def _get_annotation_model(self):
+        """Pydantic model describing the Document Annotation output for this document type"""
         from pydantic import BaseModel, Field
-        from mistralai.extra import response_format_from_pydantic_model
         
-        try:
-            # Upload del PDF
-            uploaded_pdf = self.client.files.upload(
-                file={
-                    "file_name": "document.pdf",
-                    "content": pdf_bytes
-                },
-                purpose="ocr"
-            )
+        # Definisci il modello Pydantic per l'estrazione strutturata
+        if isinstance(self, DocumentoRiconoscimentoProcessor):
+            class IdentityDocument(BaseModel):
+                nome: str = Field(default="", description="Nome della persona")
+                cognome: str = Field(default="", description="Cognome della persona")
+                data_nascita: str = Field(default="", description="Data di nascita")
+                luogo_nascita: str = Field(default="", description="Luogo di nascita")
+                codice_fiscale: str = Field(default="", description="Codice fiscale")
+                tipo_documento: str = Field(default="", description="Tipo di documento")
+                numero_documento: str = Field(default="", description="Numero del documento")
+                data_rilascio: str = Field(default="", description="Data di rilascio")
+                data_scadenza: str = Field(default="", description="Data di scadenza")
+                ente_rilascio: str = Field(default="", description="Ente di rilascio")
             
-            # Definisci il modello Pydantic per l'estrazione strutturata
-            if isinstance(self, DocumentoRiconoscimentoProcessor):
-                class IdentityDocument(BaseModel):
-                    nome: str = Field(default="", description="Nome della persona")
-                    cognome: str = Field(default="", description="Cognome della persona")
-                    data_nascita: str = Field(default="", description="Data di nascita")
-                    luogo_nascita: str = Field(default="", description="Luogo di nascita")
-                    codice_fiscale: str = Field(default="", description="Codice fiscale")
-                    tipo_documento: str = Field(default="", description="Tipo di documento")
-                    numero_documento: str = Field(default="", description="Numero del documento")
-                    data_rilascio: str = Field(default="", description="Data di rilascio")
-                    data_scadenza: str = Field(default="", description="Data di scadenza")
-                    ente_rilascio: str = Field(default="", description="Ente di rilascio")
-                
-                annotation_model = IdentityDocument
-            
-            elif isinstance(self, VisuraCameraleProcessor):
-                class VisuraCamerale(BaseModel):
-                    denominazione: str = Field(default="", description="Denominazione sociale")
-                    sede_legale: str = Field(default="", description="Sede legale")
-                    pec: str = Field(default="", description="Indirizzo PEC")
-                    codice_fiscale: str = Field(default="", description="Codice fiscale")
-                    forma_giuridica: str = Field(default="", description="Forma giuridica")
-                    rappresentante: str = Field(default="", description="Rappresentante legale")
-                    capitale_sociale: str = Field(default="", description="Capitale sociale")
-                
-                annotation_model = VisuraCamerale
+            return IdentityDocument
+        
+        elif isinstance(self, VisuraCameraleProcessor):
+            class VisuraCamerale(BaseModel):
+                denominazione: str = Field(default="", description="Denominazione sociale")
+                sede_legale: str = Field(default="", description="Sede legale")
+                pec: str = Field(default="", description="Indirizzo PEC")
+                codice_fiscale: str = Field(default="", description="Codice fiscale")
+                forma_giuridica: str = Field(default="", description="Forma giuridica")
+                rappresentante: str = Field(default="", description="Rappresentante legale")
+                capitale_sociale: str = Field(default="", description="Capitale sociale")
             
-            else:
-                # Modello generico per altri tipi di documento
-                class GenericDocument(BaseModel):
-                    content: str = Field(default="", description="Contenuto principale del documento")
-                    key_information: str = Field(default="", description="Informazioni chiave estratte")
-                
-                annotation_model = GenericDocument
+            return VisuraCamerale
+        
+        else:
+            # Modello generico per altri tipi di documento
+            class GenericDocument(BaseModel):
+                content: str = Field(default="", description="Contenuto principale del documento")
+                key_information: str = Field(default="", description="Informazioni chiave estratte")
             
+            return GenericDocument
+    
+    def _request_document_annotation(self, pdf_bytes: bytes, image_mime: Optional[str] = None):
+        """Run Document Annotation on the shared upload (inline for images); no UI calls, safe in worker threads"""
+        from mistralai.extra import response_format_from_pydantic_model
+        
+        annotation_format = response_format_from_pydantic_model(self._get_annotation_model())
+        if image_mime is not None:
+            ocr_response = self._ocr_process(
+                model=OCR_MODEL,
+                document=self._image_document(pdf_bytes, image_mime),
+                document_annotation_format=annotation_format
+            )
+        else:
+            _, document_url = self._upload_for_ocr(pdf_bytes)
+            try:
+                ocr_response = self._ocr_process(
+                    model=OCR_MODEL,
+                    document={
+                        "type": "document_url",
+                        "document_url": document_url
+                    },
+                    document_annotation_format=annotation_format
+                )
+            finally:
+                self.upload_session.release(pdf_bytes)
+        
+        if hasattr(ocr_response, 'document_annotation') and ocr_response.document_annotation:
+            return ocr_response.document_annotation
+        return None
+    
+    def start_structured_extraction(self, pdf_bytes: bytes, image_mime: Optional[str] = None) -> Future:
+        """Start Document Annotation in the background so it overlaps text extraction"""
+        return _get_io_executor().submit(self._request_document_annotation, pdf_bytes, image_mime)
+    
+    @staticmethod
+    def _merge_structured_info(default_info: Dict[str, Any], structured_info: Any) -> int:
+        """Copy Document Annotation fields into default_info; returns the number of non-empty fields"""
+        # Converti il risultato strutturato in dizionario (l'API restituisce una stringa JSON)
+        if isinstance(structured_info, str):
+            extracted_dict = parse_json_object(structured_info) or {}
+        elif isinstance(structured_info, dict):
+            extracted_dict = structured_info
+        elif hasattr(structured_info, '__dict__'):
+            extracted_dict = structured_info.__dict__
+        else:
+            extracted_dict = {}
+        if not isinstance(extracted_dict, dict):
+            extracted_dict = {}
+        
+        for key, value in extracted_dict.items():
+            if key in default_info and value and str(value).strip():
+                default_info[key] = str(value).strip()
+        
+        return sum(1 for v in default_info.values() if v and str(v).strip())
+    
+    def extract_structured_info_with_ocr(self, pdf_bytes: bytes, annotation_future: Optional[Future] = None) -> Dict[str, Any]:
+        """Extract structured information directly using Mistral OCR Document Annotation"""
+        try:
             # Usa Document Annotation per estrarre informazioni strutturate
             st.info("🔍 Estrazione strutturata con Mistral OCR Document Annotation...")
             
-            ocr_response = self.client.ocr.process(
-                model="mistral-ocr-latest",
-                document={
-                    "type": "document_url",
-                    "document_url": self.client.files.get_signed_url(file_id=uploaded_pdf.id).url
-                },
-                document_annotation_format=response_format_from_pydantic_model(annotation_model)
-            )
+            # Se la richiesta è già partita in parallelo all'estrazione del testo, attendi solo il risultato
+            if annotation_future is not None:
+                structured_info = annotation_future.result()
+            else:
+                structured_info = self._request_document_annotation(pdf_bytes)
             
             # Estrai le informazioni strutturate dalla risposta
-            if hasattr(ocr_response, 'document_annotation') and ocr_response.document_annotation:
-                structured_info = ocr_response.document_annotation
+            if structured_info:
                 st.success("✅ Estrazione strutturata completata con successo!")
                 return structured_info
             else:
@@ -158,149 +496,514 @@ class DocumentProcessor(ABC):
             st.info("🔄 Fallback al metodo di estrazione tradizionale...")
             return None
     
-    def extract_information(self, text: str, pdf_bytes: bytes = None) -> Dict[str, Any]:
+    def extract_information(self, text: str, pdf_bytes: bytes = None, annotation_future: Optional[Future] = None) -> Dict[str, Any]:
         """Extract information using Mistral OCR Document Annotation first, then fallback to chat completion"""
-        import time
-        from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
-        
         default_info = self.get_default_structure()
         
-        # Prima prova con Document Annotation se abbiamo i bytes del PDF
-        if pdf_bytes is not None:
+        # Campi a formato rigido (codici, PEC, importi) estratti con regole: prevalgono su quelli del modello
+        rule_matches = self.extract_rule_based_fields(text)
+        rule_fields = confident_fields(rule_matches)
+        
+        # Prima prova con Document Annotation se abbiamo i bytes del PDF (o una richiesta già avviata)
+        if pdf_bytes is not None or annotation_future is not None:
             st.info("🚀 Tentativo di estrazione strutturata con Mistral OCR...")
-            structured_info = self.extract_structured_info_with_ocr(pdf_bytes)
+            structured_info = self.extract_structured_info_with_ocr(pdf_bytes, annotation_future=annotation_future)
             
             if structured_info:
-                # Converti il risultato strutturato in dizionario
-                if hasattr(structured_info, '__dict__'):
-                    extracted_dict = structured_info.__dict__
-                elif isinstance(structured_info, dict):
-                    extracted_dict = structured_info
-                else:
-                    extracted_dict = {}
-                
                 # Aggiorna le informazioni di default con quelle estratte
-                for key, value in extracted_dict.items():
-                    if key in default_info and value and str(value).strip():
-                        default_info[key] = str(value).strip()
+                non_empty_fields = self._merge_structured_info(default_info, structured_info)
                 
                 # Verifica se abbiamo estratto informazioni significative
-                non_empty_fields = sum(1 for v in default_info.values() if v and str(v).strip())
                 if non_empty_fields >= 3:  # Se abbiamo almeno 3 campi compilati
                     st.success(f"✅ Estrazione strutturata completata! {non_empty_fields} campi estratti.")
+                    default_info.update(rule_fields)
                     return default_info
                 else:
                     st.warning("⚠️ Estrazione strutturata parziale, provo con il metodo tradizionale...")
         
+        # Al modello vengono chiesti solo i campi che le regole non hanno compilato
+        fields = self._missing_fields(default_info, rule_fields)
+        if rule_matches:
+            st.info("🧮 Campi estratti con regole: " + ", ".join(
+                f"{field} ({rule_matches[field].confidence:.0%})" for field in rule_fields))
+            uncertain = [field for field in rule_matches if field not in rule_fields]
+            if uncertain:
+                st.caption(f"Valori incerti, verificati dall'AI: {', '.join(uncertain)}")
+            default_info.update(rule_fields)
+            if fields is not None and not fields:
+                st.success("✅ Tutti i campi estratti senza chiamate AI")
+                return default_info
+        
+        # Documento lungo: estrazione a blocchi invece di un unico prompt
+        if self._needs_chunking(text):
+            return self._extract_information_chunked(text, default_info, fields)
+        
         # Fallback al metodo tradizionale con chat completion
         st.info("🔄 Estrazione con chat completion...")
-        prompt = self.get_extraction_prompt(text)
+        prompt = self._prompt_for(text, fields)
         
-        messages = [{"role": "user", "content": prompt}]
+        def make_api_call(timeout):
+            return self._chat_complete(prompt, fields, timeout)
         
-        def make_api_call():
-            return self.client.chat.complete(
-                model="mistral-small-latest",
-                messages=messages,
-                temperature=0
+        # Retry, timeout adattivi e circuit breaker comuni a tutte le chiamate; il budget del documento
+        # limita il tempo totale, pause comprese
+        extracted_info = self._chat_with_retry(make_api_call, CallBudget(EXTRACTION_BUDGET), CHAT_TIMEOUT)
+        if extracted_info is not None:
+            default_info.update({key: value for key, value in extracted_info.items() if key not in rule_fields})
+        return default_info
+    
+    def _route_for(self, prompt: str, fields: Optional[List[str]] = None):
+        """Model and max_tokens for extracting fields (all when None) with prompt"""
+        field_count = len(fields) if fields is not None else len(self.get_default_structure())
+        return get_model_router().choose(self.get_document_type_name(), estimate_tokens(prompt), field_count)
+    
+    def _chat_complete(self, prompt: str, fields: Optional[List[str]], timeout: Optional[float],
+                       temperature: float = 0):
+        """Cached extraction call on the routed model; records the route's telemetry (no UI calls)"""
+        router = get_model_router()
+        route = self._route_for(prompt, fields)
+        start = time.monotonic()
+        try:
+            chat_response = cached_chat_complete(
+                self.client,
+                model=route.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                response_format=self.get_response_format(fields),
+                max_tokens=route.max_tokens,
+                bypass=self.bypass_llm_cache,
+                priority=self.api_priority,
+                validate=contains_json_object,
+                timeout_ms=int(timeout * 1000) if timeout else None
+            )
+        except RateLimitTimeout:
+            # Attesa nella coda del rate limiter: non dice nulla sul modello
+            raise
+        except Exception:
+            router.record_failure(self.get_document_type_name(), route, time.monotonic() - start)
+            raise
+        router.record(self.get_document_type_name(), route, time.monotonic() - start, chat_response,
+                      self._parse_json_response(chat_response) is not None)
+        return chat_response
+    
+    async def _chat_complete_async(self, prompt: str, fields: Optional[List[str]], timeout: Optional[float],
+                                   temperature: float = 0):
+        """Async counterpart of _chat_complete"""
+        router = get_model_router()
+        route = self._route_for(prompt, fields)
+        start = time.monotonic()
+        try:
+            chat_response = await cached_chat_complete_async(
+                self.client,
+                model=route.model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                response_format=self.get_response_format(fields),
+                max_tokens=route.max_tokens,
+                bypass=self.bypass_llm_cache,
+                priority=self.api_priority,
+                validate=contains_json_object,
+                timeout_ms=int(timeout * 1000) if timeout else None
             )
+        except (RateLimitTimeout, asyncio.CancelledError):
+            raise
+        except Exception:
+            router.record_failure(self.get_document_type_name(), route, time.monotonic() - start)
+            raise
+        router.record(self.get_document_type_name(), route, time.monotonic() - start, chat_response,
+                      self._parse_json_response(chat_response) is not None)
+        return chat_response
+    
+    def _chat_with_retry(self, make_api_call: Callable[[float], Any], budget: CallBudget,
+                         default_timeout: float) -> Optional[Dict[str, Any]]:
+        """Run make_api_call(timeout) through the shared resilience layer; returns the parsed JSON or None"""
+        resilience = get_resilience()
+        st.info(f"⏳ Timeout impostato: {resilience.timeout_for('chat', default_timeout):.0f} secondi")
         
-        # Meccanismo di retry con timeout ridotti per evitare blocchi
-        max_retries = 2  # Ridotto a 2 tentativi
-        timeouts = [10, 20]  # Timeout molto più bassi
+        def on_retry(attempt, error, delay):
+            if error is None:
+                reason = "risposta senza JSON valido"
+            elif isinstance(error, DeadlineExceeded):
+                reason = "timeout"
+            else:
+                reason = str(error)
+            st.warning(f"🔄 Tentativo {attempt} fallito ({reason}): nuovo tentativo tra {delay:.1f}s")
         
-        for attempt in range(max_retries):
-            try:
-                if attempt > 0:
-                    st.info(f"🔄 Tentativo {attempt + 1} di {max_retries}...")
-                
-                current_timeout = timeouts[attempt]
-                st.info(f"⏳ Timeout impostato: {current_timeout} secondi")
-                
-                # Usa ThreadPoolExecutor con timeout progressivo
-                with ThreadPoolExecutor() as executor:
-                    future = executor.submit(make_api_call)
-                    start_time = time.time()
-                    
-                    try:
-                        chat_response = future.result(timeout=current_timeout)
-                        elapsed_time = time.time() - start_time
-                        st.success(f"✅ Estrazione completata in {elapsed_time:.1f} secondi")
-                        
-                        response_text = chat_response.choices[0].message.content
-                        json_start = response_text.find('{')
-                        json_end = response_text.rfind('}')
-                        
-                        if json_start != -1 and json_end != -1:
-                            json_string = response_text[json_start:json_end + 1]
-                            extracted_info = json.loads(json_string)
-                            default_info.update(extracted_info)
-                            return default_info  # Successo, esci dal loop
-                        else:
-                            st.error("Impossibile trovare un blocco JSON valido nella risposta dell'API.")
-                            if attempt == max_retries - 1:
-                                break
-                                
-                    except FutureTimeoutError:
-                        elapsed = time.time() - start_time
-                        error_msg = f"⏰ Timeout al tentativo {attempt + 1}: L'API non risponde entro {current_timeout}s (elapsed: {elapsed:.1f}s)"
-                        if attempt == max_retries - 1:
-                            st.error(f"{error_msg}\n\n💡 **Possibili soluzioni:**\n- Verifica la connessione internet\n- Riprova tra qualche minuto\n- Il testo potrebbe essere troppo complesso")
-                        else:
-                            st.warning(error_msg)
-                            time.sleep(3)  # Pausa più lunga prima del retry
-                    
-            except json.JSONDecodeError as e:
-                     error_msg = f"Errore JSON al tentativo {attempt + 1}: {e}"
-                     if attempt == max_retries - 1:
-                         st.error(f"{error_msg} Impossibile decodificare la risposta.")
-                     else:
-                         st.warning(error_msg)
-                         time.sleep(1)  # Pausa ridotta
-                         
-            except Exception as e:
-                error_msg = f"Errore al tentativo {attempt + 1}: {e}"
-                if attempt == max_retries - 1:
-                    st.error(f"{error_msg}\n\n🔧 **Debug:** {type(e).__name__}, {len(text)} caratteri")
+        start_time = time.time()
+        try:
+            chat_response = resilience.call(
+                make_api_call, "chat", default_timeout, budget=budget,
+                accept=lambda response: self._parse_json_response(response) is not None,
+                on_retry=on_retry
+            )
+        except CircuitOpen as e:
+            st.error(f"🚧 {e}")
+            return None
+        except BudgetExhausted:
+            st.error("⏰ Tempo massimo per il documento esaurito: estrazione interrotta")
+            return None
+        except RateLimitTimeout:
+            st.error("🚦 Troppe richieste in corso verso l'API: riprova tra qualche istante")
+            return None
+        except DeadlineExceeded:
+            st.error(f"⏰ Timeout: l'API non risponde (elapsed: {time.time() - start_time:.1f}s)\n\n"
+                     "💡 **Possibili soluzioni:**\n- Verifica la connessione internet\n- Riprova tra qualche minuto\n"
+                     "- Il testo potrebbe essere troppo complesso")
+            return None
+        except Exception as e:
+            st.error(f"Errore nell'estrazione: {e}\n\n🔧 **Debug:** {type(e).__name__}")
+            return None
+        
+        extracted_info = self._parse_json_response(chat_response)
+        if extracted_info is None:
+            st.error("Impossibile trovare un blocco JSON valido nella risposta dell'API.")
+        else:
+            st.success(f"✅ Estrazione completata in {time.time() - start_time:.1f} secondi")
+        return extracted_info
+
+    
+    # --- Estrazione a blocchi -----------------------------------------------
+    
+    def _needs_chunking(self, text: str) -> bool:
+        return self.chunked_extraction and estimate_tokens(text) > self.chunk_token_budget
+    
+    @staticmethod
+    def _parse_json_response(chat_response) -> Optional[Dict[str, Any]]:
+        """JSON object contained in a chat response, or None"""
+        # Parser tollerante: anche una risposta troncata restituisce i campi completi
+        return parse_json_object(chat_response.choices[0].message.content or "")
+    
+    def _extract_chunk(self, chunk: str, fields: Optional[List[str]], timeout: float) -> Optional[Dict[str, Any]]:
+        """Extraction call for one chunk; no UI calls, runs on the scheduler's workers"""
+        chat_response = self._chat_complete(self._prompt_for(chunk, fields), fields, timeout)
+        return self._parse_json_response(chat_response)
+    
+    def _merge_chunk_results(self, default_info: Dict[str, Any], results: List[Any]) -> Dict[str, Any]:
+        """Merge the partial results (earlier structured fields first) and report what went wrong"""
+        partials = [default_info] + [result for result in results if isinstance(result, dict)]
+        failed = sum(1 for result in results if not isinstance(result, dict))
+        merged, conflicts = merge_partial_results(self.get_default_structure(), partials, self.chunk_merge_rules)
+        
+        if failed:
+            st.warning(f"⚠️ {failed} blocchi su {len(results)} non estratti: il risultato può essere incompleto")
+        if conflicts:
+            st.warning(f"⚠️ Valori diversi tra le sezioni del documento per: {', '.join(conflicts)}")
+        return merged
+    
+    def _extract_information_chunked(self, text: str, default_info: Dict[str, Any],
+                                     fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Map-reduce extraction: chunks are extracted in parallel, so latency follows the longest chunk"""
+        chunks = split_into_chunks(text, self.chunk_token_budget)
+        st.info(f"🧩 Documento lungo ({estimate_tokens(text)} token stimati): estrazione in {len(chunks)} blocchi paralleli...")
+        
+        start_time = time.time()
+        try:
+            # I blocchi falliti per errori temporanei vengono riprovati insieme, dopo il backoff
+            results = get_resilience().call_all(
+                self._extract_chunk, "chat",
+                [(chunk, fields) for chunk in chunks],
+                CHUNK_TIMEOUT,
+                budget=CallBudget(EXTRACTION_BUDGET)
+            )
+        except CircuitOpen as e:
+            st.error(f"🚧 {e}")
+            return default_info
+        except BudgetExhausted:
+            st.error("⏰ Tempo massimo per il documento esaurito: estrazione interrotta")
+            return default_info
+        
+        extracted = sum(1 for result in results if isinstance(result, dict))
+        st.success(f"✅ {extracted} blocchi su {len(chunks)} estratti in {time.time() - start_time:.1f} secondi")
+        return self._merge_chunk_results(default_info, results)
+    
+    # --- Pipeline asincrona -------------------------------------------------
+    # Stesse fasi della pipeline sincrona, senza chiamate Streamlit: un solo event loop
+    # può elaborare molti documenti insieme e i timeout annullano davvero le richieste.
+    
+    async def _upload_for_ocr_async(self, pdf_bytes: bytes) -> tuple[str, str]:
+        """Async counterpart of _upload_for_ocr: same upload session, so every call must be paired with a release"""
+        upload_future = _get_io_executor().submit(self._upload_for_ocr, pdf_bytes)
+        try:
+            return await asyncio.wrap_future(upload_future)
+        except asyncio.CancelledError:
+            # Un upload già partito termina nel suo thread (il file remoto esiste comunque):
+            # il riferimento viene rilasciato alla fine, e con l'ultimo il file viene cancellato
+            upload_future.add_done_callback(lambda future: self._release_upload(pdf_bytes, future))
+            raise
+    
+    @asynccontextmanager
+    async def _document_url_async(self, pdf_bytes: bytes, upload: Optional[Awaitable] = None) -> AsyncIterator[str]:
+        """Yield a signed URL, reusing a shared upload when given (its owner releases it), acquiring one otherwise"""
+        if upload is not None:
+            # shield: annullare un utilizzatore non deve annullare l'upload condiviso
+            _, document_url = await asyncio.shield(upload)
+            yield document_url
+            return
+        
+        _, document_url = await self._upload_for_ocr_async(pdf_bytes)
+        try:
+            yield document_url
+        finally:
+            self.upload_session.release(pdf_bytes)
+    
+    async def _ocr_process_async(self, **params):
+        """client.ocr.process_async with the shared retry policy and rate limit; the timeout cancels the request"""
+        async def make_api_call(timeout):
+            await get_rate_limiter().acquire_async(priority=self.api_priority, timeout=timeout)
+            return await self.client.ocr.process_async(**params, timeout_ms=int(timeout * 1000))
+        
+        return await get_resilience().call_async(
+            make_api_call,
+            "ocr", OCR_TIMEOUT, min_timeout=OCR_TIMEOUT / 2, max_timeout=OCR_TIMEOUT * 2
+        )
+    
+    async def _run_mistral_ocr_async(self, document_url: str, page_indexes: Optional[List[int]] = None) -> Dict[int, str]:
+        """Async Mistral OCR on the given 0-based pages (all pages if None); returns {page_index: markdown}"""
+        ocr_params = {}
+        if page_indexes is not None:
+            ocr_params["pages"] = page_indexes
+        
+        ocr_response = await self._ocr_process_async(
+            model=OCR_MODEL,
+            document={
+                "type": "document_url",
+                "document_url": document_url
+            },
+            **ocr_params
+        )
+        
+        ocr_markdown = {}
+        for position, page in enumerate(ocr_response.pages):
+            index = getattr(page, "index", None)
+            if index is None:
+                index = page_indexes[position] if page_indexes is not None else position
+            ocr_markdown[index] = page.markdown
+        return ocr_markdown
+    
+    async def _extract_pdf_page_sources_async(self, pdf_bytes: bytes,
+                                              upload: Optional[Awaitable] = None) -> tuple[List[str], List[Optional[str]]]:
+        """Async counterpart of _extract_pdf_page_sources; the text layer is parsed in a worker thread"""
+        ocr_cache = get_ocr_cache()
+        cache_params = self._ocr_cache_params()
+        cached = ocr_cache.get(pdf_bytes, OCR_MODEL, **cache_params)
+        if cached is not None:
+            return cached.get("text_layer_pages", []), cached.get("ocr_pages", [])
+        
+        try:
+            text_layer_pages = await asyncio.to_thread(get_text_backend().extract_pages, pdf_bytes)
+        except Exception:
+            text_layer_pages = []
+        
+        keywords = self.get_quality_keywords()
+        ocr_indexes = [i for i, page_text in enumerate(text_layer_pages)
+                       if score_page_text(page_text, keywords)["needs_ocr"]]
+        ocr_pages: List[Optional[str]] = [None] * len(text_layer_pages)
+        if text_layer_pages and not ocr_indexes:
+            ocr_cache.put(pdf_bytes, OCR_MODEL, text_layer_pages, ocr_pages, **cache_params)
+            return text_layer_pages, ocr_pages
+        
+        try:
+            async with self._document_url_async(pdf_bytes, upload) as document_url:
+                if text_layer_pages:
+                    ocr_markdown = await self._run_mistral_ocr_async(document_url, ocr_indexes)
                 else:
-                    st.warning(error_msg)
-                    time.sleep(1)  # Pausa ridotta
+                    # Layer di testo illeggibile: OCR completo
+                    ocr_markdown = await self._run_mistral_ocr_async(document_url, None)
+                    text_layer_pages = [""] * (max(ocr_markdown, default=-1) + 1)
+                    ocr_pages = [None] * len(text_layer_pages)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Senza OCR restano le pagine del layer di testo; il risultato parziale non va in cache
+            return text_layer_pages, ocr_pages
+        
+        for index, markdown in ocr_markdown.items():
+            if index < len(ocr_pages):
+                ocr_pages[index] = markdown
+        ocr_cache.put(pdf_bytes, OCR_MODEL, text_layer_pages, ocr_pages, **cache_params)
+        return text_layer_pages, ocr_pages
+    
+    async def extract_text_from_pdf_async(self, pdf_bytes: bytes) -> tuple[str, str]:
+        """Async counterpart of extract_text_from_pdf: (PyPDF2 text, merged text)"""
+        text_layer_pages, ocr_pages = await self._extract_pdf_page_sources_async(pdf_bytes)
+        pypdf2_text = "".join(page_text + "\n" for page_text in text_layer_pages if page_text)
+        merged_text = self.pages_to_text(self._merge_pages(text_layer_pages, ocr_pages))
+        return pypdf2_text, merged_text
+    
+    async def _request_document_annotation_async(self, pdf_bytes: bytes, upload: Optional[Awaitable] = None):
+        """Async Document Annotation; returns the raw annotation or None"""
+        from mistralai.extra import response_format_from_pydantic_model
         
+        async with self._document_url_async(pdf_bytes, upload) as document_url:
+            ocr_response = await self._ocr_process_async(
+                model=OCR_MODEL,
+                document={
+                    "type": "document_url",
+                    "document_url": document_url
+                },
+                document_annotation_format=response_format_from_pydantic_model(self._get_annotation_model())
+            )
+        return getattr(ocr_response, "document_annotation", None) or None
+    
+    async def extract_information_async(self, text: str, pdf_bytes: bytes = None,
+                                        annotation: Optional[Awaitable] = None) -> Dict[str, Any]:
+        """Async counterpart of extract_information: Document Annotation first, then chat completion.
+
+        annotation may be an already started Document Annotation task; otherwise it is
+        requested here when pdf_bytes is given.
+        """
+        default_info = self.get_default_structure()
+        rule_fields = confident_fields(self.extract_rule_based_fields(text))
+        
+        if annotation is None and pdf_bytes is not None:
+            annotation = self._request_document_annotation_async(pdf_bytes)
+        if annotation is not None:
+            try:
+                structured_info = await annotation
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                structured_info = None
+            if structured_info and self._merge_structured_info(default_info, structured_info) >= 3:
+                default_info.update(rule_fields)
+                return default_info
+        
+        fields = self._missing_fields(default_info, rule_fields)
+        default_info.update(rule_fields)
+        if fields is not None and not fields:
+            return default_info
+        
+        if self._needs_chunking(text):
+            results = await asyncio.gather(
+                *(self._extract_chunk_async(chunk, fields) for chunk in split_into_chunks(text, self.chunk_token_budget)),
+                return_exceptions=True
+            )
+            partials = [default_info] + [result for result in results if isinstance(result, dict)]
+            merged, _ = merge_partial_results(self.get_default_structure(), partials, self.chunk_merge_rules)
+            return merged
+        
+        prompt = self._prompt_for(text, fields)
+        try:
+            chat_response = await get_resilience().call_async(
+                lambda timeout: self._chat_complete_async(prompt, fields, timeout),
+                "chat", CHAT_TIMEOUT,
+                accept=lambda response: self._parse_json_response(response) is not None
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return default_info
+        
+        extracted_info = self._parse_json_response(chat_response)
+        if extracted_info is not None:
+            default_info.update({key: value for key, value in extracted_info.items() if key not in rule_fields})
         return default_info
+    
+    async def _extract_chunk_async(self, chunk: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """Async extraction call for one chunk"""
+        prompt = self._prompt_for(chunk, fields)
+        chat_response = await get_resilience().call_async(
+            lambda timeout: self._chat_complete_async(prompt, fields, timeout),
+            "chat", CHUNK_TIMEOUT
+        )
+        return self._parse_json_response(chat_response)
+    
+    async def process_pdf_async(self, pdf_bytes: bytes) -> tuple[str, Dict[str, Any]]:
+        """Full async pipeline for one PDF: returns (document_text, extracted_info).
 
+        One upload from the shared upload session serves OCR and Document Annotation,
+        which run concurrently with text-layer parsing; it is released at the end.
+        """
+        upload = asyncio.ensure_future(self._upload_for_ocr_async(pdf_bytes))
+        annotation = asyncio.ensure_future(self._request_document_annotation_async(pdf_bytes, upload))
+        try:
+            text_layer_pages, ocr_pages = await self._extract_pdf_page_sources_async(pdf_bytes, upload)
+            pages = self._merge_pages(text_layer_pages, ocr_pages)
+            if self.max_text_chars is not None:
+                pages = take_pages(pages, self.max_text_chars)
+            document_text = self.pages_to_text(pages)
+            extracted_info = await self.extract_information_async(document_text, annotation=annotation)
+            return document_text, extracted_info
+        finally:
+            annotation.cancel()
+            if not upload.done():
+                # _upload_for_ocr_async rilascia il riferimento quando l'upload in corso termina
+                upload.cancel()
+            elif not upload.cancelled() and upload.exception() is None:
+                self.upload_session.release(pdf_bytes)
+    
+    def process_pdf(self, pdf_bytes: bytes, timeout: Optional[float] = None) -> tuple[str, Dict[str, Any]]:
+        """Sync facade over process_pdf_async, running on the shared event loop"""
+        return run_sync(self.process_pdf_async(pdf_bytes), timeout)
 
 class VisuraCameraleProcessor(DocumentProcessor):
     """Processor for Visura Camerale documents"""
     
+    # Codici, REA, PEC e capitale estratti con regole prima del modello (VISURA_RULES=0 per disattivare)
+    rule_extraction = os.environ.get("VISURA_RULES", "1") != "0"
+    
+    # Righe del prompt per campo: il prompt ridotto elenca solo i campi mancanti
+    field_descriptions = {
+        "denominazione": "denominazione (nome completo dell'azienda)",
+        "sede_legale": "sede_legale (indirizzo completo)",
+        "pec": "pec (indirizzo PEC)",
+        "codice_fiscale": "codice_fiscale",
+        "partita_iva": "partita_iva",
+        "numero_rea": "numero_rea (es: MI-1234567)",
+        "forma_giuridica": "forma_giuridica",
+        "rappresentante": "rappresentante (nome del rappresentante legale)",
+        "capitale_sociale": "capitale_sociale (se presente)",
+        "capitale_deliberato": "capitale_deliberato (importo in euro, se presente)",
+        "capitale_sottoscritto": "capitale_sottoscritto (importo in euro, se presente)",
+        "capitale_versato": "capitale_versato (importo in euro, se presente)",
+        "soci": "soci: lista di oggetti con chiavi 'nome', 'quota_percentuale', 'quota_euro' (es: [{\"nome\": \"Mario Rossi\", \"quota_percentuale\": \"50%\", \"quota_euro\": \"5000\"}, ...])",
+        "amministratori": "amministratori: lista di oggetti con chiavi 'nome', 'carica' (es: [{\"nome\": \"Mario Rossi\", \"carica\": \"Amministratore Unico\"}, ...])",
+        "sindaci": "sindaci: lista di oggetti con chiavi 'nome', 'carica' (es: [{\"nome\": \"Luca Bianchi\", \"carica\": \"Presidente Collegio Sindacale\"}, ...])",
+    }
+    
+    list_item_fields = {
+        "soci": ["nome", "quota_percentuale", "quota_euro"],
+        "amministratori": ["nome", "carica"],
+        "sindaci": ["nome", "carica"],
+    }
+    
     def get_document_type_name(self) -> str:
         return "Visura Camerale"
     
+    def get_quality_keywords(self) -> List[str]:
+        return ["camera di commercio", "registro imprese", "rea", "codice fiscale", "sede legale", "capitale sociale", "pec"]
+    
     def get_default_structure(self) -> Dict[str, Any]:
         return {
             "denominazione": "",
             "sede_legale": "",
             "pec": "",
             "codice_fiscale": "",
+            "partita_iva": "",
+            "numero_rea": "",
             "forma_giuridica": "",
             "rappresentante": "",
             "capitale_sociale": "",
+            "capitale_deliberato": "",
+            "capitale_sottoscritto": "",
+            "capitale_versato": "",
             "soci": [],
             "amministratori": [],
             "sindaci": [],
         }
     
+    def extract_rule_based_fields(self, text: str) -> Dict[str, FieldMatch]:
+        """Codice fiscale, partita IVA, REA, PEC and capitale matched by the visura rules"""
+        return extract_visura_fields(text) if self.rule_extraction else {}
+    
     def get_extraction_prompt(self, text: str) -> str:
+        return self.get_fields_extraction_prompt(text, list(self.field_descriptions))
+    
+    def get_fields_extraction_prompt(self, text: str, fields: List[str]) -> str:
+        field_lines = "\n        ".join(f"- {self.field_descriptions[field]}" for field in fields
+                                       if field in self.field_descriptions)
         return f"""Estrai le seguenti informazioni dalla visura camerale, rispondendo SOLO con un dizionario JSON:
-        - denominazione (nome completo dell'azienda)
-        - sede_legale (indirizzo completo)
-        - pec (indirizzo PEC)
-        - codice_fiscale
-        - forma_giuridica
-        - rappresentante (nome del rappresentante legale)
-        - capitale_sociale (se presente)
-        - soci: lista di oggetti con chiavi 'nome', 'quota_percentuale', 'quota_euro' (es: [{{"nome": "Mario Rossi", "quota_percentuale": "50%", "quota_euro": "5000"}}, ...])
-        - amministratori: lista di oggetti con chiavi 'nome', 'carica' (es: [{{"nome": "Mario Rossi", "carica": "Amministratore Unico"}}, ...])
-        - sindaci: lista di oggetti con chiavi 'nome', 'carica' (es: [{{"nome": "Luca Bianchi", "carica": "Presidente Collegio Sindacale"}}, ...])
+        {field_lines}
 
         Testo della visura:
         {text}
@@ -314,6 +1017,9 @@ class BilancioProcessor(DocumentProcessor):
     def get_document_type_name(self) -> str:
         return "Bilancio"
     
+    def get_quality_keywords(self) -> List[str]:
+        return ["stato patrimoniale", "conto economico", "totale", "esercizio", "patrimonio netto", "ricavi", "debiti"]
+    
     def get_default_structure(self) -> Dict[str, Any]:
         return {
             "denominazione": "",
@@ -357,6 +1063,17 @@ class StatutoProcessor(DocumentProcessor):
     def get_document_type_name(self) -> str:
         return "Statuto"
     
+    # Le descrizioni complete stanno nell'articolo dedicato, i riassunti altrove sono più brevi
+    chunk_merge_rules = {
+        "oggetto_sociale": MERGE_LONGEST,
+        "assemblea_convocazione": MERGE_LONGEST,
+        "quorum_assemblea": MERGE_LONGEST,
+        "quorum_amministratori": MERGE_LONGEST,
+    }
+    
+    def get_quality_keywords(self) -> List[str]:
+        return ["articolo", "art.", "società", "assemblea", "capitale sociale", "amministrazione", "soci"]
+    
     def get_default_structure(self) -> Dict[str, Any]:
         return {
             "denominazione": "",
@@ -403,9 +1120,35 @@ class StatutoProcessor(DocumentProcessor):
 class DocumentoRiconoscimentoProcessor(DocumentProcessor):
     """Processor for Documento di Riconoscimento (Identity Documents)"""
     
+    # Scala di grigi, deskew, DPI e ricompressione prima dell'OCR (ID_IMAGE_PREPROCESSING=0 per disattivare)
+    preprocess_images = os.environ.get("ID_IMAGE_PREPROCESSING", "1") != "0"
+    
+    # Strategie di estrazione in parallelo: vince il primo risultato valido (ID_HEDGED_EXTRACTION=0 per la sequenza classica)
+    hedged_extraction = os.environ.get("ID_HEDGED_EXTRACTION", "1") != "0"
+    # Ritardo prima di avviare la strategia di riserva, se nel frattempo nessun risultato è valido
+    hedge_stagger_seconds = float(os.environ.get("ID_HEDGE_STAGGER", "1.5"))
+    # Un risultato è valido con codice fiscale corretto e almeno questo numero di campi compilati
+    hedge_min_fields = int(os.environ.get("ID_HEDGE_MIN_FIELDS", "4"))
+    
     def get_document_type_name(self) -> str:
         return "Documento di Riconoscimento"
     
+    def preprocess_input(self, file_bytes: bytes, file_name: str) -> tuple[bytes, Optional[str]]:
+        """Shrink scanned identity documents (images or scan-wrapping PDFs) before upload"""
+        if not self.preprocess_images:
+            return super().preprocess_input(file_bytes, file_name)
+        
+        processed_bytes, image_mime, report = preprocess_identity_document(file_bytes, file_name)
+        if report["applied"]:
+            st.caption(
+                f"🗜️ Scansione ottimizzata: {report['original_bytes'] / 1024:.0f} KB → "
+                f"{report['processed_bytes'] / 1024:.0f} KB (-{report['saved_pct']}%)"
+            )
+        return processed_bytes, image_mime
+    
+    def get_quality_keywords(self) -> List[str]:
+        return ["cognome", "nome", "nato", "nascita", "rilascio", "scadenza", "repubblica italiana"]
+    
     def get_default_structure(self) -> Dict[str, Any]:
         return {
             "tipo_documento": "",
@@ -457,13 +1200,7 @@ class DocumentoRiconoscimentoProcessor(DocumentProcessor):
         return enhanced_info
     
     def get_extraction_prompt(self, text: str) -> str:
-        # Limita drasticamente la lunghezza del testo per evitare timeout
-        max_text_length = 2000
-        if len(text) > max_text_length:
-            # Prendi solo l'inizio del testo per velocizzare l'elaborazione
-            text = text[:max_text_length]
-            st.info(f"📝 Testo limitato a {max_text_length} caratteri per evitare timeout")
-        
+        # Nessun troncamento: i testi lunghi vengono estratti a blocchi (chunk_token_budget)
         return f"""Estrai dal documento:
 - nome, cognome
 - data_nascita
@@ -477,34 +1214,155 @@ Testo: {text}
 
 Rispondi solo JSON."""
 
-    def extract_information(self, text: str, pdf_bytes: bytes = None) -> Dict[str, Any]:
+    def get_fragmented_text_prompt(self, text: str) -> str:
+        """Simplified prompt for short or fragmented OCR text"""
+        return f"""
+            Il testo seguente è stato estratto da un documento di identità tramite OCR ma potrebbe essere incompleto o frammentato.
+            
+            Testo disponibile:
+            {text}
+            
+            Analizza il testo e estrai qualsiasi informazione identificabile, anche parziale.
+            Cerca pattern come:
+            - Sequenze di numeri che potrebbero essere numeri di documento
+            - Date in qualsiasi formato
+            - Parole che potrebbero essere nomi o luoghi
+            - Codici fiscali (16 caratteri alfanumerici)
+            
+            Rispondi con un JSON contenente solo i campi che puoi identificare con ragionevole certezza:
+            {{"tipo_documento": "", "numero_documento": "", "nome": "", "cognome": "", "data_nascita": "", "codice_fiscale": "", "note": []}}
+            """
+    
+    def _identity_chat_call(self, prompt: str, temperature: float = 0, timeout: Optional[float] = None):
+        """Single chat completion for an identity-document prompt"""
+        return self._chat_complete(prompt, None, timeout, temperature)
+    
+    def _identity_chat_strategy(self, prompt: str, temperature: float, default_timeout: float,
+                                budget: CallBudget) -> Optional[Dict[str, Any]]:
+        """Chat strategy of the hedged race; runs in a worker thread, so no Streamlit calls"""
+        chat_response = get_resilience().call(
+            lambda timeout: self._identity_chat_call(prompt, temperature, timeout),
+            "chat", default_timeout, budget=budget,
+            accept=lambda response: self._parse_json_response(response) is not None
+        )
+        return self._parse_json_response(chat_response)
+    
+    @staticmethod
+    def _populated_fields(info: Dict[str, Any]) -> int:
+        return sum(1 for key, value in info.items() if key != 'note' and value and str(value).strip())
+    
+    def _is_valid_identity(self, info: Dict[str, Any]) -> bool:
+        """Codice fiscale with a correct check character and at least hedge_min_fields populated fields"""
+        return (is_valid_personal_codice_fiscale(str(info.get('codice_fiscale') or ''))
+                and self._populated_fields(info) >= self.hedge_min_fields)
+    
+    def _extract_information_hedged(self, text: str, pdf_bytes: bytes = None,
+                                    annotation_future: Optional[Future] = None) -> Dict[str, Any]:
+        """Race the extraction strategies and keep the first result that passes validation.
+        
+        Document Annotation and the primary prompt start together; the other prompt starts
+        after hedge_stagger_seconds if no valid result has arrived yet. Losers are cancelled:
+        queued ones never start, running ones are abandoned and not retried.
+        """
+        executor = _get_io_executor()
+        budget = CallBudget(EXTRACTION_BUDGET)
+        
+        # I prompt si costruiscono nel thread principale (get_extraction_prompt può mostrare messaggi)
+        standard = ("chat completion", self.get_extraction_prompt(text), 0, 12)
+        fragmented = ("strategia avanzata - testo frammentato", self.get_fragmented_text_prompt(text), 0.3, 8)
+        primary, hedge = (fragmented, standard) if len(text.strip()) < 100 else (standard, fragmented)
+        
+        def submit_chat(strategy) -> Future:
+            _, prompt, temperature, default_timeout = strategy
+            return executor.submit(self._identity_chat_strategy, prompt, temperature, default_timeout, budget)
+        
+        strategies: Dict[Future, str] = {}
+        if annotation_future is None and pdf_bytes is not None:
+            annotation_future = self.start_structured_extraction(pdf_bytes)
+        if annotation_future is not None:
+            strategies[annotation_future] = "Mistral OCR Document Annotation"
+        strategies[submit_chat(primary)] = primary[0]
+        
+        st.info(f"🏁 Estrazione documento di identità con strategie in parallelo "
+                f"({', '.join(strategies.values())}; riserva dopo {self.hedge_stagger_seconds:g}s)...")
+        hedge_at = time.monotonic() + self.hedge_stagger_seconds
+        pending = set(strategies)
+        winner, best, best_score = None, None, (False, 0)
+        
+        while pending or hedge is not None:
+            if budget.expired:
+                break
+            wait_for = budget.remaining()
+            if hedge is not None:
+                wait_for = min(wait_for, max(0.0, hedge_at - time.monotonic()))
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception:
+                    # Interruttore aperto, budget esaurito o errore API: la strategia è persa
+                    result = None
+                if not result:
+                    continue
+                info = self.get_default_structure()
+                if strategies[future] == "Mistral OCR Document Annotation":
+                    self._merge_structured_info(info, result)
+                else:
+                    info.update(result)
+                score = (self._is_valid_identity(info), self._populated_fields(info))
+                if score > best_score:
+                    best, best_score = (strategies[future], info), score
+                if score[0]:
+                    winner = best
+                    break
+            if winner is not None:
+                break
+            
+            # Strategia di riserva: parte solo se dopo lo stagger nessun risultato è ancora valido
+            if hedge is not None and (time.monotonic() >= hedge_at or not pending):
+                future = submit_chat(hedge)
+                strategies[future] = hedge[0]
+                pending.add(future)
+                hedge = None
+        
+        # Annulla le strategie perdenti: quelle in coda non partono, quelle in corso non vengono ritentate
+        budget.cancel()
+        for future in pending:
+            future.cancel()
+        
+        if winner is not None:
+            label, info = winner
+            st.success(f"✅ Documento di identità estratto con {label} ({best_score[1]} campi, codice fiscale valido)")
+        elif best is not None:
+            label, info = best
+            st.warning(f"⚠️ Nessuna strategia ha prodotto un risultato convalidato: uso il migliore ({label}, {best_score[1]} campi)")
+        else:
+            st.error("❌ Nessuna strategia di estrazione ha prodotto risultati")
+            return self.get_default_structure()
+        
+        if not isinstance(info.get('note'), list):
+            info['note'] = [info['note']] if info.get('note') else []
+        info['note'].append(f"Estratto con {label}")
+        return info
+    
+    def extract_information(self, text: str, pdf_bytes: bytes = None, annotation_future: Optional[Future] = None) -> Dict[str, Any]:
         """Extract information using Mistral OCR Document Annotation first, then enhanced fallback strategies for identity documents"""
-        import time
-        from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+        if self.hedged_extraction and not self._needs_chunking(text):
+            return self._extract_information_hedged(text, pdf_bytes, annotation_future)
         
         default_info = self.get_default_structure()
         
-        # Prima prova con Document Annotation se abbiamo i bytes del PDF
-        if pdf_bytes is not None:
+        # Prima prova con Document Annotation se abbiamo i bytes del PDF (o una richiesta già avviata)
+        if pdf_bytes is not None or annotation_future is not None:
             st.info("🚀 Tentativo di estrazione strutturata con Mistral OCR per documento di identità...")
-            structured_info = self.extract_structured_info_with_ocr(pdf_bytes)
+            structured_info = self.extract_structured_info_with_ocr(pdf_bytes, annotation_future=annotation_future)
             
             if structured_info:
-                # Converti il risultato strutturato in dizionario
-                if hasattr(structured_info, '__dict__'):
-                    extracted_dict = structured_info.__dict__
-                elif isinstance(structured_info, dict):
-                    extracted_dict = structured_info
-                else:
-                    extracted_dict = {}
-                
                 # Aggiorna le informazioni di default con quelle estratte
-                for key, value in extracted_dict.items():
-                    if key in default_info and value and str(value).strip():
-                        default_info[key] = str(value).strip()
+                non_empty_fields = self._merge_structured_info(default_info, structured_info)
                 
                 # Verifica se abbiamo estratto informazioni significative
-                non_empty_fields = sum(1 for v in default_info.values() if v and str(v).strip())
                 if non_empty_fields >= 3:  # Se abbiamo almeno 3 campi compilati
                     st.success(f"✅ Estrazione strutturata completata! {non_empty_fields} campi estratti.")
                     if 'note' not in default_info:
@@ -514,149 +1372,43 @@ Rispondi solo JSON."""
                 else:
                     st.warning("⚠️ Estrazione strutturata parziale, provo con strategie avanzate...")
         
-        def make_api_call_with_prompt(prompt, temperature=0):
-            messages = [{"role": "user", "content": prompt}]
-            return self.client.chat.complete(
-                model="mistral-small-latest",
-                messages=messages,
-                temperature=temperature
-            )
+        make_api_call_with_prompt = self._identity_chat_call
+        
+        # Retry e circuit breaker condivisi, budget complessivo per il documento
+        budget = CallBudget(EXTRACTION_BUDGET)
         
         # Se il testo è molto breve o sembra incompleto, usiamo strategie multiple
         if len(text.strip()) < 100:
             st.warning("⚠️ Testo estratto molto breve. Usando strategie avanzate di estrazione...")
             
             # Strategia 1: Prompt semplificato per testi frammentati
-            simple_prompt = f"""
-            Il testo seguente è stato estratto da un documento di identità tramite OCR ma potrebbe essere incompleto o frammentato.
-            
-            Testo disponibile:
-            {text}
-            
-            Analizza il testo e estrai qualsiasi informazione identificabile, anche parziale.
-            Cerca pattern come:
-            - Sequenze di numeri che potrebbero essere numeri di documento
-            - Date in qualsiasi formato
-            - Parole che potrebbero essere nomi o luoghi
-            - Codici fiscali (16 caratteri alfanumerici)
+            simple_prompt = self.get_fragmented_text_prompt(text)
             
-            Rispondi con un JSON contenente solo i campi che puoi identificare con ragionevole certezza:
-            {{"tipo_documento": "", "numero_documento": "", "nome": "", "cognome": "", "data_nascita": "", "codice_fiscale": "", "note": []}}
-            """
-            
-            # Meccanismo di retry con timeout ridotti per strategia avanzata
-            max_retries_advanced = 2
-            timeouts_advanced = [8, 15]  # Timeout molto ridotti per strategia avanzata
-            
-            for attempt in range(max_retries_advanced):
-                try:
-                    if attempt > 0:
-                        st.info(f"🔄 Retry strategia avanzata {attempt + 1}/{max_retries_advanced}...")
-                    
-                    current_timeout = timeouts_advanced[attempt]
-                    st.info(f"⏳ Timeout strategia avanzata: {current_timeout} secondi")
-                    
-                    with ThreadPoolExecutor() as executor:
-                        future = executor.submit(make_api_call_with_prompt, simple_prompt, 0.3)
-                        start_time = time.time()
-                        chat_response = future.result(timeout=current_timeout)
-                        elapsed_time = time.time() - start_time
-                        st.success(f"✅ Estrazione avanzata completata in {elapsed_time:.1f} secondi")
-                    
-                    response_text = chat_response.choices[0].message.content
-                    json_start = response_text.find('{')
-                    json_end = response_text.rfind('}')
-                    
-                    if json_start != -1 and json_end != -1:
-                        json_string = response_text[json_start:json_end + 1]
-                        extracted_info = json.loads(json_string)
-                        default_info.update(extracted_info)
-                        
-                        # Aggiungi nota sul metodo di estrazione
-                        if 'note' not in default_info:
-                            default_info['note'] = []
-                        default_info['note'].append("Estratto con strategia avanzata - testo frammentato")
-                        break  # Successo, esci dal loop
-                        
-                except FutureTimeoutError:
-                    elapsed = time.time() - start_time
-                    if attempt == max_retries_advanced - 1:
-                        st.error(f"⏰ Timeout: L'estrazione avanzata ha fallito tutti i tentativi (elapsed: {elapsed:.1f}s).")
-                    else:
-                        st.warning(f"⏰ Timeout tentativo {attempt + 1} (elapsed: {elapsed:.1f}s), riprovo...")
-                        time.sleep(1)
-                except Exception as e:
-                    if attempt == max_retries_advanced - 1:
-                        st.warning(f"Strategia semplificata fallita definitivamente: {e}")
-                    else:
-                        st.warning(f"Tentativo {attempt + 1} fallito: {e}")
-                        time.sleep(1)
+            # Timeout iniziale ridotto per la strategia avanzata
+            extracted_info = self._chat_with_retry(
+                lambda timeout: make_api_call_with_prompt(simple_prompt, 0.3, timeout), budget, 8
+            )
+            if extracted_info is not None:
+                default_info.update(extracted_info)
+                
+                # Aggiungi nota sul metodo di estrazione
+                if 'note' not in default_info:
+                    default_info['note'] = []
+                default_info['note'].append("Estratto con strategia avanzata - testo frammentato")
+        
+        elif self._needs_chunking(text):
+            return self._extract_information_chunked(text, default_info)
         
         else:
             # Usa il metodo standard per testi più lunghi
             st.info("🔄 Estrazione con chat completion...")
             prompt = self.get_extraction_prompt(text)
             
-            # Retry per strategia standard con timeout ridotti
-            max_retries = 2
-            timeouts = [12, 25]  # Timeout ridotti
-            
-            for attempt in range(max_retries):
-                try:
-                    if attempt > 0:
-                        st.info(f"🔄 Tentativo {attempt + 1} di {max_retries}...")
-                    
-                    current_timeout = timeouts[attempt]
-                    st.info(f"⏳ Timeout impostato: {current_timeout} secondi")
-                    
-                    with ThreadPoolExecutor() as executor:
-                        future = executor.submit(make_api_call_with_prompt, prompt, 0)
-                        start_time = time.time()
-                        
-                        try:
-                            chat_response = future.result(timeout=current_timeout)
-                            elapsed_time = time.time() - start_time
-                            st.success(f"✅ Estrazione completata in {elapsed_time:.1f} secondi")
-                            
-                            response_text = chat_response.choices[0].message.content
-                            json_start = response_text.find('{')
-                            json_end = response_text.rfind('}')
-                            
-                            if json_start != -1 and json_end != -1:
-                                json_string = response_text[json_start:json_end + 1]
-                                extracted_info = json.loads(json_string)
-                                default_info.update(extracted_info)
-                                break  # Successo, esci dal loop
-                            else:
-                                if attempt == max_retries - 1:
-                                    st.error("Impossibile trovare un blocco JSON valido nella risposta dell'API.")
-                                else:
-                                    st.warning(f"Risposta non valida al tentativo {attempt + 1}, riprovo...")
-                                    
-                        except FutureTimeoutError:
-                             elapsed = time.time() - start_time
-                             error_msg = f"⏰ Timeout {current_timeout}s (elapsed: {elapsed:.1f}s)"
-                             if attempt == max_retries - 1:
-                                 st.error(f"{error_msg}\n\n💡 **Soluzioni:**\n- Verifica connessione internet\n- Documento troppo complesso")
-                             else:
-                                 st.warning(error_msg)
-                                 time.sleep(1)  # Pausa ridotta
-                        
-                except json.JSONDecodeError as e:
-                    error_msg = f"Errore JSON al tentativo {attempt + 1}: {e}"
-                    if attempt == max_retries - 1:
-                        st.error(f"{error_msg} Impossibile decodificare la risposta.")
-                    else:
-                        st.warning(error_msg)
-                        time.sleep(1)  # Pausa ridotta
-                        
-                except Exception as e:
-                    error_msg = f"Errore al tentativo {attempt + 1}: {e}"
-                    if attempt == max_retries - 1:
-                        st.error(f"{error_msg}\n\n🔧 **Debug info:**\n- Lunghezza testo: {len(text)} caratteri\n- Tipo errore: {type(e).__name__}")
-                    else:
-                        st.warning(error_msg)
-                        time.sleep(1)  # Pausa ridotta
+            extracted_info = self._chat_with_retry(
+                lambda timeout: make_api_call_with_prompt(prompt, 0, timeout), budget, 12
+            )
+            if extracted_info is not None:
+                default_info.update(extracted_info)
         
         return default_info
 
@@ -664,9 +1416,14 @@ Rispondi solo JSON."""
 class FatturaProcessor(DocumentProcessor):
     """Processor for Fattura documents"""
     
+    list_item_fields = {"righe_fattura": ["descrizione", "quantita", "prezzo_unitario", "totale"]}
+    
     def get_document_type_name(self) -> str:
         return "Fattura"
     
+    def get_quality_keywords(self) -> List[str]:
+        return ["fattura", "partita iva", "imponibile", "iva", "totale"]
+    
     def get_default_structure(self) -> Dict[str, Any]:
         return {
             "numero_fattura": "",
@@ -718,6 +1475,9 @@ class ContrattoProcessor(DocumentProcessor):
     def get_document_type_name(self) -> str:
         return "Contratto"
     
+    def get_quality_keywords(self) -> List[str]:
+        return ["contratto", "parti", "articolo", "oggetto", "clausola"]
+    
     def get_default_structure(self) -> Dict[str, Any]:
         return {
             "tipo_contratto": "",
@@ -775,6 +1535,9 @@ class VerbaleAssembleaProcessor(DocumentProcessor):
     def get_document_type_name(self) -> str:
         return "Verbale di Assemblea"
 
+    def get_quality_keywords(self) -> List[str]:
+        return ["assemblea", "verbale", "presidente", "soci", "ordine del giorno", "delibera"]
+
     def get_default_structure(self) -> Dict[str, Any]:
         return {
             "data_assemblea_str": "", # es. "13/06/2025"
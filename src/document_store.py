@@ -0,0 +1,548 @@
+"""
+Archivio fuori sessione dei documenti elaborati dal multi-documento.
+
+MultiDocumentProcessor teneva in st.session_state il testo completo di ogni
+documento: la memoria del server cresceva con ogni sessione e ogni file, e
+tutto andava perso ricaricando la pagina. Ora ogni documento viene salvato
+nell'archivio (testo compresso con zlib, dati estratti in JSON) e in sessione
+resta solo un riferimento leggero (StoredDocument) con nome, tipo e dati
+estratti: il testo viene letto e decompresso solo quando serve.
+
+Due backend:
+
+- disk: una cartella per sessione, un file di metadati e uno di testo
+  compresso per documento;
+- sqlite: una riga per documento in un unico database.
+
+Riservatezza: i documenti (anche quelli d'identità, con codice fiscale e
+dati anagrafici) vengono scritti in chiaro, solo compressi. Per questo
+l'archivio è disattivato per impostazione predefinita (DOCUMENT_STORE=memory:
+tutto resta in st.session_state e sparisce con la sessione) e va attivato
+esplicitamente su un server il cui disco sia protetto quanto la memoria.
+
+Conservazione: con l'archivio attivo i documenti di una sessione restano su
+disco fino a DOCUMENT_STORE_TTL_HOURS (24 ore) dall'ultimo uso, o fino a
+"Cancella tutti i documenti". Il ripristino dopo un ricaricamento della
+pagina richiede anche DOCUMENT_STORE_RESTORE=1: l'identificativo di sessione
+finisce allora nel parametro "sessione" dell'URL e chi conosce l'URL ritrova
+i documenti (va trattato come una password). Senza ripristino
+l'identificativo resta solo nella sessione Streamlit.
+
+Limiti di occupazione (sul testo compresso, l'unica parte voluminosa):
+DOCUMENT_STORE_SESSION_MAX_MB per sessione e DOCUMENT_STORE_MAX_MB in totale.
+Oltre il limite si elimina il testo dei documenti letti meno di recente
+(LRU); i dati estratti restano. La scansione completa (sessioni scadute,
+occupazione scritta da altri processi) avviene al più ogni SWEEP_SECONDS;
+tra una scansione e l'altra le dimensioni sono tenute in un indice in memoria.
+
+Variabili d'ambiente: DOCUMENT_STORE (memory = niente archivio, disk,
+sqlite), DOCUMENT_STORE_RESTORE, DOCUMENT_STORE_DIR, DOCUMENT_STORE_PATH,
+DOCUMENT_STORE_SESSION_MAX_MB, DOCUMENT_STORE_MAX_MB, DOCUMENT_STORE_TTL_HOURS.
+"""
+
+from abc import ABC, abstractmethod
+from collections.abc import Mapping
+from contextlib import contextmanager
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+DEFAULT_STORE_DIR = os.path.join(".cache", "documents")
+DEFAULT_STORE_PATH = os.path.join(".cache", "documents.sqlite3")
+DEFAULT_SESSION_MAX_MB = 20
+DEFAULT_MAX_MB = 500
+DEFAULT_TTL_HOURS = 24
+# Intervallo minimo tra due scansioni complete dell'archivio
+SWEEP_SECONDS = 600
+
+# Ripristino dei documenti tramite il parametro "sessione" dell'URL (opt-in, vedi sopra)
+RESTORE_ENABLED = os.environ.get("DOCUMENT_STORE_RESTORE", "0") == "1"
+
+_SESSION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_session_id() -> str:
+    return uuid.uuid4().hex
+
+
+def is_valid_session_id(session_id: Optional[str]) -> bool:
+    """Session ids end up in paths and URLs: only uuid4 hex strings are accepted"""
+    return bool(session_id) and bool(_SESSION_ID_PATTERN.match(session_id))
+
+
+def compress_text(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8"), 6)
+
+
+def decompress_text(blob: bytes) -> str:
+    return zlib.decompress(blob).decode("utf-8")
+
+
+class StoredDocument(Mapping):
+    """Lightweight processed_documents entry; text_content is loaded from the store on access.
+
+    The other keys (file_name, document_type, extracted_info and the content
+    fingerprints) are the saved metadata, kept in memory.
+    """
+
+    def __init__(self, store: "DocumentStore", session_id: str, doc_id: str, metadata: Dict[str, Any]):
+        self.store = store
+        self.session_id = session_id
+        self.doc_id = doc_id
+        self.position = metadata.get("position", 0)  # Ordine di caricamento, per il ripristino
+        self._metadata = {key: value for key, value in metadata.items() if key not in ("position", "doc_id")}
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "text_content":
+            # Testo eliminato dalla quota (o archivio non leggibile): restano i dati estratti
+            return self.store.load_text(self.session_id, self.doc_id) or ""
+        return self._metadata[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._metadata
+        yield "text_content"
+
+    def __len__(self) -> int:
+        return len(self._metadata) + 1
+
+    def __repr__(self) -> str:
+        return (f"StoredDocument({self._metadata.get('file_name')!r}, {self._metadata.get('document_type')!r}, "
+                f"doc_id={self.doc_id!r})")
+
+
+class DocumentStore(ABC):
+    """Base class: quotas, counters and handle creation shared by the backends"""
+
+    def __init__(self, session_max_mb: float = None, max_size_mb: float = None, ttl_hours: float = None):
+        if session_max_mb is None:
+            session_max_mb = float(os.environ.get("DOCUMENT_STORE_SESSION_MAX_MB", DEFAULT_SESSION_MAX_MB))
+        if max_size_mb is None:
+            max_size_mb = float(os.environ.get("DOCUMENT_STORE_MAX_MB", DEFAULT_MAX_MB))
+        if ttl_hours is None:
+            ttl_hours = float(os.environ.get("DOCUMENT_STORE_TTL_HOURS", DEFAULT_TTL_HOURS))
+        self.session_max_bytes = int(session_max_mb * 1024 * 1024)
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.ttl_seconds = ttl_hours * 3600
+        self.loads = 0
+        self.evictions = 0
+        self.expired_sessions = 0
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def store_document(self, session_id: str, doc_info: Dict[str, Any], position: int) -> StoredDocument:
+        """Save a processed_documents entry and return its handle"""
+        doc_id = uuid.uuid4().hex
+        metadata = {key: value for key, value in doc_info.items() if key != "text_content"}
+        metadata["position"] = position
+        self.save(session_id, doc_id, metadata, doc_info.get("text_content") or "")
+        return StoredDocument(self, session_id, doc_id, metadata)
+
+    def restore_documents(self, session_id: str) -> List[StoredDocument]:
+        """Handles of the documents saved by a session, in upload order"""
+        return [StoredDocument(self, session_id, metadata["doc_id"], metadata)
+                for metadata in sorted(self.list_documents(session_id), key=lambda item: item["position"])]
+
+    # Operazioni dei backend
+    @abstractmethod
+    def save(self, session_id: str, doc_id: str, metadata: Dict[str, Any], text: str):
+        """Persist a document (metadata and compressed text), then enforce the quotas"""
+        pass
+
+    @abstractmethod
+    def load_text(self, session_id: str, doc_id: str) -> Optional[str]:
+        """Text of a document, or None when evicted or unreadable"""
+        pass
+
+    @abstractmethod
+    def list_documents(self, session_id: str) -> List[Dict[str, Any]]:
+        """Saved metadata of every document of a session, with its doc_id"""
+        pass
+
+    @abstractmethod
+    def delete(self, session_id: str, doc_id: str):
+        """Remove one document"""
+        pass
+
+    @abstractmethod
+    def delete_session(self, session_id: str):
+        """Remove every document of a session"""
+        pass
+
+    @abstractmethod
+    def get_stats(self) -> Dict[str, Any]:
+        """Occupation and counters (see _stats)"""
+        pass
+
+    def _stats(self, backend: str, sessions: int, documents: int, size_bytes: int) -> Dict[str, Any]:
+        return {
+            "backend": backend,
+            "sessions": sessions,
+            "documents": documents,
+            "size_bytes": size_bytes,
+            "max_size_bytes": self.max_size_bytes,
+            "session_max_bytes": self.session_max_bytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "expired_sessions": self.expired_sessions,
+        }
+
+
+class DiskDocumentStore(DocumentStore):
+    """One directory per session: <doc_id>.json (metadata) and <doc_id>.txt.z (compressed text).
+
+    The mtime of the text file is the LRU timestamp, the newest mtime in a session
+    directory its last use.
+    """
+
+    def __init__(self, store_dir: str = None, **limits):
+        super().__init__(**limits)
+        self.store_dir = store_dir or os.environ.get("DOCUMENT_STORE_DIR", DEFAULT_STORE_DIR)
+        # Dimensione dei testi compressi per sessione e percorso, ricostruita a ogni scansione completa
+        self._sizes: Dict[str, Dict[str, int]] = {}
+        self._total_size = 0
+
+    def _session_dir(self, session_id: str) -> str:
+        if not is_valid_session_id(session_id):
+            raise ValueError(f"Identificativo di sessione non valido: {session_id!r}")
+        return os.path.join(self.store_dir, session_id)
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def save(self, session_id: str, doc_id: str, metadata: Dict[str, Any], text: str):
+        directory = self._session_dir(session_id)
+        with self._lock:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                text_path = os.path.join(directory, f"{doc_id}.txt.z")
+                blob = compress_text(text)
+                self._write_atomic(text_path, blob)
+                self._track(session_id, text_path, len(blob))
+                self._write_atomic(os.path.join(directory, f"{doc_id}.json"),
+                                   json.dumps(metadata, ensure_ascii=False, default=str).encode("utf-8"))
+                self._evict_if_needed(session_id)
+            except OSError:
+                # Senza archivio il testo resta non disponibile, i dati estratti sono nel riferimento
+                pass
+
+    def load_text(self, session_id: str, doc_id: str) -> Optional[str]:
+        path = os.path.join(self._session_dir(session_id), f"{doc_id}.txt.z")
+        with self._lock:
+            try:
+                with open(path, "rb") as f:
+                    blob = f.read()
+                # Aggiorna mtime: è il timestamp usato per l'ordine LRU
+                os.utime(path, None)
+                self.loads += 1
+            except OSError:
+                return None
+        return decompress_text(blob)
+
+    def list_documents(self, session_id: str) -> List[Dict[str, Any]]:
+        directory = self._session_dir(session_id)
+        documents = []
+        with self._lock:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                return documents
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                        metadata = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                metadata["doc_id"] = name[:-len(".json")]
+                documents.append(metadata)
+        return documents
+
+    def delete(self, session_id: str, doc_id: str):
+        directory = self._session_dir(session_id)
+        with self._lock:
+            self._untrack(session_id, os.path.join(directory, f"{doc_id}.txt.z"))
+            for suffix in (".json", ".txt.z"):
+                try:
+                    os.remove(os.path.join(directory, f"{doc_id}{suffix}"))
+                except OSError:
+                    pass
+
+    def delete_session(self, session_id: str):
+        with self._lock:
+            self._total_size -= sum(self._sizes.pop(session_id, {}).values())
+            shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def _track(self, session_id: str, path: str, size: int):
+        files = self._sizes.setdefault(session_id, {})
+        self._total_size += size - files.get(path, 0)
+        files[path] = size
+
+    def _untrack(self, session_id: str, path: str):
+        self._total_size -= self._sizes.get(session_id, {}).pop(path, 0)
+
+    def _session_size(self, session_id: str) -> int:
+        return sum(self._sizes.get(session_id, {}).values())
+
+    def _list_texts(self) -> List[tuple]:
+        """(mtime, size, session_id, path) of every compressed text"""
+        entries = []
+        try:
+            sessions = os.listdir(self.store_dir)
+        except OSError:
+            return entries
+        for session_id in sessions:
+            directory = os.path.join(self.store_dir, session_id)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith(".txt.z"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, session_id, path))
+        return entries
+
+    def _sweep(self, session_id: str, now: float):
+        """Full scan: expire idle sessions and rebuild the size index (other processes share the directory)"""
+        self._last_sweep = now
+        self._sizes, self._total_size = {}, 0
+        try:
+            sessions = os.listdir(self.store_dir)
+        except OSError:
+            return
+        for other in sessions:
+            directory = os.path.join(self.store_dir, other)
+            try:
+                stats = {name: os.stat(os.path.join(directory, name)) for name in os.listdir(directory)}
+            except OSError:
+                continue
+            last_used = max((stat.st_mtime for stat in stats.values()), default=0)
+            if other != session_id and now - last_used > self.ttl_seconds:
+                shutil.rmtree(directory, ignore_errors=True)
+                self.expired_sessions += 1
+                continue
+            for name, stat in stats.items():
+                if name.endswith(".txt.z"):
+                    self._track(other, os.path.join(directory, name), stat.st_size)
+
+    def _evict_lru(self, session_ids: List[str], over_quota: Callable[[], bool]):
+        """Remove the least recently used texts of session_ids while over_quota() holds"""
+        entries = []
+        for owner in session_ids:
+            for path in list(self._sizes.get(owner, {})):
+                try:
+                    entries.append((os.stat(path).st_mtime, owner, path))
+                except OSError:
+                    self._untrack(owner, path)
+        for _, owner, path in sorted(entries):
+            if not over_quota():
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._untrack(owner, path)
+            self.evictions += 1
+
+    def _evict_if_needed(self, session_id: str):
+        """Periodically expire idle sessions; drop least recently used texts over the session and global quotas"""
+        now = time.time()
+        if now - self._last_sweep >= SWEEP_SECONDS:
+            self._sweep(session_id, now)
+        # Le date di accesso servono solo oltre quota: di norma nessuna scansione
+        if self._session_size(session_id) > self.session_max_bytes:
+            self._evict_lru([session_id], lambda: self._session_size(session_id) > self.session_max_bytes)
+        if self._total_size > self.max_size_bytes:
+            self._evict_lru(list(self._sizes), lambda: self._total_size > self.max_size_bytes)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._list_texts()
+            sessions = documents = 0
+            try:
+                for session_id in os.listdir(self.store_dir):
+                    sessions += 1
+                    documents += sum(name.endswith(".json") for name in os.listdir(os.path.join(self.store_dir, session_id)))
+            except OSError:
+                pass
+            return self._stats("disk", sessions, documents, sum(size for _, size, _, _ in entries))
+
+
+class SQLiteDocumentStore(DocumentStore):
+    """One row per document; the compressed text is set to NULL when evicted"""
+
+    def __init__(self, db_path: str = None, **limits):
+        super().__init__(**limits)
+        self.db_path = db_path or os.environ.get("DOCUMENT_STORE_PATH", DEFAULT_STORE_PATH)
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.db_path, timeout=5)
+        if not self._initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                " session_id TEXT NOT NULL, doc_id TEXT NOT NULL, metadata TEXT NOT NULL, text BLOB,"
+                " size INTEGER NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (session_id, doc_id))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS documents_accessed ON documents (accessed_at)")
+            connection.commit()
+            self._initialized = True
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """Connessione breve: commit all'uscita (rollback in caso di errore), poi chiusura"""
+        connection = self._connect()
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def save(self, session_id: str, doc_id: str, metadata: Dict[str, Any], text: str):
+        blob = compress_text(text)
+        now = time.time()
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO documents (session_id, doc_id, metadata, text, size, accessed_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (session_id, doc_id, json.dumps(metadata, ensure_ascii=False, default=str),
+                         blob, len(blob), now)
+                    )
+                    self._evict_if_needed(connection, session_id, now)
+            except (sqlite3.Error, OSError):
+                pass
+
+    def load_text(self, session_id: str, doc_id: str) -> Optional[str]:
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    row = connection.execute(
+                        "SELECT text FROM documents WHERE session_id = ? AND doc_id = ?", (session_id, doc_id)
+                    ).fetchone()
+                    if row is None or row[0] is None:
+                        return None
+                    connection.execute(
+                        "UPDATE documents SET accessed_at = ? WHERE session_id = ? AND doc_id = ?",
+                        (time.time(), session_id, doc_id)
+                    )
+                    self.loads += 1
+                    blob = row[0]
+            except (sqlite3.Error, OSError):
+                return None
+        return decompress_text(blob)
+
+    def list_documents(self, session_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    rows = connection.execute(
+                        "SELECT doc_id, metadata FROM documents WHERE session_id = ?", (session_id,)
+                    ).fetchall()
+            except (sqlite3.Error, OSError):
+                return []
+        documents = []
+        for doc_id, metadata in rows:
+            metadata = json.loads(metadata)
+            metadata["doc_id"] = doc_id
+            documents.append(metadata)
+        return documents
+
+    def delete(self, session_id: str, doc_id: str):
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    connection.execute("DELETE FROM documents WHERE session_id = ? AND doc_id = ?",
+                                       (session_id, doc_id))
+            except (sqlite3.Error, OSError):
+                pass
+
+    def delete_session(self, session_id: str):
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    connection.execute("DELETE FROM documents WHERE session_id = ?", (session_id,))
+            except (sqlite3.Error, OSError):
+                pass
+
+    def _evict_if_needed(self, connection: sqlite3.Connection, session_id: str, now: float):
+        """Periodically expire idle sessions; drop least recently used texts over the session and global quotas"""
+        if now - self._last_sweep >= SWEEP_SECONDS:
+            self._last_sweep = now
+            expired = connection.execute(
+                "SELECT session_id FROM documents GROUP BY session_id HAVING MAX(accessed_at) < ?",
+                (now - self.ttl_seconds,)
+            ).fetchall()
+            for (other,) in expired:
+                connection.execute("DELETE FROM documents WHERE session_id = ?", (other,))
+                self.expired_sessions += 1
+
+        session_size, total_size = connection.execute(
+            "SELECT COALESCE(SUM(CASE WHEN session_id = ? THEN size END), 0), COALESCE(SUM(size), 0) FROM documents",
+            (session_id,)
+        ).fetchone()
+        if session_size <= self.session_max_bytes and total_size <= self.max_size_bytes:
+            return
+        rows = connection.execute(
+            "SELECT session_id, doc_id, size FROM documents WHERE text IS NOT NULL ORDER BY accessed_at"
+        ).fetchall()
+        for owner, doc_id, size in rows:
+            over_session = owner == session_id and session_size > self.session_max_bytes
+            if not over_session and total_size <= self.max_size_bytes:
+                continue
+            connection.execute("UPDATE documents SET text = NULL, size = 0 WHERE session_id = ? AND doc_id = ?",
+                               (owner, doc_id))
+            total_size -= size
+            if owner == session_id:
+                session_size -= size
+            self.evictions += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    sessions, documents, size_bytes = connection.execute(
+                        "SELECT COUNT(DISTINCT session_id), COUNT(*), COALESCE(SUM(size), 0) FROM documents"
+                    ).fetchone()
+            except (sqlite3.Error, OSError):
+                sessions, documents, size_bytes = 0, 0, 0
+            return self._stats("sqlite", sessions, documents, size_bytes)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_document_store() -> Optional[DocumentStore]:
+    """Archivio condiviso da tutte le sessioni del processo (None con DOCUMENT_STORE=memory, il default)"""
+    global _default_store
+    backend = os.environ.get("DOCUMENT_STORE", "memory")
+    if backend == "memory":
+        return None
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = SQLiteDocumentStore() if backend == "sqlite" else DiskDocumentStore()
+        return _default_store
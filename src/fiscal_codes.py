@@ -0,0 +1,65 @@
+"""
+Validazione di codice fiscale e partita IVA italiani.
+
+- Partita IVA (e codice fiscale numerico delle società): 11 cifre, l'ultima è
+  la cifra di controllo calcolata con l'algoritmo di Luhn.
+- Codice fiscale delle persone fisiche: 16 caratteri, l'ultimo è il carattere
+  di controllo calcolato dalle tabelle dei caratteri in posizione pari/dispari.
+  Sono accettati i codici con omocodia (cifre sostituite da lettere).
+"""
+
+import re
+
+_PARTITA_IVA = re.compile(r'^\d{11}$')
+_PERSONAL_CF = re.compile(r'^[A-Z]{6}[0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]$')
+
+# Valori dei caratteri in posizione dispari (1ª, 3ª, ...) per il carattere di controllo
+_ODD_VALUES = {
+    '0': 1, '1': 0, '2': 5, '3': 7, '4': 9, '5': 13, '6': 15, '7': 17, '8': 19, '9': 21,
+    'A': 1, 'B': 0, 'C': 5, 'D': 7, 'E': 9, 'F': 13, 'G': 15, 'H': 17, 'I': 19, 'J': 21,
+    'K': 2, 'L': 4, 'M': 18, 'N': 20, 'O': 11, 'P': 3, 'Q': 6, 'R': 8, 'S': 12, 'T': 14,
+    'U': 16, 'V': 10, 'W': 22, 'X': 25, 'Y': 24, 'Z': 23,
+}
+
+
+def _even_value(char: str) -> int:
+    return int(char) if char.isdigit() else ord(char) - ord('A')
+
+
+def normalize_code(code: str) -> str:
+    """Uppercase code without spaces, dots or dashes (common in OCR output)"""
+    return re.sub(r'[\s.\-]', '', code or "").upper()
+
+
+def is_valid_partita_iva(code: str) -> bool:
+    """Whether code is an 11-digit number with a correct check digit"""
+    code = normalize_code(code)
+    if not _PARTITA_IVA.match(code) or code == "0" * 11:
+        return False
+    total = 0
+    for position, char in enumerate(code[:10]):
+        digit = int(char)
+        if position % 2 == 1:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return (10 - total % 10) % 10 == int(code[10])
+
+
+def is_valid_personal_codice_fiscale(code: str) -> bool:
+    """Whether code is a 16-character codice fiscale with a correct check character"""
+    code = normalize_code(code)
+    if not _PERSONAL_CF.match(code):
+        return False
+    total = sum(_ODD_VALUES[char] if position % 2 == 0 else _even_value(char)
+                for position, char in enumerate(code[:15]))
+    return chr(ord('A') + total % 26) == code[15]
+
+
+def is_valid_codice_fiscale(code: str) -> bool:
+    """Whether code is a valid codice fiscale: personal (16 characters) or numeric (11 digits)"""
+    code = normalize_code(code)
+    if len(code) == 11:
+        return is_valid_partita_iva(code)
+    return is_valid_personal_codice_fiscale(code)
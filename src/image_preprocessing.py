@@ -0,0 +1,194 @@
+"""
+Preprocessing delle scansioni dei documenti di identità prima dell'OCR.
+
+Carte d'identità e passaporti arrivano spesso come foto da smartphone di
+diversi megabyte, a colori e leggermente ruotate, a volte incapsulate in un
+PDF. Prima dell'upload le immagini vengono convertite in scala di grigi,
+raddrizzate (deskew), riportate a una risoluzione sufficiente per l'OCR e
+ricompresse in JPEG: il payload si riduce di molto e l'OCR risponde prima.
+
+Pillow è in requirements.txt; in un'installazione che ne è priva i file passano
+invariati.
+"""
+
+import io
+import os
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+IMAGE_MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+}
+
+# Risoluzione sufficiente per l'OCR di documenti di identità
+TARGET_DPI = int(os.environ.get("ID_PREPROCESS_DPI", "300"))
+# Lato lungo massimo quando la risoluzione dell'immagine non è nota (foto da smartphone)
+MAX_LONG_SIDE_PX = 2000
+JPEG_QUALITY = 80
+
+# Ricerca dell'angolo di inclinazione: ±MAX_SKEW_DEGREES a passi di SKEW_STEP_DEGREES
+MAX_SKEW_DEGREES = 5.0
+SKEW_STEP_DEGREES = 0.5
+# Lato del campione ridotto su cui si stima l'inclinazione
+SKEW_SAMPLE_SIZE = 600
+
+
+def image_mime_type(file_name: str) -> Optional[str]:
+    """MIME type of a supported image upload, None for any other file"""
+    return IMAGE_MIME_TYPES.get(os.path.splitext(file_name.lower())[1])
+
+
+def _projection_score(binary) -> float:
+    """Varianza del profilo orizzontale: è massima quando le righe di testo sono allineate"""
+    profile = list(binary.resize((1, binary.height), Image.BOX).getdata())
+    mean = sum(profile) / len(profile)
+    return sum((value - mean) ** 2 for value in profile)
+
+
+def estimate_skew_angle(gray) -> float:
+    """Rotation (degrees, counter-clockwise) that straightens the text lines of a grayscale image"""
+    sample = gray.copy()
+    sample.thumbnail((SKEW_SAMPLE_SIZE, SKEW_SAMPLE_SIZE))
+    # Testo bianco su fondo nero: gli angoli vuoti introdotti dalla rotazione non contano
+    binary = ImageOps.invert(sample).point(lambda value: 255 if value > 128 else 0)
+
+    best_angle = 0.0
+    best_score = _projection_score(binary)
+    steps = int(MAX_SKEW_DEGREES / SKEW_STEP_DEGREES)
+    for step in range(-steps, steps + 1):
+        angle = step * SKEW_STEP_DEGREES
+        if step == 0:
+            continue
+        score = _projection_score(binary.rotate(angle, resample=Image.NEAREST, fillcolor=0))
+        if score > best_score:
+            best_angle, best_score = angle, score
+    return best_angle
+
+
+def preprocess_image(image, source_dpi: Optional[float] = None) -> Tuple[Any, Dict[str, Any]]:
+    """Grayscale, deskew and downscale a PIL image; returns (image, details)"""
+    image = ImageOps.exif_transpose(image)
+    gray = image.convert("L")
+
+    angle = estimate_skew_angle(gray)
+    if angle:
+        gray = gray.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+    # Normalizzazione DPI: mai ingrandire, riduci alla risoluzione obiettivo o al lato massimo
+    scale = min(1.0, MAX_LONG_SIDE_PX / max(gray.size))
+    if source_dpi:
+        scale = min(scale, TARGET_DPI / source_dpi)
+    if scale < 1.0:
+        new_size = (max(1, round(gray.width * scale)), max(1, round(gray.height * scale)))
+        gray = gray.resize(new_size, Image.LANCZOS)
+
+    output_dpi = round(source_dpi * scale) if source_dpi else TARGET_DPI
+    return gray, {"deskew_angle": angle, "scale": round(scale, 3), "dpi": output_dpi}
+
+
+def _source_dpi(image) -> Optional[float]:
+    dpi = image.info.get("dpi")
+    if dpi and dpi[0] and float(dpi[0]) > 1:
+        return float(dpi[0])
+    return None
+
+
+def _report(original: bytes, processed: bytes, applied: bool, **details) -> Dict[str, Any]:
+    saved_bytes = len(original) - len(processed) if applied else 0
+    report = {
+        "applied": applied,
+        "original_bytes": len(original),
+        "processed_bytes": len(processed) if applied else len(original),
+        "saved_bytes": saved_bytes,
+        "saved_pct": round(100 * saved_bytes / len(original), 1) if original else 0.0,
+    }
+    report.update(details)
+    return report
+
+
+def preprocess_image_bytes(image_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    """Preprocess a JPEG/PNG upload into a smaller grayscale JPEG; returns (bytes, report)"""
+    if not PIL_AVAILABLE:
+        return image_bytes, _report(image_bytes, image_bytes, False, reason="Pillow non installato")
+
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        processed, details = preprocess_image(image, _source_dpi(image))
+
+    buffer = io.BytesIO()
+    processed.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=True,
+                   dpi=(details["dpi"], details["dpi"]))
+    output = buffer.getvalue()
+
+    if len(output) >= len(image_bytes):
+        return image_bytes, _report(image_bytes, output, False, reason="nessun risparmio")
+    return output, _report(image_bytes, output, True, **details)
+
+
+def preprocess_scanned_pdf(pdf_bytes: bytes) -> Tuple[bytes, Dict[str, Any]]:
+    """Rebuild a scan-wrapping PDF (one image per page, no usable text layer) from preprocessed pages.
+
+    Born-digital PDFs and pages without an embedded image are left untouched.
+    """
+    if not PIL_AVAILABLE:
+        return pdf_bytes, _report(pdf_bytes, pdf_bytes, False, reason="Pillow non installato")
+
+    import PyPDF2
+    from text_quality import score_page_text
+
+    try:
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+        pages = []
+        angles = []
+        for page in reader.pages:
+            if not score_page_text(page.extract_text() or "")["needs_ocr"]:
+                return pdf_bytes, _report(pdf_bytes, pdf_bytes, False, reason="PDF con testo digitale")
+            images = list(page.images)
+            if not images:
+                return pdf_bytes, _report(pdf_bytes, pdf_bytes, False, reason="pagina senza immagini")
+
+            # La scansione è l'immagine più grande della pagina
+            scans = [Image.open(io.BytesIO(image_file.data)) for image_file in images]
+            scan = max(scans, key=lambda image: image.width * image.height)
+            page_width_inches = float(page.mediabox.width) / 72
+            source_dpi = scan.width / page_width_inches if page_width_inches else None
+            processed, details = preprocess_image(scan, source_dpi)
+            pages.append((processed, details["dpi"]))
+            angles.append(details["deskew_angle"])
+    except Exception as e:
+        return pdf_bytes, _report(pdf_bytes, pdf_bytes, False, reason=f"PDF non elaborabile: {e}")
+
+    if not pages:
+        return pdf_bytes, _report(pdf_bytes, pdf_bytes, False, reason="PDF vuoto")
+
+    buffer = io.BytesIO()
+    first_page, first_dpi = pages[0]
+    first_page.save(buffer, format="PDF", save_all=True, append_images=[image for image, _ in pages[1:]],
+                    resolution=first_dpi, quality=JPEG_QUALITY)
+    output = buffer.getvalue()
+
+    if len(output) >= len(pdf_bytes):
+        return pdf_bytes, _report(pdf_bytes, output, False, reason="nessun risparmio")
+    return output, _report(pdf_bytes, output, True, pages=len(pages), deskew_angles=angles)
+
+
+def preprocess_identity_document(file_bytes: bytes, file_name: str) -> Tuple[bytes, Optional[str], Dict[str, Any]]:
+    """Preprocess an identity document upload.
+
+    Returns (bytes, image_mime, report): image_mime is the MIME type of the bytes
+    for image uploads and None for PDFs and other files.
+    """
+    image_mime = image_mime_type(file_name)
+    if image_mime is not None:
+        processed, report = preprocess_image_bytes(file_bytes)
+        return processed, ("image/jpeg" if report["applied"] else image_mime), report
+    if file_name.lower().endswith(".pdf"):
+        processed, report = preprocess_scanned_pdf(file_bytes)
+        return processed, None, report
+    return file_bytes, None, _report(file_bytes, file_bytes, False, reason="formato non supportato")
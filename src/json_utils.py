@@ -0,0 +1,158 @@
+"""
+Utility JSON per le risposte dei modelli.
+
+- parse_json_object: estrae l'oggetto JSON da una risposta chat tollerando
+  code fence, testo prima/dopo, virgole finali e output troncato (in quel caso
+  vengono salvati i campi completi e scartato quello interrotto).
+- build_json_schema: costruisce lo schema JSON per le risposte strutturate
+  (response_format "json_schema") a partire dalla struttura di default di un
+  processore.
+"""
+
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+_CODE_FENCE = re.compile(r'```(?:json)?\s*(.*?)```', re.DOTALL | re.IGNORECASE)
+_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+_CLOSERS = {'{': '}', '[': ']'}
+# Tentativi massimi di chiusura durante il recupero di un JSON troncato
+_MAX_SALVAGE_ATTEMPTS = 200
+
+
+def _loads(text: str) -> Any:
+    # strict=False accetta a capo e tabulazioni letterali dentro le stringhe, frequenti nei testi OCR
+    return json.loads(text, strict=False)
+
+
+def salvage_json_object(fragment: str) -> Optional[Dict[str, Any]]:
+    """Recover the complete members of a truncated JSON object (fragment must start at '{')"""
+    stack = []
+    in_string = False
+    escaped = False
+    cut_points = []  # (posizione, parentesi da chiudere) dopo ogni valore completo
+
+    for position, char in enumerate(fragment):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in _CLOSERS:
+            stack.append(char)
+        elif char in '}]':
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                # Oggetto completo: nessun recupero necessario
+                try:
+                    return _loads(fragment[:position + 1])
+                except json.JSONDecodeError:
+                    return None
+            cut_points.append((position + 1, "".join(_CLOSERS[c] for c in reversed(stack))))
+        elif char == ',' and stack:
+            cut_points.append((position, "".join(_CLOSERS[c] for c in reversed(stack))))
+
+    # Dal taglio più lungo al più corto: il primo che produce JSON valido vince
+    for position, closers in reversed(cut_points[-_MAX_SALVAGE_ATTEMPTS:]):
+        candidate = fragment[:position].rstrip().rstrip(',') + closers
+        try:
+            result = _loads(_TRAILING_COMMA.sub(r'\1', candidate))
+        except json.JSONDecodeError:
+            continue
+        if isinstance(result, dict):
+            return result
+    return None
+
+
+def parse_json_object(text: str, salvage: bool = True) -> Optional[Dict[str, Any]]:
+    """JSON object contained in a model response, or None.
+
+    With salvage=False only complete, well-formed objects are accepted.
+    """
+    if not text:
+        return None
+    fenced = _CODE_FENCE.search(text)
+    if fenced and '{' in fenced.group(1):
+        text = fenced.group(1)
+
+    start = text.find('{')
+    if start == -1:
+        return None
+
+    # Oggetto completo seguito da eventuale testo libero
+    try:
+        result, _ = json.JSONDecoder(strict=False).raw_decode(text, start)
+        if isinstance(result, dict):
+            return result
+    except json.JSONDecodeError:
+        pass
+
+    end = text.rfind('}')
+    if end > start:
+        candidate = text[start:end + 1]
+        for attempt in (candidate, _TRAILING_COMMA.sub(r'\1', candidate)):
+            try:
+                result = _loads(attempt)
+                if isinstance(result, dict):
+                    return result
+            except json.JSONDecodeError:
+                continue
+
+    return salvage_json_object(text[start:]) if salvage else None
+
+
+def _schema_for(value: Any, item_fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    if isinstance(value, dict):
+        return _object_schema({key: _schema_for(child) for key, child in value.items()})
+    if isinstance(value, list):
+        if item_fields:
+            items = _object_schema({field: {"type": "string"} for field in item_fields})
+        elif value:
+            items = _schema_for(value[0])
+        else:
+            items = {"type": "string"}
+        return {"type": "array", "items": items}
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, (int, float)):
+        return {"type": "number"}
+    return {"type": "string"}
+
+
+def _object_schema(properties: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def build_json_schema(structure: Dict[str, Any], list_item_fields: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+    """JSON schema mirroring a default structure.
+
+    Empty lists become lists of strings unless list_item_fields gives the keys of their objects.
+    """
+    list_item_fields = list_item_fields or {}
+    return _object_schema({key: _schema_for(value, list_item_fields.get(key)) for key, value in structure.items()})
+
+
+def json_schema_response_format(name: str, structure: Dict[str, Any],
+                                list_item_fields: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+    """response_format for schema-constrained chat completions"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": re.sub(r'[^A-Za-z0-9_-]', '_', name),
+            "schema": build_json_schema(structure, list_item_fields),
+            "strict": True,
+        },
+    }
+
@@ -0,0 +1,317 @@
+"""
+Cache persistente (SQLite) delle risposte chat di Mistral.
+
+Le estrazioni girano a temperatura 0: lo stesso prompt produce la stessa
+risposta, ma ogni rerun di Streamlit o click su "Estrai" la pagava di nuovo.
+La chiave è lo SHA-256 di (modello, messaggi, temperatura, response format,
+max_tokens). Le voci scadono dopo un TTL e, oltre la dimensione massima,
+vengono eliminate quelle usate meno di recente.
+
+Tutte le chiamate chat passano da cached_chat_complete (e dalla variante
+async): è il punto unico in cui agganciare politiche comuni alle chiamate.
+Solo le chiamate che raggiungono l'API passano dal rate limiter condiviso.
+
+Variabili d'ambiente: LLM_CACHE_PATH, LLM_CACHE_MAX_MB, LLM_CACHE_TTL_HOURS,
+LLM_CACHE_BYPASS=1 per disattivarla.
+"""
+
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from chunked_extraction import estimate_tokens
+from json_utils import parse_json_object
+from rate_limiter import PRIORITY_NORMAL, get_rate_limiter, retry_after_seconds
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "llm_responses.sqlite3")
+DEFAULT_MAX_SIZE_MB = 50
+DEFAULT_TTL_HOURS = 24 * 7
+# Token di risposta stimati per il rate limiter quando max_tokens non è indicato
+DEFAULT_COMPLETION_TOKENS = 1000
+# Incrementare quando cambia il formato della chiave o delle voci
+CACHE_FORMAT_VERSION = 1
+
+
+class LLMResponseCache:
+    """Cache SQLite con TTL ed eviction LRU per le risposte chat"""
+
+    def __init__(self, db_path: str = None, max_size_mb: float = None, ttl_hours: float = None):
+        self.db_path = db_path or os.environ.get("LLM_CACHE_PATH", DEFAULT_CACHE_PATH)
+        if max_size_mb is None:
+            max_size_mb = float(os.environ.get("LLM_CACHE_MAX_MB", DEFAULT_MAX_SIZE_MB))
+        if ttl_hours is None:
+            ttl_hours = float(os.environ.get("LLM_CACHE_TTL_HOURS", DEFAULT_TTL_HOURS))
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.ttl_seconds = ttl_hours * 3600
+        self.enabled = os.environ.get("LLM_CACHE_BYPASS", "0") != "1"
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.db_path, timeout=5)
+        if not self._initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT, content TEXT NOT NULL,"
+                " size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            connection.commit()
+            self._initialized = True
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """Connessione breve: commit all'uscita (rollback in caso di errore), poi chiusura"""
+        connection = self._connect()
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, Any]], temperature: Optional[float] = None,
+                 response_format: Any = None, max_tokens: Optional[int] = None) -> str:
+        """Chiave della voce: hash dei parametri che determinano la risposta"""
+        if hasattr(response_format, "model_dump"):
+            response_format = response_format.model_dump()
+        payload = json.dumps(
+            {
+                "v": CACHE_FORMAT_VERSION,
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "response_format": response_format,
+                "max_tokens": max_tokens,
+            },
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Restituisce il contenuto della risposta in cache o None"""
+        now = time.time()
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    row = connection.execute(
+                        "SELECT content, created_at FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None and now - row[1] > self.ttl_seconds:
+                        connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        self.expired += 1
+                        row = None
+                    if row is None:
+                        self.misses += 1
+                        return None
+                    connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                    self.hits += 1
+                    return row[0]
+            except (sqlite3.Error, OSError):
+                self.misses += 1
+                return None
+
+    def put(self, key: str, model: str, content: str):
+        """Salva la risposta e applica l'eviction se necessario"""
+        now = time.time()
+        size = len(content.encode("utf-8"))
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO responses (key, model, content, size, created_at, accessed_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, model, content, size, now, now)
+                    )
+                    self._evict_if_needed(connection, now)
+            except (sqlite3.Error, OSError):
+                # La cache è un'ottimizzazione: un errore di scrittura non deve bloccare l'estrazione
+                pass
+
+    def _evict_if_needed(self, connection: sqlite3.Connection, now: float):
+        """Elimina le voci scadute, poi quelle usate meno di recente finché si rientra nel limite"""
+        cursor = connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.expired += max(cursor.rowcount, 0)
+
+        total_size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            if total_size <= self.max_size_bytes:
+                break
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total_size -= size
+            self.evictions += 1
+
+    def clear(self):
+        """Svuota completamente la cache"""
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    connection.execute("DELETE FROM responses")
+            except (sqlite3.Error, OSError):
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Contatori hit/miss e occupazione"""
+        with self._lock:
+            try:
+                with self._transaction() as connection:
+                    entries, size_bytes = connection.execute(
+                        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+                    ).fetchone()
+            except (sqlite3.Error, OSError):
+                entries, size_bytes = 0, 0
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": size_bytes,
+                "max_size_bytes": self.max_size_bytes,
+            }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """Istanza condivisa da tutte le sessioni dello stesso processo"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = LLMResponseCache()
+        return _default_cache
+
+
+def contains_json_object(text: str) -> bool:
+    """Whether the response is a complete JSON object (salvaged partial output is not worth caching)"""
+    return parse_json_object(text, salvage=False) is not None
+
+
+def _cached_response(content: str):
+    """Oggetto con la stessa forma della risposta dell'SDK (choices[0].message.content)"""
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=None,
+        cached=True
+    )
+
+
+def _cache_lookup(model, messages, temperature, response_format, max_tokens, bypass):
+    cache = get_llm_cache()
+    if not cache.enabled:
+        return cache, None, None
+    key = cache.make_key(model, messages, temperature, response_format, max_tokens)
+    # bypass salta la lettura ma salva comunque la risposta nuova (refresh della voce)
+    return cache, key, (None if bypass else cache.get(key))
+
+
+def _cache_store(cache, key, model, chat_response, validate):
+    if key is None:
+        return
+    content = chat_response.choices[0].message.content
+    if isinstance(content, str) and (validate is None or validate(content)):
+        cache.put(key, model, content)
+
+
+def _request_params(model, messages, temperature, response_format, max_tokens, kwargs) -> Dict[str, Any]:
+    params = {"model": model, "messages": messages, **kwargs}
+    if temperature is not None:
+        params["temperature"] = temperature
+    if response_format is not None:
+        params["response_format"] = response_format
+    if max_tokens is not None:
+        params["max_tokens"] = max_tokens
+    return params
+
+
+def _estimated_tokens(messages: List[Dict[str, Any]], max_tokens: Optional[int]) -> int:
+    prompt = json.dumps(messages, ensure_ascii=False, default=str)
+    return estimate_tokens(prompt) + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+def _queue_timeout(kwargs: Dict[str, Any]) -> Optional[float]:
+    """The call's timeout also bounds the wait in the rate-limit queue"""
+    timeout_ms = kwargs.get("timeout_ms")
+    return timeout_ms / 1000 if timeout_ms else None
+
+
+def _settle(estimated: int, chat_response):
+    usage = getattr(chat_response, "usage", None)
+    get_rate_limiter().settle(estimated, getattr(usage, "total_tokens", None))
+
+
+def _throttle_on_rate_limit(error: BaseException):
+    pause = retry_after_seconds(error)
+    if pause is not None:
+        get_rate_limiter().throttle(pause)
+
+
+def cached_chat_complete(client, model: str, messages: List[Dict[str, Any]], temperature: Optional[float] = None,
+                         response_format: Any = None, max_tokens: Optional[int] = None, bypass: bool = False,
+                         validate: Optional[Callable[[str], bool]] = None, priority: int = PRIORITY_NORMAL, **kwargs):
+    """client.chat.complete with the persistent response cache in front.
+
+    Only responses accepted by validate (all when None) are stored. Cache misses
+    wait in the shared rate-limit queue with the given priority. Extra kwargs
+    (e.g. timeout_ms) go to the client and do not affect the key.
+    """
+    cache, key, content = _cache_lookup(model, messages, temperature, response_format, max_tokens, bypass)
+    if content is not None:
+        return _cached_response(content)
+
+    estimated = _estimated_tokens(messages, max_tokens)
+    get_rate_limiter().acquire(estimated, priority, timeout=_queue_timeout(kwargs))
+    try:
+        chat_response = client.chat.complete(
+            **_request_params(model, messages, temperature, response_format, max_tokens, kwargs))
+    except Exception as e:
+        _throttle_on_rate_limit(e)
+        raise
+    _settle(estimated, chat_response)
+    _cache_store(cache, key, model, chat_response, validate)
+    return chat_response
+
+
+async def cached_chat_complete_async(client, model: str, messages: List[Dict[str, Any]],
+                                     temperature: Optional[float] = None, response_format: Any = None,
+                                     max_tokens: Optional[int] = None, bypass: bool = False,
+                                     validate: Optional[Callable[[str], bool]] = None,
+                                     priority: int = PRIORITY_NORMAL, **kwargs):
+    """Async counterpart of cached_chat_complete (client.chat.complete_async)"""
+    cache, key, content = _cache_lookup(model, messages, temperature, response_format, max_tokens, bypass)
+    if content is not None:
+        return _cached_response(content)
+
+    estimated = _estimated_tokens(messages, max_tokens)
+    await get_rate_limiter().acquire_async(estimated, priority, timeout=_queue_timeout(kwargs))
+    try:
+        chat_response = await client.chat.complete_async(
+            **_request_params(model, messages, temperature, response_format, max_tokens, kwargs))
+    except Exception as e:
+        _throttle_on_rate_limit(e)
+        raise
+    _settle(estimated, chat_response)
+    _cache_store(cache, key, model, chat_response, validate)
+    return chat_response
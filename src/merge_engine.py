@@ -0,0 +1,169 @@
+"""
+Combinazione deterministica dei dati estratti da più documenti.
+
+La combinazione per i template passava al modello tutti i documenti e lunghe
+istruzioni di mappatura solo per scegliere e unire i valori (10-20 secondi).
+Qui ogni campo richiesto dal template viene compilato in locale:
+
+- risoluzioni dei conflitti (scelte dell'utente, poi quelle automatiche)
+  applicate così come sono;
+- altrimenti il valore della fonte più autorevole per quel campo (priorità
+  configurabile per campo e per categoria del template: visura > statuto >
+  bilancio per i dati societari, documento di identità per quelli personali),
+  a parità di tipo il documento caricato per primo;
+- per ogni campo una traccia di provenienza (documento, tipo, regola,
+  numero di valori alternativi).
+
+I campi senza alcuna fonte restano vuoti e vengono restituiti come "non
+decisi": solo per questi si può usare il modello come ripiego
+(MERGE_LLM_FALLBACK=1).
+
+Variabili d'ambiente: MERGE_LLM_FALLBACK, MERGE_FIELD_PRIORITY (JSON
+{"campo": ["tipo", ...]} che sostituisce la priorità di quei campi).
+"""
+
+import json
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+LLM_FALLBACK = os.environ.get("MERGE_LLM_FALLBACK", "0") == "1"
+
+RULE_USER_RESOLUTION = "user_resolution"
+RULE_AUTO_RESOLUTION = "auto_resolution"
+RULE_SOURCE_PRIORITY = "source_priority"
+RULE_LLM_FALLBACK = "llm_fallback"
+
+_COMPANY = ["visura", "statuto", "verbale_assemblea", "bilancio", "contratto", "fattura", "generico"]
+
+# Priorità delle fonti per categoria del template (_get_template_requirements)
+CATEGORY_PRIORITY: Dict[str, List[str]] = {
+    "azienda": _COMPANY,
+    "governance": ["visura", "verbale_assemblea", "statuto", "generico"],
+    "soci": ["visura", "statuto", "verbale_assemblea", "bilancio", "generico"],
+    "bilancio": ["bilancio", "verbale_assemblea", "visura", "generico"],
+    "ripianamento": ["verbale_assemblea", "bilancio", "generico"],
+    "assemblea": ["verbale_assemblea", "generico"],
+    "documenti_riconoscimento": ["riconoscimento"],
+    "contratti": ["contratto", "generico"],
+    "fatture": ["fattura", "generico"],
+    "irregolarita": ["generico", "verbale_assemblea"],
+    "documenti_riferimento": ["generico", "verbale_assemblea", "contratto", "statuto"],
+}
+DEFAULT_PRIORITY = _COMPANY + ["riconoscimento"]
+
+# Priorità specifiche di singoli campi (prevalgono su quella della categoria)
+FIELD_PRIORITY: Dict[str, List[str]] = {
+    "capitale_sociale": ["visura", "statuto", "bilancio", "verbale_assemblea"],
+    "soci": ["visura", "verbale_assemblea", "statuto"],
+    "presenti": ["verbale_assemblea"],
+}
+
+
+def _field_priority_overrides() -> Dict[str, List[str]]:
+    """MERGE_FIELD_PRIORITY as {campo: [tipi]}; an invalid value is ignored with a warning"""
+    raw = os.environ.get("MERGE_FIELD_PRIORITY", "{}")
+    try:
+        overrides = json.loads(raw)
+        if not isinstance(overrides, dict) or not all(
+                isinstance(types, list) and all(isinstance(name, str) for name in types)
+                for types in overrides.values()):
+            raise ValueError("atteso un oggetto {campo: [tipi di documento]}")
+    except ValueError as e:
+        print(f"Warning: MERGE_FIELD_PRIORITY non valido, uso le priorità predefinite: {e}")
+        return {}
+    return overrides
+
+
+FIELD_PRIORITY.update(_field_priority_overrides())
+
+# Nomi con cui i processor estraggono i campi richiesti dai template
+FIELD_ALIASES: Dict[str, List[str]] = {
+    "capitale_sociale": ["capitale_sociale_totale_str", "capitale_nominale_str", "capitale_deliberato"],
+    "data_assemblea": ["data_assemblea_str"],
+    "ordine_giorno": ["ordine_del_giorno_raw", "punti_ordine_giorno"],
+    "presenti": ["soci_presenti_raw"],
+}
+
+
+class MergedField(NamedTuple):
+    """Provenienza di un campo combinato"""
+    value: Any
+    source_document: str
+    document_type: str
+    rule: str
+    alternatives: int
+
+
+def _has_value(value: Any) -> bool:
+    if isinstance(value, (list, dict)):
+        return bool(value)
+    return value is not None and str(value).strip() != ""
+
+
+class MergeEngine:
+    """Rule-based merge of processed documents into the fields required by a template"""
+
+    def __init__(self, field_priority: Optional[Dict[str, List[str]]] = None,
+                 category_priority: Optional[Dict[str, List[str]]] = None):
+        self.field_priority = {**FIELD_PRIORITY, **(field_priority or {})}
+        self.category_priority = {**CATEGORY_PRIORITY, **(category_priority or {})}
+
+    def priority_for(self, field: str, category: Optional[str] = None) -> List[str]:
+        """Document types in decreasing authority for a field"""
+        return self.field_priority.get(field) or self.category_priority.get(category) or DEFAULT_PRIORITY
+
+    def candidates(self, documents: List[Dict[str, Any]], field: str,
+                   category: Optional[str] = None) -> List[Tuple[Any, Dict[str, Any]]]:
+        """(value, document) pairs for a field, most authoritative first (upload order on ties)"""
+        priority = self.priority_for(field, category)
+        found = []
+        for position, document in enumerate(documents):
+            info = document.get("extracted_info") or {}
+            for name in [field] + FIELD_ALIASES.get(field, []):
+                if _has_value(info.get(name)):
+                    document_type = document.get("document_type", "")
+                    rank = priority.index(document_type) if document_type in priority else len(priority)
+                    found.append((rank, position, info[name], document))
+                    break
+        found.sort(key=lambda item: (item[0], item[1]))
+        return [(value, document) for _, _, value, document in found]
+
+    def merge(self, documents: List[Dict[str, Any]], requirements: Dict[str, List[str]],
+              resolutions: Optional[Dict[str, Dict[str, Any]]] = None
+              ) -> Tuple[Dict[str, Any], Dict[str, MergedField], List[str]]:
+        """Merge documents into the required fields.
+
+        Returns (merged data, provenance per field, fields with no source). A field listed
+        in several categories (e.g. codice_fiscale) is decided by the first one.
+        """
+        resolutions = resolutions or {}
+        merged: Dict[str, Any] = {}
+        provenance: Dict[str, MergedField] = {}
+        undecided: List[str] = []
+
+        for category, fields in requirements.items():
+            for field in fields:
+                if field in merged or field in undecided:
+                    continue
+                candidates = self.candidates(documents, field, category)
+
+                resolution = resolutions.get(field)
+                if resolution is not None:
+                    rule = RULE_AUTO_RESOLUTION if resolution.get("resolution_type") == "auto" else RULE_USER_RESOLUTION
+                    source = resolution.get("source", "")
+                    document_type = next((document.get("document_type", "") for _, document in candidates
+                                          if document.get("file_name") == source), "")
+                    merged[field] = resolution.get("value", "")
+                    provenance[field] = MergedField(merged[field], source, document_type, rule, len(candidates))
+                elif candidates:
+                    value, document = candidates[0]
+                    merged[field] = value
+                    provenance[field] = MergedField(value, document.get("file_name", ""),
+                                                    document.get("document_type", ""), RULE_SOURCE_PRIORITY,
+                                                    len(candidates) - 1)
+                else:
+                    undecided.append(field)
+
+        for field in undecided:
+            merged[field] = ""
+        return merged, provenance, undecided
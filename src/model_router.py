@@ -0,0 +1,201 @@
+"""
+Scelta del modello di chat e di max_tokens in base alla complessità della richiesta.
+
+Una carta d'identità di una pagina e uno statuto di 40 pagine usavano lo stesso
+modello. Il router assegna ogni estrazione a un livello in base ai token del
+testo e al numero di campi richiesti:
+
+- light: testi brevi con pochi campi (documenti di identità, fatture semplici);
+- standard: il caso comune;
+- heavy: testi lunghi o schemi con molti campi.
+
+max_tokens è stimato dal numero di campi, entro il tetto del livello; sale al
+tetto del livello quando la richiesta è stata spostata a un livello superiore
+o quando le risposte recenti vengono troncate (più di
+MODEL_ROUTER_MAX_TRUNCATION_RATE), altrimenti il troncamento si ripeterebbe
+uguale su ogni livello. Per ogni
+tipo di documento e livello vengono registrati latenza, token (da
+chat_response.usage), esito e risposte troncate (get_stats). Se un livello ha
+un tasso di successo inferiore a MODEL_ROUTER_MIN_SUCCESS_RATE su almeno
+MODEL_ROUTER_MIN_SAMPLES chiamate, quel tipo di documento passa al livello
+superiore.
+
+Variabili d'ambiente: MODEL_ROUTING (0 = sempre il livello standard),
+MODEL_ROUTE_LIGHT, MODEL_ROUTE_STANDARD, MODEL_ROUTE_HEAVY,
+MODEL_ROUTER_LIGHT_MAX_TOKENS, MODEL_ROUTER_LIGHT_MAX_FIELDS,
+MODEL_ROUTER_HEAVY_MIN_TOKENS, MODEL_ROUTER_HEAVY_MIN_FIELDS,
+MODEL_ROUTER_MIN_SUCCESS_RATE, MODEL_ROUTER_MIN_SAMPLES,
+MODEL_ROUTER_MAX_TRUNCATION_RATE.
+"""
+
+from collections import deque
+import math
+import os
+import threading
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+ROUTING_ENABLED = os.environ.get("MODEL_ROUTING", "1") != "0"
+
+LIGHT, STANDARD, HEAVY = "light", "standard", "heavy"
+TIERS = (LIGHT, STANDARD, HEAVY)
+
+MODELS = {
+    LIGHT: os.environ.get("MODEL_ROUTE_LIGHT", "ministral-8b-latest"),
+    STANDARD: os.environ.get("MODEL_ROUTE_STANDARD", "mistral-small-latest"),
+    HEAVY: os.environ.get("MODEL_ROUTE_HEAVY", "mistral-medium-latest"),
+}
+# Tetto di max_tokens per livello
+MAX_COMPLETION_TOKENS = {LIGHT: 1024, STANDARD: 4096, HEAVY: 8192}
+MIN_COMPLETION_TOKENS = 512
+TOKENS_PER_FIELD = 100
+
+# Soglie di complessità (token del testo, campi richiesti)
+LIGHT_MAX_TOKENS = int(os.environ.get("MODEL_ROUTER_LIGHT_MAX_TOKENS", "1500"))
+LIGHT_MAX_FIELDS = int(os.environ.get("MODEL_ROUTER_LIGHT_MAX_FIELDS", "15"))
+HEAVY_MIN_TOKENS = int(os.environ.get("MODEL_ROUTER_HEAVY_MIN_TOKENS", "12000"))
+HEAVY_MIN_FIELDS = int(os.environ.get("MODEL_ROUTER_HEAVY_MIN_FIELDS", "40"))
+
+# Escalation al livello superiore quando la qualità osservata è insufficiente
+MIN_SUCCESS_RATE = float(os.environ.get("MODEL_ROUTER_MIN_SUCCESS_RATE", "0.8"))
+MIN_SAMPLES = int(os.environ.get("MODEL_ROUTER_MIN_SAMPLES", "10"))
+OUTCOME_WINDOW = 50
+# Quota di risposte troncate (finestra recente) oltre la quale si usa il tetto di max_tokens del livello
+MAX_TRUNCATION_RATE = float(os.environ.get("MODEL_ROUTER_MAX_TRUNCATION_RATE", "0.1"))
+
+
+class Route(NamedTuple):
+    """Modello e max_tokens scelti per una richiesta"""
+    tier: str
+    model: str
+    max_tokens: int
+
+
+class RouteStats:
+    """Telemetria di un livello per un tipo di documento"""
+
+    def __init__(self):
+        self.outcomes: Deque[bool] = deque(maxlen=OUTCOME_WINDOW)
+        self.latencies: Deque[float] = deque(maxlen=OUTCOME_WINDOW)
+        self.truncations: Deque[bool] = deque(maxlen=OUTCOME_WINDOW)
+        self.calls = 0
+        self.successes = 0
+        self.truncated = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def success_rate(self) -> Optional[float]:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else None
+
+    def truncation_rate(self) -> Optional[float]:
+        return sum(self.truncations) / len(self.truncations) if self.truncations else None
+
+    def p95(self) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+
+class ModelRouter:
+    """Complexity-based choice of chat model and max_tokens, with per-route telemetry"""
+
+    def __init__(self, enabled: bool = ROUTING_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], RouteStats] = {}
+
+    def base_tier(self, text_tokens: int, field_count: int) -> str:
+        """Tier from complexity alone (before quality-based escalation)"""
+        if not self.enabled:
+            return STANDARD
+        if text_tokens >= HEAVY_MIN_TOKENS or field_count >= HEAVY_MIN_FIELDS:
+            return HEAVY
+        if text_tokens <= LIGHT_MAX_TOKENS and field_count <= LIGHT_MAX_FIELDS:
+            return LIGHT
+        return STANDARD
+
+    def _underperforming(self, document_type: str, tier: str) -> bool:
+        stats = self._stats.get((document_type, tier))
+        return (stats is not None and len(stats.outcomes) >= MIN_SAMPLES
+                and stats.success_rate() < MIN_SUCCESS_RATE)
+
+    def _truncating(self, document_type: str, tier: str) -> bool:
+        stats = self._stats.get((document_type, tier))
+        rate = stats.truncation_rate() if stats is not None else None
+        return rate is not None and rate > MAX_TRUNCATION_RATE
+
+    def choose(self, document_type: str, text_tokens: int, field_count: int) -> Route:
+        """Route for an extraction of field_count fields from a text of text_tokens tokens"""
+        base_tier = tier = self.base_tier(text_tokens, field_count)
+        truncating = False
+        if self.enabled:
+            with self._lock:
+                while tier != HEAVY and self._underperforming(document_type, tier):
+                    tier = TIERS[TIERS.index(tier) + 1]
+                truncating = self._truncating(document_type, tier)
+        if tier != base_tier or truncating:
+            # Le risposte troncate sono tra le cause dell'escalation: servono più token, non solo un altro modello
+            max_tokens = MAX_COMPLETION_TOKENS[tier]
+        else:
+            max_tokens = min(MAX_COMPLETION_TOKENS[tier], max(MIN_COMPLETION_TOKENS, field_count * TOKENS_PER_FIELD))
+        return Route(tier, MODELS[tier], max_tokens)
+
+    def record(self, document_type: str, route: Route, latency: float, chat_response: Any, success: bool):
+        """Record the outcome of a routed call (cached responses are not API calls and are ignored)"""
+        if getattr(chat_response, "cached", False):
+            return
+        usage = getattr(chat_response, "usage", None)
+        choices = getattr(chat_response, "choices", None) or []
+        truncated = bool(choices) and getattr(choices[0], "finish_reason", None) == "length"
+        with self._lock:
+            stats = self._stats.setdefault((document_type, route.tier), RouteStats())
+            stats.calls += 1
+            stats.latencies.append(latency)
+            # Una risposta troncata da max_tokens non è un successo, anche se il JSON è recuperabile
+            ok = success and not truncated
+            stats.outcomes.append(ok)
+            stats.successes += ok
+            stats.truncated += truncated
+            stats.truncations.append(truncated)
+            stats.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+            stats.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+    def record_failure(self, document_type: str, route: Route, latency: float):
+        """Record a routed call that raised (timeout, API error)"""
+        with self._lock:
+            stats = self._stats.setdefault((document_type, route.tier), RouteStats())
+            stats.calls += 1
+            stats.latencies.append(latency)
+            stats.outcomes.append(False)
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = []
+            for (document_type, tier), stats in sorted(self._stats.items()):
+                rows.append({
+                    "document_type": document_type,
+                    "tier": tier,
+                    "model": MODELS[tier],
+                    "calls": stats.calls,
+                    "success_rate": stats.success_rate(),
+                    "average_latency": sum(stats.latencies) / len(stats.latencies) if stats.latencies else None,
+                    "p95_latency": stats.p95(),
+                    "average_prompt_tokens": stats.prompt_tokens / stats.calls if stats.calls else 0,
+                    "average_completion_tokens": stats.completion_tokens / stats.calls if stats.calls else 0,
+                    "truncated": stats.truncated,
+                    "escalated": self._underperforming(document_type, tier),
+                })
+            return rows
+
+
+_model_router = None
+_model_router_lock = threading.Lock()
+
+
+def get_model_router() -> ModelRouter:
+    """Router condiviso da tutte le sessioni del processo"""
+    global _model_router
+    with _model_router_lock:
+        if _model_router is None:
+            _model_router = ModelRouter()
+        return _model_router
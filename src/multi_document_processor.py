@@ -1,142 +1,411 @@
 from typing import Dict, List, Any, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
 from mistralai import Mistral
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import copy
 import json
 from typing import Dict, Any
-from document_processors import DocumentProcessorFactory
+from document_processors import DocumentProcessorFactory, take_pages
+from llm_cache import cached_chat_complete, contains_json_object
+from json_utils import json_schema_response_format, parse_json_object
+from resilience import get_resilience
+from rate_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from conflict_engine import ConflictIndex, FieldConflict
+from merge_engine import LLM_FALLBACK, RULE_LLM_FALLBACK, MergedField, MergeEngine
+from prompt_builder import PromptBuilder, PromptStats
+from document_classifier import Classification, get_document_classifier, pdf_text_pages, text_pages
+from document_fingerprint import DEDUP_ENABLED, content_hash, is_near_duplicate, text_sketch
+from document_store import RESTORE_ENABLED, StoredDocument, get_document_store, is_valid_session_id, new_session_id
+
+# Timeout minimo delle chiamate di analisi e combinazione (prompt con tutti i documenti)
+COMBINATION_TIMEOUT = 60
+
+# Documenti elaborati contemporaneamente dal caricamento multiplo
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+
+# Campi dei dati combinati che devono essere liste
+LIST_FIELDS = ['soci', 'amministratori', 'sindaci', 'righe_fattura', 'note', 'clausole_principali', 'articoli_chiave', 'poteri_amministratori']
+
+# Elementi degli elenchi nella risposta di combinazione (gli altri elenchi sono di stringhe)
+COMBINATION_LIST_ITEMS = {
+    "soci": {"nome": "", "quota_percentuale": "", "quota_euro": "", "presente": False},
+    "amministratori": {"nome": "", "carica": "", "presente": False},
+    "sindaci": {"nome": "", "carica": "", "presente": False},
+    "righe_fattura": {"descrizione": "", "quantita": "", "prezzo_unitario": "", "totale": ""},
+}
+
+RECOMMENDATIONS_RESPONSE_FORMAT = json_schema_response_format(
+    "conflict_recommendations", {"recommendations": []},
+    {"recommendations": ["field_name", "recommended_value", "reason"]}
+)
+
+
+def combination_response_format(fields: List[str]) -> Dict[str, Any]:
+    """Response schema for the combination fallback, restricted to the requested fields"""
+    structure = {}
+    for field in fields:
+        if field in COMBINATION_LIST_ITEMS:
+            structure[field] = [COMBINATION_LIST_ITEMS[field]]
+        else:
+            structure[field] = [] if field in LIST_FIELDS else ""
+    return json_schema_response_format("combination", structure)
+
 
 class MultiDocumentProcessor:
     """Processor for handling multiple documents and combining their information"""
     
-    def __init__(self, mistral_client: Mistral):
+    def __init__(self, mistral_client: Mistral, session_id: Optional[str] = None):
         self.client = mistral_client
+        # Testo e dati estratti vivono nell'archivio; processed_documents contiene solo i riferimenti
+        self.session_id = session_id if is_valid_session_id(session_id) else new_session_id()
+        self.document_store = get_document_store()
+        self._next_position = 0
         self.processed_documents = []
         self.combined_info = {}
+        self.combined_provenance: Dict[str, MergedField] = {}  # Fonte e regola di ogni campo combinato
         self.resolved_conflicts = {}  # Store user-resolved conflicts
+        self.auto_resolved_conflicts = {}  # Differenze risolte dal confronto locale
+        # Valori dei campi indicizzati per documento: i conflitti si aggiornano solo per i documenti cambiati
+        self.conflict_index = ConflictIndex()
+        self._conflict_analysis: Optional[Tuple[int, Dict[str, Any]]] = None
+        # Quasi duplicati calcolati dalle impronte, per la lista di documenti corrente
+        self._duplicates: Optional[Tuple[Tuple[int, ...], Dict[int, Any]]] = None
     
     def process_document(self, file_bytes: bytes, file_name: str, document_type: str) -> Dict[str, Any]:
         """Process a single document and extract information"""
         try:
-            # Create processor for the document type
-            processor = DocumentProcessorFactory.create_processor(document_type, self.client)
-            
-            # Extract text based on file type
-            if file_name.lower().endswith('.pdf'):
-                pypdf2_text, ocr_text = processor.extract_text_from_pdf(file_bytes)
-                # Use OCR text if available, fallback to PyPDF2
-                document_text = ocr_text if ocr_text else pypdf2_text
-            else:
-                # Assume text file
-                document_text = file_bytes.decode('utf-8')
-            
-            # Extract information
-            if file_name.lower().endswith('.pdf'):
-                extracted_info = processor.extract_information(document_text, pdf_bytes=file_bytes)
-            else:
-                extracted_info = processor.extract_information(document_text)
-            
-            # Store processed document
-            doc_info = {
-                'file_name': file_name,
-                'document_type': document_type,
-                'extracted_info': extracted_info,
-                'text_content': document_text
-            }
-            
-            self.processed_documents.append(doc_info)
-            return extracted_info
+            file_hash = content_hash(file_bytes)
+            existing = self._find_exact_duplicate(file_hash, document_type)
+            if existing is not None:
+                st.info(f"♻️ {file_name} è identico a {existing['file_name']}, già elaborato: riuso i dati estratti")
+                return existing['extracted_info']
+            doc_info = self._add_document(self._extract_document(file_bytes, file_name, document_type,
+                                                                 file_hash=file_hash))
+            return doc_info['extracted_info']
             
         except Exception as e:
             st.error(f"Errore nel processare {file_name}: {e}")
             return {}
     
+    def process_documents(self, files: List[Tuple[bytes, str, str]],
+                          max_concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Process (file_bytes, file_name, document_type) tuples concurrently.
+        
+        Each file gets a status box with its progress and messages; processed_documents
+        is extended in upload order once all files are done. Exact duplicates (of a
+        processed document or of an earlier file in the batch) are not processed again.
+        Returns the extracted info of each file, in upload order ({} for files that failed).
+        """
+        if not files:
+            return []
+        
+        progress = st.progress(0.0, text=f"📦 Elaborazione di {len(files)} documenti...")
+        statuses = [st.status(f"⏳ {file_name}: in attesa", expanded=False) for _, file_name, _ in files]
+        
+        hashes = [content_hash(file_bytes) for file_bytes, _, _ in files]
+        known: Dict[int, Any] = {}  # indice -> documento già elaborato identico
+        repeats: Dict[int, int] = {}  # indice -> primo file identico dello stesso caricamento
+        first_seen: Dict[Tuple[str, str], int] = {}
+        for index, (file_hash, (_, file_name, document_type)) in enumerate(zip(hashes, files)):
+            existing = self._find_exact_duplicate(file_hash, document_type)
+            if existing is not None:
+                known[index] = existing
+                statuses[index].update(label=f"♻️ {file_name}: identico a {existing['file_name']}, già elaborato",
+                                       state="complete")
+            elif DEDUP_ENABLED and (file_hash, document_type) in first_seen:
+                repeats[index] = first_seen[(file_hash, document_type)]
+                statuses[index].update(label=f"♻️ {file_name}: identico a {files[repeats[index]][1]}",
+                                       state="complete")
+            else:
+                first_seen[(file_hash, document_type)] = index
+        to_process = [index for index in range(len(files)) if index not in known and index not in repeats]
+        
+        # I processor mostrano messaggi Streamlit: i thread del batch ricevono il contesto della
+        # sessione e scrivono ciascuno nel proprio riquadro (lo stack dei contenitori è per thread)
+        ctx = get_script_run_ctx()
+        
+        def run(index: int) -> Dict[str, Any]:
+            if ctx is not None:
+                add_script_run_ctx(ctx=ctx)
+            file_bytes, file_name, document_type = files[index]
+            statuses[index].update(label=f"🔄 {file_name}: elaborazione...", state="running")
+            with statuses[index]:
+                return self._extract_document(file_bytes, file_name, document_type, priority=PRIORITY_BATCH,
+                                              file_hash=hashes[index])
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(files)
+        workers = max(1, min(max_concurrency or BATCH_CONCURRENCY, len(to_process) or 1))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-ingest") as executor:
+            futures = {executor.submit(run, index): index for index in to_process}
+            for done, future in enumerate(as_completed(futures), len(files) - len(to_process) + 1):
+                index = futures[future]
+                file_name = files[index][1]
+                try:
+                    results[index] = future.result()
+                    filled = len([value for value in results[index]['extracted_info'].values() if value])
+                    statuses[index].update(label=f"✅ {file_name}: {filled} campi estratti", state="complete")
+                except Exception as e:
+                    statuses[index].update(label=f"❌ {file_name}: errore", state="error")
+                    statuses[index].error(f"Errore nel processare {file_name}: {e}")
+                progress.progress(done / len(files), text=f"📦 {done}/{len(files)} documenti elaborati")
+        
+        for index in to_process:
+            if results[index] is not None:
+                results[index] = self._add_document(results[index])
+        for index, first in repeats.items():
+            results[index] = results[first]
+        for index, existing in known.items():
+            results[index] = existing
+        return [doc_info['extracted_info'] if doc_info is not None else {} for doc_info in results]
+    
+    def _add_document(self, doc_info: Dict[str, Any]) -> Dict[str, Any]:
+        """Save a processed document in the store, keep its handle and index its values"""
+        if self.document_store is not None:
+            doc_info = self.document_store.store_document(self.session_id, doc_info, self._next_position)
+        self._next_position += 1
+        self.processed_documents.append(doc_info)
+        if id(doc_info) not in self.get_duplicates():
+            self.conflict_index.add_document(doc_info)
+        return doc_info
+    
+    def restore_documents(self) -> int:
+        """Reload the documents this session saved in the store (e.g. after a page reload; DOCUMENT_STORE_RESTORE=1)"""
+        if not RESTORE_ENABLED or self.document_store is None or self.processed_documents:
+            return 0
+        self.processed_documents = self.document_store.restore_documents(self.session_id)
+        self.conflict_index.sync(self._unique_documents())
+        self._next_position = max((handle.position for handle in self.processed_documents), default=-1) + 1
+        return len(self.processed_documents)
+    
+    def _find_exact_duplicate(self, file_hash: str, document_type: str) -> Optional[Dict[str, Any]]:
+        """Processed document of the same type with identical file bytes"""
+        if not DEDUP_ENABLED:
+            return None
+        return next((doc for doc in self.processed_documents
+                     if doc.get('content_hash') == file_hash and doc['document_type'] == document_type), None)
+    
+    def _find_near_duplicate(self, sketch: List[int], document_type: str) -> Optional[Dict[str, Any]]:
+        """First processed document of the same type whose text is a near-duplicate of sketch"""
+        if not DEDUP_ENABLED or not sketch:
+            return None
+        return next((doc for doc in self.processed_documents
+                     if doc['document_type'] == document_type and is_near_duplicate(sketch, doc.get('text_sketch') or [])),
+                    None)
+    
+    def _reuse_near_duplicate(self, sketch: List[int], file_name: str, document_type: str,
+                              annotation_future=None) -> Optional[Dict[str, Any]]:
+        """Extracted info of a near-duplicate already processed (the new extraction is skipped), or None"""
+        original = self._find_near_duplicate(sketch, document_type)
+        if original is None:
+            return None
+        if annotation_future is not None:
+            annotation_future.cancel()
+        st.info(f"♻️ {file_name} è quasi identico a {original['file_name']} (stesso documento riscansionato?): "
+                f"riuso i dati estratti")
+        return copy.deepcopy(original['extracted_info'])
+    
+    def get_duplicates(self) -> Dict[int, Any]:
+        """id() of each processed document that near-duplicates an earlier one -> that earlier document"""
+        key = tuple(id(doc) for doc in self.processed_documents)
+        if self._duplicates is None or self._duplicates[0] != key:
+            duplicates = {}
+            originals = []
+            for doc in self.processed_documents:
+                sketch = doc.get('text_sketch') or []
+                original = next((other for other in originals if other['document_type'] == doc['document_type']
+                                 and is_near_duplicate(sketch, other.get('text_sketch') or [])),
+                                None) if DEDUP_ENABLED else None
+                if original is None:
+                    originals.append(doc)
+                else:
+                    duplicates[id(doc)] = original
+            self._duplicates = (key, duplicates)
+        return self._duplicates[1]
+    
+    def duplicate_of(self, doc: Dict[str, Any]) -> Optional[str]:
+        """File name of the document doc duplicates, if any"""
+        original = self.get_duplicates().get(id(doc))
+        return original['file_name'] if original is not None else None
+    
+    def _unique_documents(self) -> List[Dict[str, Any]]:
+        """Processed documents without near-duplicates: a copy would count as a second source"""
+        duplicates = self.get_duplicates()
+        return [doc for doc in self.processed_documents if id(doc) not in duplicates]
+    
+    def _extract_document(self, file_bytes: bytes, file_name: str, document_type: str,
+                          priority: Optional[int] = None, file_hash: Optional[str] = None) -> Dict[str, Any]:
+        """Extract text and information from one document; returns its processed_documents entry.
+        
+        When the text turns out to be a near-duplicate of a processed document of the same
+        type, its extracted info is reused instead of calling the model again.
+        """
+        # Create processor for the document type
+        processor = DocumentProcessorFactory.create_processor(document_type, self.client)
+        if priority is not None:
+            processor.api_priority = priority
+        
+        # Scanned identity documents are shrunk before upload; image uploads get their MIME type
+        file_bytes, image_mime = processor.preprocess_input(file_bytes, file_name)
+        
+        # Extract text and information based on file type
+        if image_mime is not None:
+            # Images are sent inline to OCR; Document Annotation always runs in the background
+            annotation_future = processor.start_structured_extraction(file_bytes, image_mime=image_mime)
+            pages = processor.extract_pages_from_image(file_bytes, image_mime)
+            document_text = processor.pages_to_text(pages)
+            sketch = text_sketch(document_text)
+            extracted_info = (self._reuse_near_duplicate(sketch, file_name, document_type, annotation_future)
+                              or processor.extract_information(document_text, annotation_future=annotation_future))
+        elif file_name.lower().endswith('.pdf') and processor.async_pipeline:
+            # Same pipeline on the shared event loop, with real request cancellation on timeout
+            # La pipeline async estrae subito: un quasi duplicato viene solo segnalato
+            document_text, extracted_info = processor.process_pdf(file_bytes)
+            sketch = text_sketch(document_text)
+        elif file_name.lower().endswith('.pdf'):
+            # One upload shared by OCR and Document Annotation, deleted when extraction ends
+            with processor.upload_session.retain(file_bytes):
+                # Document Annotation overlaps text-layer parsing and OCR, results are joined below
+                annotation_future = None
+                if processor.concurrent_extraction:
+                    annotation_future = processor.start_structured_extraction(file_bytes)
+                # Merged pages streamed in order (text layer where readable, OCR only where needed);
+                # processors with a text budget stop reading once they have enough
+                pages = take_pages(processor.iter_pdf_pages(file_bytes), processor.max_text_chars)
+                document_text = processor.pages_to_text(pages)
+                sketch = text_sketch(document_text)
+                extracted_info = (self._reuse_near_duplicate(sketch, file_name, document_type, annotation_future)
+                                  or processor.extract_information(document_text, pdf_bytes=file_bytes,
+                                                                   annotation_future=annotation_future))
+        else:
+            # Assume text file
+            document_text = file_bytes.decode('utf-8')
+            sketch = text_sketch(document_text)
+            extracted_info = (self._reuse_near_duplicate(sketch, file_name, document_type)
+                              or processor.extract_information(document_text))
+        
+        return {
+            'file_name': file_name,
+            'document_type': document_type,
+            'extracted_info': extracted_info,
+            'text_content': document_text,
+            'content_hash': file_hash or content_hash(file_bytes),
+            'text_sketch': sketch,
+        }
+    
+    def _complete_json(self, prompt: str, response_format: Dict[str, Any],
+                       temperature: float = 0) -> Optional[Dict[str, Any]]:
+        """Schema-constrained chat completion with the shared retry policy; returns the parsed object or None"""
+        def make_api_call(timeout):
+            return cached_chat_complete(
+                self.client,
+                model="mistral-small-latest",
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                response_format=response_format,
+                validate=contains_json_object,
+                priority=PRIORITY_INTERACTIVE,
+                timeout_ms=int(timeout * 1000)
+            )
+        
+        def parse(chat_response):
+            # Tolerant of truncated output
+            return parse_json_object(chat_response.choices[0].message.content or "")
+        
+        chat_response = get_resilience().call(
+            make_api_call, "chat", COMBINATION_TIMEOUT, min_timeout=COMBINATION_TIMEOUT,
+            accept=lambda response: parse(response) is not None
+        )
+        return parse(chat_response)
+    
     def analyze_conflicts_with_ai(self) -> Dict[str, Any]:
-        """Use Mistral AI to intelligently analyze conflicts between documents"""
-        if len(self.processed_documents) < 2:
+        """Detect conflicts locally; only the ambiguous ones are sent to Mistral AI for a recommendation"""
+        documents = self._unique_documents()
+        if len(documents) < 2:
             return {"conflicts": [], "analysis": "Nessun conflitto: meno di 2 documenti processati"}
         
-        # Prepare document summaries for AI analysis
-        docs_summary = []
-        for i, doc in enumerate(self.processed_documents, 1):
-            docs_summary.append(f"""
-DOCUMENTO {i}: {doc['file_name']} (Tipo: {doc['document_type']})
-Informazioni estratte:
-{json.dumps(doc['extracted_info'], indent=2, ensure_ascii=False)}
-""")
-        
-        analysis_prompt = f"""
-Analizza i seguenti {len(self.processed_documents)} documenti e identifica TUTTI i conflitti o discrepanze tra le informazioni estratte.
-
-DOCUMENTI DA ANALIZZARE:
-{"".join(docs_summary)}
-
-ISTRUZIONI PER L'ANALISI:
-1. Confronta TUTTI i campi simili tra i documenti
-2. Identifica conflitti evidenti (valori diversi per lo stesso campo)
-3. Segnala discrepanze sospette (es: nomi simili ma non identici)
-4. Assegna un livello di confidenza per ogni conflitto (ALTO, MEDIO, BASSO)
-5. Suggerisci quale valore potrebbe essere corretto e perché
+        detected = self.conflict_index.sync(documents)
+        # Stessi documenti dell'ultima analisi: nessun nuovo confronto né chiamata AI
+        if self._conflict_analysis is not None and self._conflict_analysis[0] == self.conflict_index.version:
+            return self._conflict_analysis[1]
+        
+        ambiguous = [conflict for conflict in detected if conflict.ambiguous]
+        auto_resolved = [conflict for conflict in detected if not conflict.ambiguous]
+        
+        self.auto_resolved_conflicts = {
+            conflict.field_name: {
+                "value": conflict.recommended.value,
+                "source": conflict.recommended.source_document,
+                "resolution_type": "auto"
+            }
+            for conflict in auto_resolved
+        }
+        
+        summary = (f"Confronto locale: {len(auto_resolved)} differenze risolte automaticamente, "
+                   f"{len(ambiguous)} conflitti da verificare.")
+        if ambiguous:
+            try:
+                if self._recommend_with_ai(ambiguous):
+                    summary += " Raccomandazioni AI richieste solo per i conflitti ambigui."
+            except Exception as e:
+                st.error(f"Errore nell'analisi AI dei conflitti: {e}")
+        
+        analysis = {
+            "conflicts": [conflict.to_dict() for conflict in ambiguous],
+            "auto_resolved": [conflict.to_dict() for conflict in auto_resolved],
+            "summary": summary
+        }
+        self._conflict_analysis = (self.conflict_index.version, analysis)
+        return analysis
+    
+    def _recommend_with_ai(self, conflicts: List[FieldConflict]) -> bool:
+        """Ask the model which value is correct for each ambiguous conflict (compact prompt)"""
+        lines = []
+        for i, conflict in enumerate(conflicts, 1):
+            values = " | ".join(f'"{value.value}" ({value.document_type}: {value.source_document})'
+                                for value in conflict.values)
+            lines.append(f"{i}. {conflict.field_name}: {values}")
+        
+        prompt = f"""
+Questi campi hanno valori diversi in documenti aziendali diversi. Per ciascuno indica il valore più probabilmente corretto, considerando il tipo di documento di provenienza.
 
-CAMPI DA CONTROLLARE PRIORITARIAMENTE:
-- Denominazione/Nome azienda o persona
-- Codice Fiscale/Partita IVA
-- Indirizzi e sedi legali
-- Date (nascita, costituzione, etc.)
-- Numeri di documento
-- Importi e valori numerici
-- Nomi di persone (amministratori, soci, etc.)
+CONFLITTI:
+{chr(10).join(lines)}
 
-FORMATO OUTPUT:
-Rispondi SOLO con un JSON nel seguente formato:
-{{
-  "conflicts": [
-    {{
-      "field_name": "nome_campo",
-      "conflict_type": "VALORE_DIVERSO|FORMATO_DIVERSO|MISSING_VALUE",
-      "confidence_level": "ALTO|MEDIO|BASSO",
-      "description": "Descrizione del conflitto",
-      "values": [
-        {{
-          "value": "valore_trovato",
-          "source_document": "nome_file",
-          "document_type": "tipo_documento",
-          "confidence": "perché questo valore potrebbe essere corretto"
-        }}
-      ],
-      "ai_recommendation": "quale valore raccomandi e perché"
-    }}
-  ],
-  "summary": "Riassunto generale dell'analisi"
-}}
+Rispondi SOLO con un JSON nel formato:
+{{"recommendations": [{{"field_name": "nome_campo", "recommended_value": "valore", "reason": "motivazione breve"}}]}}
 """
-        
-        try:
-            messages = [{"role": "user", "content": analysis_prompt}]
-            chat_response = self.client.chat.complete(
-                model="mistral-small-latest",
-                messages=messages,
-                temperature=0.1
-            )
-            
-            response_text = chat_response.choices[0].message.content
-            
-            # Extract JSON from response
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}')
-            
-            if json_start != -1 and json_end != -1:
-                json_string = response_text[json_start:json_end + 1]
-                return json.loads(json_string)
-            else:
-                return {"conflicts": [], "analysis": "Errore nell'analisi AI: formato risposta non valido"}
-                
-        except Exception as e:
-            st.error(f"Errore nell'analisi AI dei conflitti: {e}")
-            return {"conflicts": [], "analysis": f"Errore: {str(e)}"}
+        analysis = self._complete_json(prompt, RECOMMENDATIONS_RESPONSE_FORMAT, temperature=0.1)
+        if analysis is None:
+            return False
+        
+        by_name = {conflict.field_name: conflict for conflict in conflicts}
+        for recommendation in analysis.get("recommendations", []):
+            if not isinstance(recommendation, dict):
+                continue
+            conflict = by_name.get(recommendation.get("field_name"))
+            if conflict is None:
+                continue
+            value = recommendation.get("recommended_value")
+            conflict.ai_recommendation = f"{value} - {recommendation.get('reason', '')}".strip(" -")
+            # Il valore raccomandato diventa quello proposto dal modello, se è tra quelli dei documenti
+            candidate = conflict.find_value(value) if value is not None else None
+            if candidate is not None:
+                conflict.recommended = candidate
+        return True
 
     def display_conflict_resolution_ui(self, conflicts_analysis: Dict[str, Any]) -> Dict[str, Any]:
         """Display interactive UI for conflict resolution"""
         
+        auto_resolved = conflicts_analysis.get("auto_resolved", [])
+        if auto_resolved:
+            with st.expander(f"🤖 {len(auto_resolved)} differenze risolte automaticamente", expanded=False):
+                for conflict in auto_resolved:
+                    st.markdown(f"**{conflict['field_name']}:** `{conflict['recommended_value']}` "
+                                f"(da: {conflict['recommended_source']}, confidenza {conflict['confidence']:.0%}) "
+                                f"- {conflict['description']}")
+        
         if not conflicts_analysis.get("conflicts"):
             st.success("✅ **Nessun conflitto rilevato!** Tutti i documenti sono coerenti tra loro.")
             return {}
@@ -278,7 +547,7 @@ Rispondi SOLO con un JSON nel seguente formato:
         # Step 2: If conflicts exist, show resolution UI
         if conflicts_analysis.get("conflicts"):
             st.markdown("## 🔍 Risoluzione Conflitti")
-            st.markdown("L'AI ha rilevato alcuni conflitti tra i documenti. Per favore aiutaci a risolverli:")
+            st.markdown("Sono stati rilevati alcuni conflitti tra i documenti. Per favore aiutaci a risolverli:")
             
             resolved_conflicts = self.display_conflict_resolution_ui(conflicts_analysis)
             
@@ -287,60 +556,66 @@ Rispondi SOLO con un JSON nel seguente formato:
                 st.warning("⏳ Risolvi i conflitti sopra prima di procedere con la combinazione dei documenti.")
                 return {}
         
-        # Step 3: Combine documents using AI recommendations and user choices
-        return self._combine_with_resolutions(target_template, conflicts_analysis)
+        # Step 3: Combine documents using source priority, automatic resolutions and user choices
+        combined = self._combine_with_resolutions(target_template, conflicts_analysis)
+        
+        if self.combined_provenance:
+            with st.expander("🔎 Provenienza dei dati combinati", expanded=False):
+                for field, origin in self.combined_provenance.items():
+                    alternatives = f", {origin.alternatives} alternative" if origin.alternatives else ""
+                    st.caption(f"**{field}:** {origin.source_document or 'n/d'} "
+                               f"({origin.document_type or origin.rule}{alternatives})")
+        return combined
 
-    def _combine_with_resolutions(self, target_template: str, conflicts_analysis: Dict[str, Any]) -> Dict[str, Any]:
+    def _combine_with_resolutions(self, target_template: str, conflicts_analysis: Dict[str, Any],
+                                  use_llm_fallback: Optional[bool] = None) -> Dict[str, Any]:
         """Combine documents applying conflict resolutions"""
         
         template_requirements = self._get_template_requirements(target_template)
+        # Le scelte dell'utente prevalgono sulle risoluzioni automatiche
+        resolutions = {**self.auto_resolved_conflicts, **self.resolved_conflicts}
         
-        # Create enhanced prompt that includes conflict resolutions
-        combination_prompt = self._create_enhanced_combination_prompt(
-            template_requirements, 
-            conflicts_analysis, 
-            self.resolved_conflicts
-        )
+        def fallback_prompt(missing, projection):
+            return self._create_enhanced_combination_prompt(missing, conflicts_analysis, resolutions, projection)
         
-        try:
-            messages = [{"role": "user", "content": combination_prompt}]
-            
-            chat_response = self.client.chat.complete(
-                model="mistral-small-latest",
-                messages=messages,
-                temperature=0
-            )
-            
-            response_text = chat_response.choices[0].message.content
-            
-            # Extract JSON from response
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}')
-            
-            if json_start != -1 and json_end != -1:
-                json_string = response_text[json_start:json_end + 1]
-                self.combined_info = json.loads(json_string)
-            else:
-                st.error("Impossibile trovare un blocco JSON valido nella risposta di combinazione.")
-                
-        except Exception as e:
-            st.error(f"Errore nella combinazione dei documenti: {e}")
-            
+        return self._merge_documents(template_requirements, resolutions, fallback_prompt, use_llm_fallback)
+    
+    def _merge_documents(self, requirements: Dict[str, List[str]], resolutions: Dict[str, Dict[str, Any]],
+                         fallback_prompt, use_llm_fallback: Optional[bool] = None) -> Dict[str, Any]:
+        """Rule-based merge; the model is asked (optionally) only for the fields no document provides"""
+        merged, provenance, undecided = MergeEngine().merge(self._unique_documents(), requirements, resolutions)
+        st.info(f"🧩 Combinazione locale: {len(provenance)} campi compilati, {len(undecided)} senza fonte")
+        
+        if undecided and (LLM_FALLBACK if use_llm_fallback is None else use_llm_fallback):
+            missing = {category: [field for field in fields if field in undecided]
+                       for category, fields in requirements.items()}
+            missing = {category: fields for category, fields in missing.items() if fields}
+            try:
+                st.info(f"🤖 Richiesta AI solo per i campi senza fonte: {', '.join(undecided)}")
+                # Si chiedono solo i campi mancanti, ma i documenti restano proiettati su tutti quelli
+                # del template: sono il contesto da cui dedurli
+                completed = self._complete_json(fallback_prompt(missing, requirements),
+                                                combination_response_format(undecided))
+                if completed is None:
+                    st.error("Impossibile trovare un blocco JSON valido nella risposta di combinazione.")
+                else:
+                    for field in undecided:
+                        value = completed.get(field)
+                        if value not in (None, "", [], {}):
+                            merged[field] = value
+                            provenance[field] = MergedField(value, "Mistral AI", "", RULE_LLM_FALLBACK, 0)
+            except Exception as e:
+                st.error(f"Errore nella combinazione dei documenti: {e}")
+        
+        self.combined_info = merged
+        self.combined_provenance = provenance
         return self._validate_and_clean_combined_data(self.combined_info)
 
     def _create_enhanced_combination_prompt(self, requirements: Dict[str, List[str]], 
                                           conflicts_analysis: Dict[str, Any], 
-                                          resolved_conflicts: Dict[str, Any]) -> str:
-        """Create enhanced prompt with conflict resolutions"""
-        
-        # Prepare documents summary
-        docs_summary = []
-        for i, doc in enumerate(self.processed_documents, 1):
-            docs_summary.append(f"""
-DOCUMENTO {i}: {doc['file_name']} (Tipo: {doc['document_type']})
-Informazioni estratte:
-{json.dumps(doc['extracted_info'], indent=2, ensure_ascii=False)}
-""")
+                                          resolved_conflicts: Dict[str, Any],
+                                          projection: Optional[Dict[str, List[str]]] = None) -> str:
+        """Create enhanced prompt with conflict resolutions; documents are projected on projection (default requirements)"""
         
         # Create detailed field mapping instructions
         field_mapping_instructions = self._create_field_mapping_instructions()
@@ -357,11 +632,14 @@ Informazioni estratte:
             for field, resolution in resolved_conflicts.items():
                 resolutions_text += f"- {field}: '{resolution['value']}' (fonte: {resolution['source']})\n"
         
-        prompt = f"""
-Sei un esperto nell'estrazione e mappatura di dati aziendali. Hai a disposizione {len(self.processed_documents)} documenti processati e devi creare un set di dati strutturato per il template richiesto.
+        documents = self._unique_documents()
+        
+        def render(documents_text: str) -> str:
+            return f"""
+Sei un esperto nell'estrazione e mappatura di dati aziendali. Hai a disposizione {len(documents)} documenti processati e devi creare un set di dati strutturato per il template richiesto.
 
 DOCUMENTI DISPONIBILI:
-{"".join(docs_summary)}
+{documents_text}
 
 CAMPI RICHIESTI DAL TEMPLATE:
 {chr(10).join(req_description)}
@@ -424,6 +702,9 @@ ESEMPIO OUTPUT CORRETTO:
 Rispondi SOLO con il dizionario JSON finale, senza commenti o spiegazioni.
 """
         
+        # Documenti proiettati sui campi richiesti, entro il budget di token
+        prompt, stats = PromptBuilder(projection or requirements).build(documents, render)
+        self._show_prompt_stats(stats)
         return prompt
 
     def _create_field_mapping_instructions(self) -> str:
@@ -466,7 +747,8 @@ Rispondi SOLO con il dizionario JSON finale, senza commenti o spiegazioni.
 - data_fattura → data_fattura
 """
     
-    def combine_documents_info(self, target_template: str = "verbale_assemblea_template") -> Dict[str, Any]:
+    def combine_documents_info(self, target_template: str = "verbale_assemblea_template",
+                               use_llm_fallback: Optional[bool] = None) -> Dict[str, Any]:
         """Combine information from all processed documents for a specific template"""
         if not self.processed_documents:
             return {}
@@ -474,35 +756,10 @@ Rispondi SOLO con il dizionario JSON finale, senza commenti o spiegazioni.
         # Define what information is needed for each template
         template_requirements = self._get_template_requirements(target_template)
         
-        # Create prompt for combining information
-        combination_prompt = self._create_combination_prompt(template_requirements)
-        
-        try:
-            # Send to Mistral for intelligent combination
-            messages = [{"role": "user", "content": combination_prompt}]
-            
-            chat_response = self.client.chat.complete(
-                model="mistral-small-latest",
-                messages=messages,
-                temperature=0
-            )
-            
-            response_text = chat_response.choices[0].message.content
-            
-            # Extract JSON from response
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}')
-            
-            if json_start != -1 and json_end != -1:
-                json_string = response_text[json_start:json_end + 1]
-                self.combined_info = json.loads(json_string)
-            else:
-                st.error("Impossibile trovare un blocco JSON valido nella risposta di combinazione.")
-                
-        except Exception as e:
-            st.error(f"Errore nella combinazione dei documenti: {e}")
-            
-        return self._validate_and_clean_combined_data(self.combined_info)
+        # Regole locali con le risoluzioni già note; il prompt di combinazione serve solo come ripiego
+        return self._merge_documents(template_requirements,
+                                     {**self.auto_resolved_conflicts, **self.resolved_conflicts},
+                                     self._create_combination_prompt, use_llm_fallback)
     
     def _validate_and_clean_combined_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Valida e pulisce i dati combinati per assicurarsi che siano nel formato corretto"""
@@ -512,9 +769,7 @@ Rispondi SOLO con il dizionario JSON finale, senza commenti o spiegazioni.
         cleaned_data = data.copy()
         
         # Lista dei campi che devono essere sempre liste di dizionari
-        list_fields = ['soci', 'amministratori', 'sindaci', 'righe_fattura', 'note', 'clausole_principali', 'articoli_chiave', 'poteri_amministratori']
-        
-        for field in list_fields:
+        for field in LIST_FIELDS:
             if field in cleaned_data:
                 current_value = cleaned_data[field]
                 
@@ -523,7 +778,6 @@ Rispondi SOLO con il dizionario JSON finale, senza commenti o spiegazioni.
                     if isinstance(current_value, str):
                         # Se è una stringa, prova a parsare come JSON
                         try:
-                            import json
                             parsed = json.loads(current_value)
                             if isinstance(parsed, list):
                                 cleaned_data[field] = parsed
@@ -720,28 +974,23 @@ Rispondi SOLO con il dizionario JSON finale, senza commenti o spiegazioni.
         
         return requirements.get(template_type, {})
     
-    def _create_combination_prompt(self, requirements: Dict[str, List[str]]) -> str:
-        """Create a prompt for combining document information"""
-        
-        # Prepare documents summary
-        docs_summary = []
-        for i, doc in enumerate(self.processed_documents, 1):
-            docs_summary.append(f"""
-DOCUMENTO {i}: {doc['file_name']} (Tipo: {doc['document_type']})
-Informazioni estratte:
-{json.dumps(doc['extracted_info'], indent=2, ensure_ascii=False)}
-""")
+    def _create_combination_prompt(self, requirements: Dict[str, List[str]],
+                                   projection: Optional[Dict[str, List[str]]] = None) -> str:
+        """Create a prompt for combining document information; documents are projected on projection (default requirements)"""
         
         # Create requirements description
         req_description = []
         for category, fields in requirements.items():
             req_description.append(f"- {category}: {', '.join(fields)}")
         
-        prompt = f"""
-Hai a disposizione {len(self.processed_documents)} documenti processati. Combina le informazioni estratte per creare un unico set di dati coerente e completo.
+        documents = self._unique_documents()
+        
+        def render(documents_text: str) -> str:
+            return f"""
+Hai a disposizione {len(documents)} documenti processati. Combina le informazioni estratte per creare un unico set di dati coerente e completo.
 
 DOCUMENTI DISPONIBILI:
-{"".join(docs_summary)}
+{documents_text}
 
 INFORMAZIONI RICHIESTE PER IL TEMPLATE:
 {chr(10).join(req_description)}
@@ -775,8 +1024,16 @@ Rispondi SOLO con un dizionario JSON valido. Assicurati che:
 
 """
         
+        # Documenti proiettati sui campi richiesti, entro il budget di token
+        prompt, stats = PromptBuilder(projection or requirements).build(documents, render)
+        self._show_prompt_stats(stats)
         return prompt
     
+    @staticmethod
+    def _show_prompt_stats(stats: PromptStats):
+        dropped = f" • {stats.dropped_values} valori esclusi per il budget" if stats.dropped_values else ""
+        st.caption(f"📉 Prompt di combinazione: {stats.tokens_before:,} → {stats.tokens_after:,} token stimati{dropped}")
+    
     def get_processing_summary(self) -> Dict[str, Any]:
         """Get a summary of processed documents"""
         return {
@@ -788,42 +1045,38 @@ Rispondi SOLO con un dizionario JSON valido. Assicurati che:
     
     def clear_documents(self):
         """Clear all processed documents"""
+        if self.document_store is not None:
+            self.document_store.delete_session(self.session_id)
         self.processed_documents = []
         self.combined_info = {}
+        self.combined_provenance = {}
+        self.auto_resolved_conflicts = {}
+        self.conflict_index = ConflictIndex()
+        self._conflict_analysis = None
+    
+    def remove_document(self, file_name: str) -> bool:
+        """Remove a processed document and retract its values from the conflict index"""
+        removed = [doc for doc in self.processed_documents if doc['file_name'] == file_name]
+        self.processed_documents = [doc for doc in self.processed_documents if doc['file_name'] != file_name]
+        for doc in removed:
+            self.conflict_index.remove_document(doc)
+            if isinstance(doc, StoredDocument):
+                doc.store.delete(doc.session_id, doc.doc_id)
+        return bool(removed)
     
     def get_document_conflicts(self) -> List[Dict[str, Any]]:
         """Identify potential conflicts between documents"""
         conflicts = []
         
-        if len(self.processed_documents) < 2:
+        documents = self._unique_documents()
+        if len(documents) < 2:
             return conflicts
         
-        # Check for common fields that might conflict
-        common_fields = [
-            'denominazione', 'codice_fiscale', 'sede_legale', 'partita_iva',
-            'nome', 'cognome', 'data_nascita', 'numero_documento',
-            'numero_fattura', 'numero_contratto', 'data_contratto'
-        ]
-        
-        for field in common_fields:
-            values = {}
-            for doc in self.processed_documents:
-                # Handle nested objects (like fornitore.denominazione)
-                value = self._extract_nested_value(doc['extracted_info'], field)
-                if value:
-                    if field not in values:
-                        values[field] = []
-                    values[field].append({
-                        'value': value,
-                        'source': doc['file_name']
-                    })
-            
-            # Check for conflicts
-            if field in values and len(set(item['value'] for item in values[field])) > 1:
-                conflicts.append({
-                    'field': field,
-                    'values': values[field]
-                })
+        for conflict in self.conflict_index.sync(documents):
+            conflicts.append({
+                'field': conflict.field_name,
+                'values': [{'value': value.value, 'source': value.source_document} for value in conflict.values]
+            })
         
         return conflicts
     
@@ -844,51 +1097,15 @@ Rispondi SOLO con un dizionario JSON valido. Assicurati che:
         
         return None
     
-    def suggest_document_type(self, file_name: str, text_content: str) -> str:
+    def suggest_document_type(self, file_name: str, text_content: str, pdf_bytes: Optional[bytes] = None) -> str:
         """Suggest document type based on filename and content"""
-        file_name_lower = file_name.lower()
-        text_lower = text_content.lower()
-        
-        # Check filename patterns (more specific first)
-        if any(keyword in file_name_lower for keyword in ['visura', 'camerale', 'cciaa']):
-            return 'visura'
-        elif any(keyword in file_name_lower for keyword in ['bilancio', 'balance', 'financial']):
-            return 'bilancio'
-        elif any(keyword in file_name_lower for keyword in ['statuto', 'statute', 'bylaws']):
-            return 'statuto'
-        elif any(keyword in file_name_lower for keyword in ['fattura', 'invoice', 'bill']):
-            return 'fattura'
-        elif any(keyword in file_name_lower for keyword in ['contratto', 'contract', 'agreement']):
-            return 'contratto'
-        elif any(keyword in file_name_lower for keyword in ['carta_identita', 'carta', 'patente', 'passaporto', 'documento_identita']):
-            return 'riconoscimento'
-        
-        # Check content patterns (more specific first)
-        if any(keyword in text_lower for keyword in ['camera di commercio', 'registro imprese', 'rea', 'numero rea']):
-            return 'visura'
-        elif any(keyword in text_lower for keyword in ['stato patrimoniale', 'conto economico', 'bilancio di esercizio']):
-            return 'bilancio'
-        elif any(keyword in text_lower for keyword in ['statuto sociale', 'articolo', 'assemblea ordinaria', 'capitale sociale']):
-            return 'statuto'
-        elif any(keyword in text_lower for keyword in ['numero fattura', 'partita iva', 'codice destinatario', 'regime iva']):
-            return 'fattura'
-        elif any(keyword in text_lower for keyword in ['contratto di', 'parte contraente', 'clausola', 'oggetto del contratto']):
-            return 'contratto'
-        elif any(keyword in text_lower for keyword in ['nato/a il', 'carta d\'identità', 'patente di guida', 'passaporto', 'rilasciato da']):
-            return 'riconoscimento'
-        
-        # Fallback to less specific patterns
-        if any(keyword in text_lower for keyword in ['bilancio', 'ricavi', 'patrimonio']):
-            return 'bilancio'
-        elif any(keyword in text_lower for keyword in ['fattura', 'iva', 'imponibile']):
-            return 'fattura'
-        elif any(keyword in text_lower for keyword in ['contratto', 'accordo']):
-            return 'contratto'
-        elif any(keyword in text_lower for keyword in ['nato', 'codice fiscale', 'rilasciato']):
-            return 'riconoscimento'
-        
-        # Default to generic if no patterns match or content is empty
-        return 'generico'
+        return self.rank_document_types(file_name, text_content, pdf_bytes)[0].document_type
+    
+    def rank_document_types(self, file_name: str, text_content: str = "",
+                            pdf_bytes: Optional[bytes] = None) -> List[Classification]:
+        """Candidate document types, best first, with confidence; PDFs are read from their text layer"""
+        pages = pdf_text_pages(pdf_bytes) if pdf_bytes and not text_content else text_pages(text_content or "")
+        return get_document_classifier().classify(file_name, pages)
 
     def extract_template_fields_from_documents(self, target_template: str) -> Dict[str, Any]:
         """Extract template-specific fields from each processed document separately"""
@@ -0,0 +1,166 @@
+"""
+Cache su disco dei risultati OCR, indicizzata per contenuto del PDF.
+
+La chiave è lo SHA-256 dei byte del PDF combinato con il nome del modello OCR,
+il backend del layer di testo e le parole chiave di qualità del processore
+(decidono quali pagine vanno all'OCR, quindi il contenuto della voce); lo
+stesso documento caricato con un nome diverso o in un'altra sessione
+riusa il risultato già pagato. Ogni voce contiene sia il layer di testo sia il
+markdown OCR pagina per pagina (None per le pagine non inviate all'OCR).
+Quando la dimensione totale supera il limite vengono eliminate le voci usate
+meno di recente (LRU basata su mtime).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Any, Iterable, List, Optional
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "ocr")
+DEFAULT_MAX_SIZE_MB = 200
+# Incrementare quando cambia il formato delle voci: le vecchie diventano miss
+CACHE_FORMAT_VERSION = 3
+
+
+class OCRCache:
+    """Cache LRU su disco per testo PyPDF2 e pagine OCR Mistral"""
+
+    def __init__(self, cache_dir: str = None, max_size_mb: float = None):
+        self.cache_dir = cache_dir or os.environ.get("OCR_CACHE_DIR", DEFAULT_CACHE_DIR)
+        if max_size_mb is None:
+            max_size_mb = float(os.environ.get("OCR_CACHE_MAX_MB", DEFAULT_MAX_SIZE_MB))
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(pdf_bytes: bytes) -> str:
+        """SHA-256 esadecimale dei byte del documento"""
+        return hashlib.sha256(pdf_bytes).hexdigest()
+
+    def make_key(self, pdf_bytes: bytes, model: str, text_backend: str = "",
+                 quality_keywords: Iterable[str] = ()) -> str:
+        """Chiave della voce: hash del contenuto + modello OCR + backend del testo + parole chiave di qualità"""
+        keywords = ",".join(sorted(quality_keywords))
+        return hashlib.sha256(
+            f"{self.content_hash(pdf_bytes)}:{model}:{text_backend}:{keywords}:v{CACHE_FORMAT_VERSION}".encode("utf-8")
+        ).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, pdf_bytes: bytes, model: str, text_backend: str = "",
+            quality_keywords: Iterable[str] = ()) -> Optional[Dict[str, Any]]:
+        """Restituisce la voce in cache ({'text_layer_pages', 'ocr_pages', ...}) o None"""
+        path = self._entry_path(self.make_key(pdf_bytes, model, text_backend, quality_keywords))
+        with self._lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                # Aggiorna mtime: è il timestamp usato per l'ordine LRU
+                os.utime(path, None)
+                self.hits += 1
+                return entry
+            except (OSError, ValueError):
+                self.misses += 1
+                return None
+
+    def put(self, pdf_bytes: bytes, model: str, text_layer_pages: List[str], ocr_pages: List[Optional[str]],
+            text_backend: str = "", quality_keywords: Iterable[str] = ()):
+        """Salva il risultato dell'estrazione e applica l'eviction se necessario"""
+        key = self.make_key(pdf_bytes, model, text_backend, quality_keywords)
+        entry = {
+            "content_hash": self.content_hash(pdf_bytes),
+            "model": model,
+            "text_backend": text_backend,
+            "text_layer_pages": text_layer_pages,
+            "ocr_pages": ocr_pages,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                path = self._entry_path(key)
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(entry, f, ensure_ascii=False)
+                # Scrittura atomica: un'altra sessione non legge mai un file a metà
+                os.replace(tmp_path, path)
+                self._evict_if_needed()
+            except OSError:
+                # La cache è un'ottimizzazione: un errore di scrittura non deve bloccare l'estrazione
+                pass
+
+    def _list_entries(self) -> List[tuple]:
+        entries = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict_if_needed(self):
+        """Elimina le voci meno usate di recente finché si rientra nel limite"""
+        entries = self._list_entries()
+        total_size = sum(size for _, size, _ in entries)
+        if total_size <= self.max_size_bytes:
+            return
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+                self.evictions += 1
+            except OSError:
+                continue
+
+    def clear(self):
+        """Svuota completamente la cache"""
+        with self._lock:
+            for _, _, path in self._list_entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Contatori hit/miss e occupazione su disco"""
+        with self._lock:
+            entries = self._list_entries()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "size_bytes": sum(size for _, size, _ in entries),
+                "max_size_bytes": self.max_size_bytes,
+            }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_ocr_cache() -> OCRCache:
+    """Istanza condivisa da tutte le sessioni dello stesso processo"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = OCRCache()
+        return _default_cache
@@ -0,0 +1,205 @@
+"""
+Backend intercambiabili per l'estrazione del layer di testo dai PDF.
+
+PyPDF2 è puro Python e su un bilancio consolidato di centinaia di pagine tiene
+occupato un core a lungo. Qui l'estrazione è astratta dietro TextLayerBackend:
+oltre a PyPDF2 è disponibile pypdfium2 (binding di PDFium, molto più veloce,
+incluso in requirements.txt; se manca si ripiega su PyPDF2), e i documenti lunghi vengono suddivisi in intervalli di
+pagine elaborati in parallelo su un pool di processi (avviati con spawn; il PDF
+arriva ai worker con un file temporaneo). PDFium non è thread-safe: nello
+stesso processo le chiamate a pypdfium2 sono serializzate da un lock.
+
+Il backend si sceglie con la variabile d'ambiente PDF_TEXT_BACKEND
+("auto", "pypdf2", "pypdfium2"); con "auto" si usa pypdfium2 se installato.
+"""
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+from typing import Dict, Iterator, List, Optional
+
+# Sotto questo numero di pagine il costo di avvio dei processi non si ripaga
+PARALLEL_MIN_PAGES = 32
+# Pagine per intervallo inviato a un singolo worker
+PAGES_PER_CHUNK = 16
+
+# PDFium non è thread-safe: nel processo tutte le chiamate a pypdfium2 passano da qui
+_PDFIUM_LOCK = threading.Lock()
+
+
+class TextLayerBackend(ABC):
+    """Base class for PDF text-layer extraction backends"""
+
+    name = ""
+
+    @classmethod
+    def is_available(cls) -> bool:
+        """Whether the backend's library is installed"""
+        return True
+
+    @abstractmethod
+    def page_count(self, pdf_bytes: bytes) -> int:
+        """Number of pages in the document"""
+        pass
+
+    @abstractmethod
+    def extract_page_range(self, pdf_bytes: bytes, start: int, end: int) -> List[str]:
+        """Extract the text of pages [start, end) as a list of strings"""
+        pass
+
+    def extract_pages(self, pdf_bytes: bytes, executor: Optional[ProcessPoolExecutor] = None) -> List[str]:
+        """Extract all pages, splitting long documents across the process pool"""
+        return [page for chunk in self.iter_page_chunks(pdf_bytes, executor) for page in chunk]
+
+    def iter_page_chunks(self, pdf_bytes: bytes,
+                         executor: Optional[ProcessPoolExecutor] = None) -> Iterator[List[str]]:
+        """Yield the pages in order, one range at a time, as soon as each range is extracted.
+
+        Long documents go to executor (a pool from new_process_pool), by default the shared pool.
+        """
+        total_pages = self.page_count(pdf_bytes)
+        ranges = [(start, min(start + PAGES_PER_CHUNK, total_pages))
+                  for start in range(0, total_pages, PAGES_PER_CHUNK)]
+
+        if total_pages < PARALLEL_MIN_PAGES:
+            for start, end in ranges:
+                yield self.extract_page_range(pdf_bytes, start, end)
+            return
+
+        # Il PDF passa ai worker tramite un file temporaneo: ogni processo lo legge una volta sola
+        # invece di ricevere tutti i byte serializzati per ogni intervallo
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf_bytes)
+        # Tutti gli intervalli partono subito sul pool; vengono restituiti nell'ordine delle pagine
+        executor = executor or _get_process_pool()
+        futures = [executor.submit(_extract_range_worker, self.name, pdf_path, start, end)
+                   for start, end in ranges]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            # Il consumatore può fermarsi prima della fine: gli intervalli non ancora avviati vengono annullati
+            for future in futures:
+                future.cancel()
+            try:
+                os.remove(pdf_path)
+            except OSError:
+                pass
+
+
+class PyPDF2Backend(TextLayerBackend):
+    """Pure-Python backend based on PyPDF2 (always available)"""
+
+    name = "pypdf2"
+
+    def page_count(self, pdf_bytes: bytes) -> int:
+        import PyPDF2
+        return len(PyPDF2.PdfReader(io.BytesIO(pdf_bytes)).pages)
+
+    def extract_page_range(self, pdf_bytes: bytes, start: int, end: int) -> List[str]:
+        import PyPDF2
+        reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+        return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+class PdfiumBackend(TextLayerBackend):
+    """Native backend based on pypdfium2 (in requirements.txt; is_available guards partial installs)"""
+
+    name = "pypdfium2"
+
+    @classmethod
+    def is_available(cls) -> bool:
+        try:
+            import pypdfium2  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    def page_count(self, pdf_bytes: bytes) -> int:
+        import pypdfium2 as pdfium
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+
+    def extract_page_range(self, pdf_bytes: bytes, start: int, end: int) -> List[str]:
+        import pypdfium2 as pdfium
+        pages = []
+        with _PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                for i in range(start, end):
+                    page = pdf[i]
+                    text_page = page.get_textpage()
+                    # PDFium usa \r\n come separatore di riga: normalizza come PyPDF2
+                    pages.append(text_page.get_text_range().replace("\r\n", "\n"))
+                    text_page.close()
+                    page.close()
+            finally:
+                pdf.close()
+        return pages
+
+
+BACKENDS: Dict[str, type] = {
+    PyPDF2Backend.name: PyPDF2Backend,
+    PdfiumBackend.name: PdfiumBackend,
+}
+
+
+def get_available_backends() -> List[str]:
+    """Names of the backends whose library is installed"""
+    return [name for name, backend_class in BACKENDS.items() if backend_class.is_available()]
+
+
+def get_text_backend(name: str = None) -> TextLayerBackend:
+    """Create the configured backend ("auto" prefers pypdfium2 when installed)"""
+    name = (name or os.environ.get("PDF_TEXT_BACKEND", "auto")).lower()
+    if name == "auto":
+        name = PdfiumBackend.name if PdfiumBackend.is_available() else PyPDF2Backend.name
+
+    if name not in BACKENDS:
+        raise ValueError(f"Backend PDF non supportato: {name}")
+    backend_class = BACKENDS[name]
+    if not backend_class.is_available():
+        raise ValueError(f"Backend PDF non installato: {name}")
+    return backend_class()
+
+
+# Ultimo PDF letto dal worker: gli intervalli successivi dello stesso documento lo riusano
+_worker_document: Optional[tuple] = None
+
+
+def _extract_range_worker(backend_name: str, pdf_path: str, start: int, end: int) -> List[str]:
+    """Entry point eseguito nei processi del pool (deve essere top-level per il pickling)"""
+    global _worker_document
+    if _worker_document is None or _worker_document[0] != pdf_path:
+        with open(pdf_path, "rb") as f:
+            _worker_document = (pdf_path, f.read())
+    return BACKENDS[backend_name]().extract_page_range(_worker_document[1], start, end)
+
+
+def new_process_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """Pool di processi per l'estrazione; il chiamante lo chiude (il benchmark ne usa uno proprio)"""
+    # spawn: il server Streamlit è multithread, un fork ne copierebbe i lock in stato incoerente
+    return ProcessPoolExecutor(max_workers=max_workers or min(4, os.cpu_count() or 1),
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """Pool di processi condiviso, creato alla prima richiesta e mai sostituito"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = new_process_pool()
+        return _process_pool
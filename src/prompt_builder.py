@@ -0,0 +1,110 @@
+"""
+Prompt compatti per i documenti elaborati.
+
+I prompt di combinazione includevano ogni documento con json.dumps(indent=2),
+compresi i campi che il template non usa. Il costruttore:
+
+- proietta ogni documento sui campi richiesti dal template
+  (_get_template_requirements, con i nomi alternativi dei processor);
+- elimina i valori vuoti e serializza senza spazi;
+- rispetta un budget di token (PROMPT_TOKEN_BUDGET): se il prompt è troppo
+  lungo toglie prima i valori delle fonti meno autorevoli per quel campo
+  (stessa priorità del merge engine), a parità i più lunghi;
+- restituisce i token stimati prima e dopo, da mostrare per verificare il
+  risparmio.
+"""
+
+import json
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from chunked_extraction import estimate_tokens
+from merge_engine import FIELD_ALIASES, MergeEngine
+
+TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "12000"))
+
+
+class PromptStats(NamedTuple):
+    """Token stimati del prompt con i documenti completi e dopo proiezione e budget"""
+    tokens_before: int
+    tokens_after: int
+    dropped_values: int
+
+
+def prune_empty(value: Any) -> Any:
+    """Value without empty strings, None, empty lists and empty objects (recursively)"""
+    if isinstance(value, dict):
+        pruned = {key: prune_empty(item) for key, item in value.items()}
+        return {key: item for key, item in pruned.items() if item not in (None, "", [], {})}
+    if isinstance(value, list):
+        pruned = [prune_empty(item) for item in value]
+        return [item for item in pruned if item not in (None, "", [], {})]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def compact_json(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class PromptBuilder:
+    """Field-projected, token-budgeted document sections for the multi-document prompts"""
+
+    def __init__(self, requirements: Dict[str, List[str]], token_budget: Optional[int] = None,
+                 merge_engine: Optional[MergeEngine] = None):
+        self.token_budget = TOKEN_BUDGET if token_budget is None else token_budget
+        self.merge_engine = merge_engine or MergeEngine()
+        # Nome del campo estratto -> (campo del template, categoria)
+        self._targets: Dict[str, Tuple[str, str]] = {}
+        for category, fields in requirements.items():
+            for field in fields:
+                for name in [field] + FIELD_ALIASES.get(field, []):
+                    self._targets.setdefault(name, (field, category))
+
+    def project(self, extracted_info: Dict[str, Any]) -> Dict[str, Any]:
+        """Non-empty values of the fields the template needs"""
+        projected = {key: value for key, value in extracted_info.items() if key in self._targets}
+        return prune_empty(projected)
+
+    def _rank(self, name: str, document_type: str) -> int:
+        field, category = self._targets[name]
+        priority = self.merge_engine.priority_for(field, category)
+        return priority.index(document_type) if document_type in priority else len(priority)
+
+    def build(self, documents: List[Dict[str, Any]], render: Callable[[str], str]) -> Tuple[str, PromptStats]:
+        """render(documents_text) with the projected documents, within the token budget"""
+        full_sections = "".join(self._section(i, document, document.get("extracted_info") or {}, indent=2)
+                                for i, document in enumerate(documents, 1))
+        tokens_before = estimate_tokens(render(full_sections))
+
+        projected = [self.project(document.get("extracted_info") or {}) for document in documents]
+        sections = "".join(self._section(i, document, info) for i, (document, info)
+                           in enumerate(zip(documents, projected), 1))
+        prompt = render(sections)
+        excess = estimate_tokens(prompt) - self.token_budget
+
+        dropped = 0
+        if excess > 0:
+            # Prima i valori delle fonti meno autorevoli per quel campo, a parità i più lunghi
+            items = [(self._rank(name, document.get("document_type", "")),
+                      estimate_tokens(compact_json({name: value})), index, name)
+                     for index, (document, info) in enumerate(zip(documents, projected))
+                     for name, value in info.items()]
+            for _, size, index, name in sorted(items, key=lambda item: (-item[0], -item[1])):
+                if excess <= 0:
+                    break
+                del projected[index][name]
+                excess -= size
+                dropped += 1
+            sections = "".join(self._section(i, document, info) for i, (document, info)
+                               in enumerate(zip(documents, projected), 1))
+            prompt = render(sections)
+
+        return prompt, PromptStats(tokens_before, estimate_tokens(prompt), dropped)
+
+    @staticmethod
+    def _section(position: int, document: Dict[str, Any], info: Dict[str, Any], indent: Optional[int] = None) -> str:
+        content = json.dumps(info, indent=indent, ensure_ascii=False) if indent else compact_json(info)
+        return (f"\nDOCUMENTO {position}: {document.get('file_name', '')} (Tipo: {document.get('document_type', '')})\n"
+                f"Informazioni estratte:\n{content}\n")
@@ -0,0 +1,330 @@
+"""
+Rate limiter a token bucket per le API Mistral, condiviso dal processo.
+
+Ogni sessione Streamlit chiamava l'API senza coordinamento: con più utenti
+che caricano documenti insieme arrivavano i 429 e i retry peggioravano la
+situazione. Qui due bucket (richieste al secondo e token al minuto) regolano
+tutte le chiamate di tutti i thread e del loop asincrono:
+
+- le richieste non vengono rifiutate ma messe in coda per priorità
+  (a parità, in ordine di arrivo); l'attesa rispetta il timeout del chiamante;
+- con MISTRAL_RATE_LIMIT_DB lo stato dei bucket sta in un file SQLite
+  (transazioni BEGIN IMMEDIATE): più repliche dell'app sulla stessa macchina
+  condividono lo stesso limite;
+- un 429 svuota il bucket delle richieste per il tempo indicato dall'API,
+  così le altre chiamate aspettano invece di riprovare subito.
+
+Variabili d'ambiente: MISTRAL_RATE_RPS, MISTRAL_RATE_TPM,
+MISTRAL_RATE_LIMIT_DB, MISTRAL_RATE_LIMIT=0 per disattivarlo (un limite a 0
+non viene applicato).
+"""
+
+from contextlib import contextmanager
+import asyncio
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+REQUESTS_PER_SECOND = float(os.environ.get("MISTRAL_RATE_RPS", "5"))
+TOKENS_PER_MINUTE = float(os.environ.get("MISTRAL_RATE_TPM", "500000"))
+
+# Priorità delle richieste in coda (valore più basso = servita prima)
+PRIORITY_INTERACTIVE = 0   # l'utente attende il risultato di un'azione
+PRIORITY_NORMAL = 1        # estrazione dei documenti
+PRIORITY_BATCH = 2         # elaborazioni in blocco
+
+# Intervallo massimo tra due controlli del bucket (con lo stato condiviso altri processi lo modificano)
+_MAX_POLL_SECONDS = 0.25
+
+
+class RateLimitTimeout(RuntimeError):
+    """The request waited in the rate-limit queue until its deadline.
+
+    Not a DeadlineExceeded: the API was never called, so the resilience layer must
+    not count it as an API timeout (latency samples, retries, circuit breaker).
+    """
+
+
+class LocalBucketStore:
+    """Stato dei bucket in memoria, condiviso dai thread del processo"""
+
+    def __init__(self, requests_per_second: float, tokens_per_minute: float):
+        self.rates = (requests_per_second, tokens_per_minute / 60.0)
+        self.capacities = (max(1.0, requests_per_second), tokens_per_minute)
+        self._levels = list(self.capacities)
+        self._updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, levels, updated_at: float, now: float):
+        elapsed = max(0.0, now - updated_at)
+        return [min(capacity, level + elapsed * rate)
+                for level, rate, capacity in zip(levels, self.rates, self.capacities)]
+
+    def _consume(self, levels, needs: Tuple[float, float]) -> Tuple[list, float]:
+        """Consume needs if available; returns (levels, wait seconds, 0 when consumed)"""
+        # Una richiesta più grande della capacità non passerebbe mai: la si limita alla capacità
+        needs = [min(need, capacity) for need, capacity in zip(needs, self.capacities)]
+        waits = [(need - level) / rate if level < need and rate > 0 else 0.0
+                 for need, level, rate in zip(needs, levels, self.rates)]
+        if max(waits) > 0:
+            return levels, max(waits)
+        return [level - need for level, need in zip(levels, needs)], 0.0
+
+    def try_consume(self, requests: float, tokens: float) -> float:
+        with self._lock:
+            now = time.time()
+            levels = self._refill(self._levels, self._updated_at, now)
+            self._levels, wait = self._consume(levels, (requests, tokens))
+            self._updated_at = now
+            return wait
+
+    def adjust(self, requests: float = 0.0, tokens: float = 0.0):
+        """Add (or, with negative values, remove) capacity; levels may go below zero"""
+        with self._lock:
+            now = time.time()
+            levels = self._refill(self._levels, self._updated_at, now)
+            self._levels = [min(capacity, level + delta)
+                            for level, delta, capacity in zip(levels, (requests, tokens), self.capacities)]
+            self._updated_at = now
+
+
+class SQLiteBucketStore(LocalBucketStore):
+    """Stato dei bucket in un file SQLite, condiviso tra processi (repliche dell'app)"""
+
+    def __init__(self, db_path: str, requests_per_second: float, tokens_per_minute: float):
+        super().__init__(requests_per_second, tokens_per_minute)
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._transaction() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, requests REAL NOT NULL,"
+                " tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO buckets (name, requests, tokens, updated_at) VALUES ('mistral', ?, ?, ?)",
+                (self.capacities[0], self.capacities[1], time.time())
+            )
+
+    @contextmanager
+    def _transaction(self):
+        """Transazione con lock di scrittura immediato: lettura e aggiornamento sono atomici tra processi"""
+        connection = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def _update(self, change) -> Any:
+        with self._lock, self._transaction() as connection:
+            row = connection.execute("SELECT requests, tokens, updated_at FROM buckets WHERE name = 'mistral'").fetchone()
+            now = time.time()
+            levels, result = change(self._refill(list(row[:2]), row[2], now))
+            connection.execute(
+                "UPDATE buckets SET requests = ?, tokens = ?, updated_at = ? WHERE name = 'mistral'",
+                (levels[0], levels[1], now)
+            )
+            return result
+
+    def try_consume(self, requests: float, tokens: float) -> float:
+        try:
+            return self._update(lambda levels: self._consume(levels, (requests, tokens)))
+        except sqlite3.Error:
+            # Stato condiviso non disponibile: si ripiega sul limite del solo processo
+            return super().try_consume(requests, tokens)
+
+    def adjust(self, requests: float = 0.0, tokens: float = 0.0):
+        def change(levels):
+            return [min(capacity, level + delta)
+                    for level, delta, capacity in zip(levels, (requests, tokens), self.capacities)], None
+        try:
+            self._update(change)
+        except sqlite3.Error:
+            super().adjust(requests, tokens)
+
+
+class RateLimiter:
+    """Priority queue in front of the request and token buckets"""
+
+    def __init__(self, requests_per_second: float = REQUESTS_PER_SECOND, tokens_per_minute: float = TOKENS_PER_MINUTE,
+                 db_path: Optional[str] = None):
+        self.requests_per_second = requests_per_second
+        self.tokens_per_minute = tokens_per_minute
+        self.enabled = os.environ.get("MISTRAL_RATE_LIMIT", "1") != "0"
+        db_path = db_path if db_path is not None else os.environ.get("MISTRAL_RATE_LIMIT_DB")
+        self.shared = bool(db_path)
+        if db_path:
+            self.store = SQLiteBucketStore(db_path, requests_per_second, tokens_per_minute)
+        else:
+            self.store = LocalBucketStore(requests_per_second, tokens_per_minute)
+        self._condition = threading.Condition()
+        self._waiting = []  # heap di (priorità, ordine di arrivo)
+        self._arrivals = itertools.count()
+        self.acquired = 0
+        self.delayed = 0
+        self.timed_out = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # --- Coda ----------------------------------------------------------------
+
+    def _enqueue(self, priority: int) -> Tuple[int, int]:
+        entry = (priority, next(self._arrivals))
+        heapq.heappush(self._waiting, entry)
+        # Una richiesta più prioritaria può scavalcare chi sta aspettando il bucket
+        self._condition.notify_all()
+        return entry
+
+    def _leave(self, entry: Tuple[int, int]):
+        if entry in self._waiting:
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+            self._condition.notify_all()
+
+    def _attempt(self, entry: Tuple[int, int], tokens: float) -> Optional[float]:
+        """Try to consume for entry (caller holds the condition): 0 when acquired,
+        the wait in seconds when the buckets are short, None when it is not entry's turn"""
+        if self._waiting[0] != entry:
+            return None
+        wait = self.store.try_consume(1, tokens)
+        if wait == 0:
+            heapq.heappop(self._waiting)
+            self._condition.notify_all()
+        return wait
+
+    def _record(self, waited: float):
+        self.acquired += 1
+        if waited > 0.001:
+            self.delayed += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def _attempt_locked(self, entry: Tuple[int, int], tokens: float) -> Optional[float]:
+        with self._condition:
+            return self._attempt(entry, tokens)
+
+    def _timeout_error(self, waited: float) -> RateLimitTimeout:
+        self.timed_out += 1
+        return RateLimitTimeout(f"Richiesta in coda per il limite di frequenza API da {waited:.1f}s")
+
+    # --- Acquisizione --------------------------------------------------------
+
+    def acquire(self, tokens: float = 0, priority: int = PRIORITY_NORMAL, timeout: Optional[float] = None):
+        """Wait until one request and tokens are available; raises RateLimitTimeout after timeout seconds"""
+        if not self.enabled:
+            return
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._condition:
+            entry = self._enqueue(priority)
+            try:
+                while True:
+                    wait = self._attempt(entry, tokens)
+                    if wait == 0:
+                        self._record(time.monotonic() - start)
+                        return
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        raise self._timeout_error(now - start)
+                    pause = _MAX_POLL_SECONDS if wait is None else min(wait, _MAX_POLL_SECONDS)
+                    if deadline is not None:
+                        pause = min(pause, deadline - now)
+                    self._condition.wait(pause)
+            except BaseException:
+                self._leave(entry)
+                raise
+
+    async def acquire_async(self, tokens: float = 0, priority: int = PRIORITY_NORMAL, timeout: Optional[float] = None):
+        """Async counterpart of acquire: waits with asyncio.sleep, sharing the queue with threads"""
+        if not self.enabled:
+            return
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._condition:
+            entry = self._enqueue(priority)
+        try:
+            while True:
+                if self.shared:
+                    # BEGIN IMMEDIATE sul file condiviso può attendere fino a 10s: fuori dal loop degli eventi
+                    wait = await asyncio.to_thread(self._attempt_locked, entry, tokens)
+                else:
+                    wait = self._attempt_locked(entry, tokens)
+                with self._condition:
+                    if wait == 0:
+                        self._record(time.monotonic() - start)
+                        return
+                    now = time.monotonic()
+                    if deadline is not None and now >= deadline:
+                        raise self._timeout_error(now - start)
+                pause = _MAX_POLL_SECONDS if wait is None else min(wait, _MAX_POLL_SECONDS)
+                if deadline is not None:
+                    pause = min(pause, deadline - now)
+                await asyncio.sleep(pause)
+        except BaseException:
+            with self._condition:
+                self._leave(entry)
+            raise
+
+    def settle(self, estimated_tokens: float, actual_tokens: Optional[float]):
+        """Correct the token bucket with the usage reported by the API"""
+        if self.enabled and actual_tokens is not None:
+            self.store.adjust(tokens=estimated_tokens - actual_tokens)
+
+    def throttle(self, seconds: float):
+        """Pause every caller for about seconds (after a 429 from the API)"""
+        if self.enabled:
+            with self._condition:
+                self.throttled += 1
+            self.store.adjust(requests=-(self.requests_per_second * seconds + 1))
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                "enabled": self.enabled,
+                "shared": self.shared,
+                "requests_per_second": self.requests_per_second,
+                "tokens_per_minute": self.tokens_per_minute,
+                "waiting": len(self._waiting),
+                "acquired": self.acquired,
+                "delayed": self.delayed,
+                "timed_out": self.timed_out,
+                "throttled": self.throttled,
+                "average_wait": (self.total_wait / self.acquired) if self.acquired else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+
+def retry_after_seconds(error: BaseException, default: float = 2.0) -> Optional[float]:
+    """Seconds to pause after a 429 (Retry-After header when present), None for other errors"""
+    if getattr(error, "status_code", None) != 429:
+        return None
+    headers = getattr(getattr(error, "raw_response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
+
+
+_rate_limiter: Optional[RateLimiter] = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Rate limiter condiviso da tutte le sessioni del processo"""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
@@ -0,0 +1,420 @@
+"""
+Politica comune di retry per le chiamate alle API Mistral.
+
+Ogni punto di chiamata aveva il proprio ciclo di retry con timeout fissi
+([10, 20], [8, 15], ...) e pause costanti; durante un disservizio di Mistral
+ogni sessione continuava a tentare e restava bloccata. Qui, per endpoint
+("chat", "ocr"):
+
+- backoff esponenziale con jitter completo tra un tentativo e l'altro;
+- timeout derivato dal p95 delle latenze osservate (il valore di default vale
+  finché non ci sono abbastanza campioni) e raddoppiato dopo ogni timeout;
+- circuit breaker: dopo N errori consecutivi le chiamate falliscono subito
+  (CircuitOpen) per un periodo di recupero, poi una sola chiamata di prova
+  decide se riaprire il traffico;
+- contatori di retry, timeout, errori e stato del breaker (get_stats).
+
+Variabili d'ambiente: RESILIENCE_MAX_ATTEMPTS, RESILIENCE_BASE_DELAY,
+RESILIENCE_MAX_DELAY, RESILIENCE_TIMEOUT_MULTIPLIER,
+CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_SECONDS.
+"""
+
+import asyncio
+from collections import deque
+import math
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional
+
+from api_scheduler import BudgetExhausted, CallBudget, DeadlineExceeded, get_api_scheduler
+from rate_limiter import RateLimitTimeout
+
+MAX_ATTEMPTS = int(os.environ.get("RESILIENCE_MAX_ATTEMPTS", "3"))
+BASE_DELAY = float(os.environ.get("RESILIENCE_BASE_DELAY", "0.5"))
+MAX_DELAY = float(os.environ.get("RESILIENCE_MAX_DELAY", "8"))
+# Timeout adattivo = p95 delle latenze × moltiplicatore, entro [min_timeout, max_timeout]
+TIMEOUT_MULTIPLIER = float(os.environ.get("RESILIENCE_TIMEOUT_MULTIPLIER", "2"))
+LATENCY_WINDOW = 100
+MIN_LATENCY_SAMPLES = 5
+FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+RECOVERY_SECONDS = float(os.environ.get("CIRCUIT_RECOVERY_SECONDS", "30"))
+
+# Stati del circuit breaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Codici HTTP per cui ha senso riprovare (sovraccarico o errore temporaneo del server)
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpen(RuntimeError):
+    """The endpoint is failing: calls are rejected without reaching the API"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether error is transient (timeout, connection error, 429/5xx) and worth retrying"""
+    if isinstance(error, (BudgetExhausted, RateLimitTimeout)):
+        return False
+    if isinstance(error, (DeadlineExceeded, TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES
+    try:
+        import httpx
+        return isinstance(error, httpx.TransportError)
+    except ImportError:
+        return False
+
+
+def backoff_delay(attempt: int, base_delay: float = BASE_DELAY, max_delay: float = MAX_DELAY) -> float:
+    """Full-jitter exponential backoff: uniform in [0, min(max_delay, base_delay * 2**attempt)]"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """Breaker a tre stati basato sugli errori consecutivi"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, recovery_seconds: float = RECOVERY_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Whether a call may go out now (the caller must hold the owner's lock)"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_seconds:
+                return False
+            self.state = HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == HALF_OPEN:
+            # Una sola chiamata di prova alla volta
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.times_opened += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """Give back a probe slot that was granted but not used (no outcome to record)"""
+        self._probe_in_flight = False
+
+    def retry_after(self) -> float:
+        return max(0.0, self.recovery_seconds - (time.monotonic() - self.opened_at)) if self.state == OPEN else 0.0
+
+
+class EndpointState:
+    """Latenze, breaker e contatori di un endpoint"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.breaker = CircuitBreaker()
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.invalid_responses = 0
+        self.short_circuited = 0
+        self.rate_limited = 0
+
+    def p95(self) -> Optional[float]:
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+
+class ResilienceLayer:
+    """Retry, adaptive timeouts and circuit breaking for every Mistral endpoint"""
+
+    def __init__(self, max_attempts: int = MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._endpoints: Dict[str, EndpointState] = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, name: str) -> EndpointState:
+        with self._lock:
+            if name not in self._endpoints:
+                self._endpoints[name] = EndpointState(name)
+            return self._endpoints[name]
+
+    def timeout_for(self, endpoint: str, default_timeout: float, min_timeout: Optional[float] = None,
+                    max_timeout: Optional[float] = None) -> float:
+        """Timeout for the next call: p95 latency × multiplier, or default_timeout until enough samples exist"""
+        state = self._endpoint(endpoint)
+        with self._lock:
+            p95 = state.p95()
+        if p95 is None:
+            return default_timeout
+        min_timeout = default_timeout / 2 if min_timeout is None else min_timeout
+        max_timeout = default_timeout * 3 if max_timeout is None else max_timeout
+        return min(max_timeout, max(min_timeout, p95 * TIMEOUT_MULTIPLIER))
+
+    # --- Registrazione degli esiti -------------------------------------------
+
+    def _before_call(self, state: EndpointState, count: int = 1) -> int:
+        """Admit up to count calls; returns how many may go out (one while the breaker is probing)"""
+        with self._lock:
+            if not state.breaker.allow():
+                state.calls += count
+                state.short_circuited += 1
+                raise CircuitOpen(
+                    f"API Mistral ({state.name}) temporaneamente non disponibile: "
+                    f"nuovo tentativo tra {state.breaker.retry_after():.0f}s"
+                )
+            # In HALF_OPEN passa solo la chiamata di prova, le altre aspettano il suo esito
+            admitted = 1 if state.breaker.state == HALF_OPEN else count
+            state.calls += admitted
+            return admitted
+
+    def _record_success(self, state: EndpointState, elapsed: float, result: Any):
+        with self._lock:
+            state.successes += 1
+            state.breaker.record_success()
+            # Le risposte dalla cache locale non dicono nulla sulla latenza dell'API
+            if not getattr(result, "cached", False):
+                state.latencies.append(elapsed)
+
+    def _record_failure(self, state: EndpointState, error: BaseException, timeout: float,
+                        count_in_breaker: bool = True):
+        with self._lock:
+            if isinstance(error, RateLimitTimeout):
+                # Attesa nella coda del rate limiter locale: l'API non è stata chiamata
+                state.rate_limited += 1
+                state.breaker.release_probe()
+                return
+            state.failures += 1
+            if isinstance(error, (DeadlineExceeded, TimeoutError, asyncio.TimeoutError)):
+                state.timeouts += 1
+                # Campione censurato: la latenza reale è almeno pari al timeout
+                state.latencies.append(timeout)
+            if is_retryable(error):
+                if count_in_breaker:
+                    state.breaker.record_failure()
+            elif getattr(error, "status_code", None) is not None:
+                # Richiesta rifiutata (4xx): l'API è raggiungibile
+                state.breaker.record_success()
+            else:
+                # Errore locale (coda piena, bug): nessuna informazione sullo stato dell'API
+                state.breaker.release_probe()
+
+    def _record_invalid(self, state: EndpointState, elapsed: float):
+        with self._lock:
+            state.invalid_responses += 1
+            state.breaker.record_success()
+            state.latencies.append(elapsed)
+
+    def _record_retry(self, state: EndpointState):
+        with self._lock:
+            state.retries += 1
+
+    # --- Esecuzione -----------------------------------------------------------
+
+    def call(self, fn: Callable[[float], Any], endpoint: str, default_timeout: float,
+             budget: Optional[CallBudget] = None, accept: Optional[Callable[[Any], bool]] = None,
+             on_retry: Optional[Callable[[int, BaseException, float], None]] = None,
+             min_timeout: Optional[float] = None, max_timeout: Optional[float] = None,
+             via_scheduler: bool = True) -> Any:
+        """Call fn(timeout) with retries; returns its result.
+
+        fn receives the timeout of the attempt (pass it on as timeout_ms). With
+        via_scheduler the deadline is enforced by the shared scheduler, otherwise fn
+        runs in the calling thread and must honour the timeout itself. Responses
+        rejected by accept are retried; after the last attempt the last one is
+        returned. on_retry(attempt, error, delay) runs in the calling thread (UI
+        messages). Raises CircuitOpen, BudgetExhausted or the last error.
+        """
+        state = self._endpoint(endpoint)
+        timeout = self.timeout_for(endpoint, default_timeout, min_timeout, max_timeout)
+        result = None
+        for attempt in range(self.max_attempts):
+            self._before_call(state)
+            attempt_timeout = timeout if budget is None else min(timeout, budget.remaining())
+            start = time.monotonic()
+            try:
+                if via_scheduler:
+                    result = get_api_scheduler().call(fn, attempt_timeout, timeout=attempt_timeout, budget=budget)
+                else:
+                    if attempt_timeout <= 0:
+                        raise BudgetExhausted("Budget di tempo del documento esaurito")
+                    result = fn(attempt_timeout)
+            except BudgetExhausted:
+                with self._lock:
+                    state.breaker.release_probe()
+                raise
+            except Exception as error:
+                self._record_failure(state, error, attempt_timeout)
+                if not is_retryable(error) or attempt == self.max_attempts - 1:
+                    raise
+                if isinstance(error, (DeadlineExceeded, TimeoutError)):
+                    timeout = min(timeout * 2, max_timeout or default_timeout * 3)
+                self._wait_before_retry(state, attempt, error, budget, on_retry)
+                continue
+
+            elapsed = time.monotonic() - start
+            if accept is None or accept(result):
+                self._record_success(state, elapsed, result)
+                return result
+            self._record_invalid(state, elapsed)
+            if attempt < self.max_attempts - 1:
+                self._wait_before_retry(state, attempt, None, budget, on_retry)
+        return result
+
+    def _wait_before_retry(self, state: EndpointState, attempt: int, error: Optional[BaseException],
+                           budget: Optional[CallBudget], on_retry):
+        delay = backoff_delay(attempt)
+        if budget is not None:
+            delay = min(delay, budget.remaining())
+        self._record_retry(state)
+        if on_retry is not None:
+            on_retry(attempt + 1, error, delay)
+        time.sleep(delay)
+
+    def call_all(self, fn: Callable, endpoint: str, calls: Iterable[tuple], default_timeout: float,
+                 budget: Optional[CallBudget] = None) -> List[Any]:
+        """Run fn(*args, timeout) concurrently on the scheduler, retrying the transient failures.
+
+        Returns one entry per call, in order: the result or the final exception.
+        While the breaker is half-open only the first call goes out; if that probe
+        fails the others get CircuitOpen. Each round counts as one breaker failure.
+        """
+        state = self._endpoint(endpoint)
+        calls = list(calls)
+        results: List[Any] = [None] * len(calls)
+        pending = list(range(len(calls)))
+        timeout = self.timeout_for(endpoint, default_timeout)
+        attempt = 0
+        while pending:
+            admitted = self._before_call(state, len(pending))
+            batch, waiting = pending[:admitted], pending[admitted:]
+            round_timeout = timeout if budget is None else min(timeout, budget.remaining())
+            start = time.monotonic()
+            outcomes = get_api_scheduler().call_all(
+                fn, [calls[index] + (round_timeout,) for index in batch], timeout=round_timeout, budget=budget
+            )
+            elapsed = time.monotonic() - start
+            retry = []
+            for index, outcome in zip(batch, outcomes):
+                results[index] = outcome
+                if isinstance(outcome, BaseException):
+                    # I blocchi di un round falliscono insieme per la stessa causa: un solo errore per il breaker
+                    self._record_failure(state, outcome, round_timeout, count_in_breaker=not retry)
+                    if is_retryable(outcome):
+                        retry.append(index)
+                else:
+                    self._record_success(state, elapsed, outcome)
+            if waiting:
+                # Round di prova: se è andata bene le altre chiamate partono subito, senza consumare un tentativo
+                if not retry:
+                    pending = waiting
+                    continue
+                for index in waiting:
+                    results[index] = CircuitOpen(f"API Mistral ({state.name}) ancora non disponibile")
+                break
+            if not retry or attempt == self.max_attempts - 1:
+                break
+            if any(isinstance(results[index], DeadlineExceeded) for index in retry):
+                timeout = min(timeout * 2, default_timeout * 3)
+            pending = retry
+            self._wait_before_retry(state, attempt, results[retry[0]], budget, None)
+            attempt += 1
+            if budget is not None and budget.expired:
+                break
+        return results
+
+    async def call_async(self, factory: Callable[[float], Awaitable], endpoint: str, default_timeout: float,
+                         accept: Optional[Callable[[Any], bool]] = None, min_timeout: Optional[float] = None,
+                         max_timeout: Optional[float] = None) -> Any:
+        """Async counterpart of call: factory(timeout) returns the awaitable of one attempt"""
+        state = self._endpoint(endpoint)
+        timeout = self.timeout_for(endpoint, default_timeout, min_timeout, max_timeout)
+        result = None
+        for attempt in range(self.max_attempts):
+            self._before_call(state)
+            start = time.monotonic()
+            try:
+                result = await asyncio.wait_for(factory(timeout), timeout)
+            except asyncio.CancelledError:
+                # Tentativo annullato (timeout di run_sync, pipeline interrotta): nessun esito da registrare
+                with self._lock:
+                    state.breaker.release_probe()
+                raise
+            except Exception as error:
+                self._record_failure(state, error, timeout)
+                if not is_retryable(error) or attempt == self.max_attempts - 1:
+                    raise
+                if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+                    timeout = min(timeout * 2, max_timeout or default_timeout * 3)
+                self._record_retry(state)
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+
+            elapsed = time.monotonic() - start
+            if accept is None or accept(result):
+                self._record_success(state, elapsed, result)
+                return result
+            self._record_invalid(state, elapsed)
+            if attempt < self.max_attempts - 1:
+                self._record_retry(state)
+                await asyncio.sleep(backoff_delay(attempt))
+        return result
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-endpoint counters, breaker state and latency figures"""
+        with self._lock:
+            endpoints = list(self._endpoints.values())
+        stats = {}
+        for state in endpoints:
+            with self._lock:
+                p95 = state.p95()
+                stats[state.name] = {
+                    "calls": state.calls,
+                    "successes": state.successes,
+                    "failures": state.failures,
+                    "retries": state.retries,
+                    "timeouts": state.timeouts,
+                    "invalid_responses": state.invalid_responses,
+                    "short_circuited": state.short_circuited,
+                    "rate_limited": state.rate_limited,
+                    "breaker_state": state.breaker.state,
+                    "breaker_opened": state.breaker.times_opened,
+                    "consecutive_failures": state.breaker.consecutive_failures,
+                    "p95_latency": p95,
+                    "samples": len(state.latencies),
+                }
+        return stats
+
+
+_resilience: Optional[ResilienceLayer] = None
+_resilience_lock = threading.Lock()
+
+
+def get_resilience() -> ResilienceLayer:
+    """Livello di resilienza condiviso da tutte le sessioni del processo"""
+    global _resilience
+    with _resilience_lock:
+        if _resilience is None:
+            _resilience = ResilienceLayer()
+        return _resilience
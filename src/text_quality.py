@@ -0,0 +1,79 @@
+"""
+Valutazione della qualità del layer di testo di una pagina PDF.
+
+Le visure e i bilanci scaricati dal Registro Imprese sono quasi sempre PDF
+nativi digitali: il testo estratto da PyPDF2 è già corretto e l'OCR è uno
+spreco. Questo modulo assegna un punteggio a ogni pagina combinando densità
+di caratteri, percentuale di glifi spazzatura e presenza di parole chiave
+attese, così da inviare a Mistral OCR solo le pagine scansionate o illeggibili.
+"""
+
+import unicodedata
+from typing import Dict, Any, Iterable
+
+# Sotto questa soglia di caratteri utili la pagina è considerata vuota/scansionata
+MIN_USEFUL_CHARS = 50
+# Numero di caratteri utili oltre il quale la densità è considerata piena
+FULL_DENSITY_CHARS = 400
+# Oltre questa quota di glifi spazzatura il testo è inutilizzabile
+MAX_GARBAGE_RATIO = 0.2
+# Punteggio minimo per accettare il layer di testo senza OCR
+MIN_ACCEPTABLE_SCORE = 0.6
+
+_WEIGHT_DENSITY = 0.5
+_WEIGHT_GARBAGE = 0.35
+_WEIGHT_KEYWORDS = 0.15
+
+
+def _is_garbage_char(char: str) -> bool:
+    """Glifi tipici di font senza mappa Unicode o di codifiche rotte"""
+    if char == "\ufffd":
+        return True
+    category = unicodedata.category(char)
+    # Cc = controllo (esclusi whitespace), Co = uso privato, Cn = non assegnato, Cs = surrogati
+    if category in ("Co", "Cn", "Cs"):
+        return True
+    if category == "Cc" and not char.isspace():
+        return True
+    return False
+
+
+def score_page_text(text: str, expected_keywords: Iterable[str] = ()) -> Dict[str, Any]:
+    """Calcola il punteggio di qualità del testo di una pagina.
+
+    Restituisce un dizionario con le metriche e il flag 'needs_ocr'.
+    """
+    text = text or ""
+    useful_chars = sum(1 for c in text if not c.isspace())
+    garbage_chars = sum(1 for c in text if _is_garbage_char(c))
+    garbage_ratio = (garbage_chars / useful_chars) if useful_chars else 1.0
+
+    keywords = [k.lower() for k in expected_keywords if k]
+    text_lower = text.lower()
+    keyword_hits = sum(1 for k in keywords if k in text_lower)
+
+    density_score = min(1.0, useful_chars / FULL_DENSITY_CHARS)
+    garbage_score = max(0.0, 1.0 - garbage_ratio / (MAX_GARBAGE_RATIO / 2))
+    # Le pagine interne (tabelle, allegati) spesso non contengono parole chiave:
+    # la loro assenza non penalizza, la loro presenza salva le pagine brevi
+    keyword_score = min(1.0, keyword_hits / 2) if keywords else 0.0
+
+    score = (
+        _WEIGHT_DENSITY * density_score
+        + _WEIGHT_GARBAGE * garbage_score
+        + _WEIGHT_KEYWORDS * keyword_score
+    )
+
+    needs_ocr = (
+        useful_chars < MIN_USEFUL_CHARS
+        or garbage_ratio > MAX_GARBAGE_RATIO
+        or score < MIN_ACCEPTABLE_SCORE
+    )
+
+    return {
+        "useful_chars": useful_chars,
+        "garbage_ratio": round(garbage_ratio, 4),
+        "keyword_hits": keyword_hits,
+        "score": round(score, 3),
+        "needs_ocr": needs_ocr,
+    }
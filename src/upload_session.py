@@ -0,0 +1,159 @@
+"""
+Sessione di upload verso Mistral con riuso del file id e del signed URL.
+
+L'OCR del testo e la Document Annotation lavorano sugli stessi byte: senza
+coordinamento ogni PDF veniva caricato due volte. UploadSession indicizza gli
+upload per hash del contenuto, carica una sola volta anche con richieste
+concorrenti, riusa il signed URL finché non scade e cancella il file remoto
+quando l'ultimo utilizzatore lo rilascia.
+"""
+
+from contextlib import contextmanager
+import atexit
+import hashlib
+import threading
+import time
+import weakref
+from typing import Dict, Any, Tuple
+
+from rate_limiter import get_rate_limiter
+
+# Durata richiesta per i signed URL (ore) e margine di sicurezza prima della scadenza (secondi)
+SIGNED_URL_EXPIRY_HOURS = 1
+SIGNED_URL_SAFETY_MARGIN = 60
+
+
+class UploadSession:
+    """Upload deduplicati per contenuto, con conteggio dei riferimenti"""
+
+    def __init__(self, mistral_client, file_name: str = "document.pdf", purpose: str = "ocr"):
+        self.client = mistral_client
+        self.file_name = file_name
+        self.purpose = purpose
+        self.uploads = 0
+        self.reuses = 0
+        self.deletes = 0
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def _ref(self, key: str) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"refs": 0, "file_id": None, "url": None, "url_expires_at": 0.0,
+                         "lock": threading.Lock()}
+                self._entries[key] = entry
+            entry["refs"] += 1
+            return entry
+
+    def _unref(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["refs"] -= 1
+            if entry["refs"] > 0:
+                return
+            del self._entries[key]
+            file_id = entry["file_id"]
+        if file_id:
+            self._delete_remote(file_id)
+
+    def _delete_remote(self, file_id: str):
+        """Cancella il file remoto in background: non deve pesare sulla latenza dell'utente"""
+        def delete():
+            try:
+                self.client.files.delete(file_id=file_id)
+                self.deletes += 1
+            except Exception:
+                pass
+        threading.Thread(target=delete, name="mistral-file-delete", daemon=True).start()
+
+    def acquire(self, content: bytes) -> Tuple[str, str]:
+        """Restituisce (file_id, signed_url), caricando il contenuto solo se necessario.
+
+        Ogni acquire va bilanciato da un release.
+        """
+        key = self.content_hash(content)
+        entry = self._ref(key)
+        try:
+            # Lock per contenuto: richieste concorrenti sugli stessi byte attendono un solo upload
+            with entry["lock"]:
+                if entry["file_id"] is None:
+                    get_rate_limiter().acquire()
+                    uploaded = self.client.files.upload(
+                        file={"file_name": self.file_name, "content": content},
+                        purpose=self.purpose
+                    )
+                    entry["file_id"] = uploaded.id
+                    self.uploads += 1
+                else:
+                    self.reuses += 1
+
+                if entry["url"] is None or time.time() >= entry["url_expires_at"]:
+                    signed_url = self.client.files.get_signed_url(
+                        file_id=entry["file_id"], expiry=SIGNED_URL_EXPIRY_HOURS
+                    )
+                    entry["url"] = signed_url.url
+                    entry["url_expires_at"] = time.time() + SIGNED_URL_EXPIRY_HOURS * 3600 - SIGNED_URL_SAFETY_MARGIN
+                return entry["file_id"], entry["url"]
+        except Exception:
+            self._unref(key)
+            raise
+
+    def release(self, content: bytes):
+        """Rilascia un riferimento; all'ultimo rilascio il file remoto viene cancellato"""
+        self._unref(self.content_hash(content))
+
+    @contextmanager
+    def retain(self, content: bytes):
+        """Mantiene vivo l'upload (senza forzarlo) per tutta la durata del blocco"""
+        key = self.content_hash(content)
+        self._ref(key)
+        try:
+            yield
+        finally:
+            self._unref(key)
+
+    def close(self):
+        """Cancella tutti i file remoti ancora registrati"""
+        with self._lock:
+            file_ids = [entry["file_id"] for entry in self._entries.values() if entry["file_id"]]
+            self._entries.clear()
+        for file_id in file_ids:
+            try:
+                self.client.files.delete(file_id=file_id)
+                self.deletes += 1
+            except Exception:
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            active = len(self._entries)
+        return {"uploads": self.uploads, "reuses": self.reuses, "deletes": self.deletes, "active": active}
+
+
+_sessions = weakref.WeakKeyDictionary()
+_sessions_lock = threading.Lock()
+
+
+def get_upload_session(mistral_client) -> UploadSession:
+    """Sessione condivisa da tutti i processori che usano lo stesso client"""
+    with _sessions_lock:
+        session = _sessions.get(mistral_client)
+        if session is None:
+            session = UploadSession(mistral_client)
+            _sessions[mistral_client] = session
+        return session
+
+
+@atexit.register
+def _close_all_sessions():
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    for session in sessions:
+        session.close()
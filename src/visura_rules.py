@@ -0,0 +1,142 @@
+"""
+Estrazione deterministica dei campi a formato rigido della visura camerale.
+
+Codice fiscale, partita IVA, numero REA, PEC e capitale sociale hanno un
+formato fisso e un'etichetta riconoscibile: espressioni regolari
+precompilate li estraggono in pochi millisecondi, senza chiamate al modello.
+Ogni campo riporta una confidenza (1.0 = etichetta trovata e cifra di
+controllo corretta); al modello vengono chiesti solo i campi che le regole non
+hanno compilato con confidenza sufficiente (VISURA_RULES_MIN_CONFIDENCE).
+"""
+
+import os
+import re
+from typing import Dict, NamedTuple, Optional
+
+from fiscal_codes import is_valid_codice_fiscale, is_valid_partita_iva, normalize_code
+
+MIN_CONFIDENCE = float(os.environ.get("VISURA_RULES_MIN_CONFIDENCE", "0.8"))
+
+# Confidenze per tipo di riscontro
+CONFIDENCE_CHECKSUM = 1.0      # etichetta + cifra di controllo corretta
+CONFIDENCE_LABELLED = 0.9      # etichetta + formato corretto (campi senza cifra di controllo)
+CONFIDENCE_INFERRED = 0.85     # valore dedotto (es. capitale "interamente versato")
+CONFIDENCE_UNLABELLED = 0.8    # formato riconoscibile senza etichetta (es. dominio PEC)
+CONFIDENCE_BAD_CHECKSUM = 0.4  # etichetta trovata ma cifra di controllo errata: probabile errore OCR
+
+_SEPARATOR = r'[\s:.\-–|*]*'
+_CF_VALUE = r'([A-Z]{6}[0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]|\d{11})'
+_EMAIL = r'([A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,})'
+_AMOUNT = r'(\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:,\d{1,2})?)'
+
+_CODICE_FISCALE = re.compile(r'codice\s+fiscale(?:\s+e\s+n(?:umero|\.)?\s*(?:di\s+)?iscr(?:izione|\.)?'
+                             r'\s+al\s+registro\s+(?:delle\s+)?imprese)?' + _SEPARATOR + _CF_VALUE, re.IGNORECASE)
+_PARTITA_IVA = re.compile(r'(?:partita\s+iva|p\.?\s*iva)' + _SEPARATOR + r'(?:IT)?\s*(\d{11})\b', re.IGNORECASE)
+_NUMERO_REA = re.compile(r'(?<![A-Za-z])(?:numero\s+|n\.?\s*)?r\.?e\.?a\.?\b' + _SEPARATOR + r'([A-Z]{2})\s*[-–/]?\s*(\d{3,7})\b',
+                         re.IGNORECASE)
+_PEC_LABELLED = re.compile(r'(?:indirizzo\s+pec|domicilio\s+digitale(?:\s*/\s*pec)?|posta\s+elettronica\s+certificata|pec)'
+                           + _SEPARATOR + _EMAIL, re.IGNORECASE)
+_PEC_DOMAIN = re.compile(_EMAIL)
+_PEC_DOMAIN_HINTS = ("pec.", ".pec", "legalmail.", "postacert.", "arubapec.", "cert.")
+
+_CAPITALE = re.compile(r'capitale\s+sociale', re.IGNORECASE)
+_CAPITALE_WINDOW = 400
+_CAPITALE_PARTS = {
+    part: re.compile(part + r'\s*(?:in\s+)?(?:euro|eur|€)?' + _SEPARATOR + r'(?:euro|eur|€)?\s*' + _AMOUNT, re.IGNORECASE)
+    for part in ("deliberato", "sottoscritto", "versato")
+}
+_CAPITALE_AMOUNT = re.compile(r'(?:di\s+|pari\s+a\s+)?(?:euro|eur|€)?' + _SEPARATOR + r'(?:euro|eur|€)?\s*' + _AMOUNT, re.IGNORECASE)
+_FULLY_PAID = re.compile(r'\bi\.\s*v\.|interamente\s+versato', re.IGNORECASE)
+
+
+class FieldMatch(NamedTuple):
+    """Valore estratto da una regola con la relativa confidenza"""
+    value: str
+    confidence: float
+    rule: str
+
+
+def _match_codice_fiscale(text: str) -> Optional[FieldMatch]:
+    # Il primo codice etichettato è quello della società (intestazione della visura);
+    # quelli successivi appartengono di norma a soci e amministratori
+    fallback = None
+    for match in _CODICE_FISCALE.finditer(text):
+        code = normalize_code(match.group(1))
+        if is_valid_codice_fiscale(code):
+            return FieldMatch(code, CONFIDENCE_CHECKSUM, "codice_fiscale_checksum")
+        if fallback is None:
+            fallback = FieldMatch(code, CONFIDENCE_BAD_CHECKSUM, "codice_fiscale_bad_checksum")
+    return fallback
+
+
+def _match_partita_iva(text: str) -> Optional[FieldMatch]:
+    fallback = None
+    for match in _PARTITA_IVA.finditer(text):
+        code = match.group(1)
+        if is_valid_partita_iva(code):
+            return FieldMatch(code, CONFIDENCE_CHECKSUM, "partita_iva_checksum")
+        if fallback is None:
+            fallback = FieldMatch(code, CONFIDENCE_BAD_CHECKSUM, "partita_iva_bad_checksum")
+    return fallback
+
+
+def _match_numero_rea(text: str) -> Optional[FieldMatch]:
+    match = _NUMERO_REA.search(text)
+    if match is None:
+        return None
+    return FieldMatch(f"{match.group(1).upper()}-{match.group(2)}", CONFIDENCE_LABELLED, "numero_rea_label")
+
+
+def _match_pec(text: str) -> Optional[FieldMatch]:
+    match = _PEC_LABELLED.search(text)
+    if match is not None:
+        return FieldMatch(match.group(1).lower().rstrip('.'), CONFIDENCE_LABELLED, "pec_label")
+    for match in _PEC_DOMAIN.finditer(text):
+        address = match.group(1).lower()
+        if any(hint in address.split('@', 1)[1] for hint in _PEC_DOMAIN_HINTS):
+            return FieldMatch(address, CONFIDENCE_UNLABELLED, "pec_domain")
+    return None
+
+
+def _match_capitale(text: str) -> Dict[str, FieldMatch]:
+    matches = {}
+    for heading in _CAPITALE.finditer(text):
+        window = text[heading.end():heading.end() + _CAPITALE_WINDOW]
+        for part, pattern in _CAPITALE_PARTS.items():
+            found = pattern.search(window)
+            if found and f"capitale_{part}" not in matches:
+                matches[f"capitale_{part}"] = FieldMatch(found.group(1), CONFIDENCE_LABELLED, "capitale_label")
+        if matches:
+            break
+
+        # Importo unico ("Capitale sociale Euro 10.000,00 i.v.")
+        found = _CAPITALE_AMOUNT.match(window)
+        if found:
+            amount = found.group(1)
+            matches["capitale_deliberato"] = FieldMatch(amount, CONFIDENCE_INFERRED, "capitale_single_amount")
+            if _FULLY_PAID.match(window[found.end():].lstrip(' ,')):
+                matches["capitale_sottoscritto"] = FieldMatch(amount, CONFIDENCE_INFERRED, "capitale_fully_paid")
+                matches["capitale_versato"] = FieldMatch(amount, CONFIDENCE_INFERRED, "capitale_fully_paid")
+            break
+
+    if "capitale_deliberato" in matches:
+        matches["capitale_sociale"] = matches["capitale_deliberato"]
+    return matches
+
+
+def extract_visura_fields(text: str) -> Dict[str, FieldMatch]:
+    """Rule-based matches for the fixed-format fields of a visura camerale, with their confidence"""
+    matches = {}
+    for field, matcher in (("codice_fiscale", _match_codice_fiscale), ("partita_iva", _match_partita_iva),
+                           ("numero_rea", _match_numero_rea), ("pec", _match_pec)):
+        match = matcher(text)
+        if match is not None:
+            matches[field] = match
+    matches.update(_match_capitale(text))
+    return matches
+
+
+def confident_fields(matches: Dict[str, FieldMatch], min_confidence: float = None) -> Dict[str, str]:
+    """Values of the matches at or above min_confidence (VISURA_RULES_MIN_CONFIDENCE by default)"""
+    threshold = MIN_CONFIDENCE if min_confidence is None else min_confidence
+    return {field: match.value for field, match in matches.items() if match.confidence >= threshold}
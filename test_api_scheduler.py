@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Test dello scheduler condiviso delle chiamate API (scadenze e posti in coda)
+"""
+
+import sys
+import os
+import time
+
+# Aggiungi i path necessari
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(current_dir, 'src')
+
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+from api_scheduler import ApiCallScheduler, DeadlineExceeded
+
+
+def wait_idle(scheduler: ApiCallScheduler, seconds: float = 5.0):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        stats = scheduler.get_stats()
+        if stats["in_flight"] == 0 and stats["queued"] == 0:
+            return stats
+        time.sleep(0.02)
+    return scheduler.get_stats()
+
+
+def test_cancelled_calls_release_their_queue_slot():
+    """Le chiamate scadute mentre erano in coda non lasciano lo scheduler saturo"""
+    scheduler = ApiCallScheduler(max_workers=1, max_queue=3)
+    for _ in range(6):
+        try:
+            scheduler.call(time.sleep, 0.3, timeout=0.1)
+        except DeadlineExceeded:
+            pass
+    stats = wait_idle(scheduler)
+    assert stats["queued"] == 0 and stats["in_flight"] == 0
+    assert scheduler.call(lambda: "ok", timeout=1.0) == "ok"
+
+
+def test_call_all_releases_queue_slots_of_expired_calls():
+    scheduler = ApiCallScheduler(max_workers=1, max_queue=4)
+    results = scheduler.call_all(time.sleep, [(0.3,)] * 4, timeout=0.1)
+    assert all(isinstance(result, DeadlineExceeded) for result in results)
+    stats = wait_idle(scheduler)
+    assert stats["queued"] == 0 and stats["in_flight"] == 0
+    assert scheduler.call_all(lambda value: value * 2, [(1,), (2,), (3,), (4,)], timeout=1.0) == [2, 4, 6, 8]
+
+
+def test_late_call_does_not_start_after_its_deadline():
+    """Una chiamata rimasta in coda oltre la scadenza non viene eseguita"""
+    scheduler = ApiCallScheduler(max_workers=1, max_queue=4)
+    started = []
+    blocker = scheduler.submit(time.sleep, 0.2, timeout=1.0)
+    late = scheduler.submit(started.append, "late", timeout=0.05)
+    blocker.result()
+    try:
+        late.result()
+    except DeadlineExceeded:
+        pass
+    assert started == []
+    assert wait_idle(scheduler)["queued"] == 0
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Test del riconoscimento del tipo di documento (automa Aho-Corasick e punteggi)
+"""
+
+import sys
+import os
+
+# Aggiungi i path necessari
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(current_dir, 'src')
+
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+from document_classifier import DocumentClassifier, KeywordAutomaton, text_pages
+
+
+def naive_matches(patterns, text):
+    """Tutte le occorrenze di tutti i pattern, con str.find"""
+    matches = []
+    for pattern in patterns:
+        start = text.find(pattern)
+        while start != -1:
+            matches.append((start, start + len(pattern) - 1, pattern))
+            start = text.find(pattern, start + 1)
+    return sorted(matches)
+
+
+def test_automaton_finds_overlapping_matches():
+    """Pattern sovrapposti e contenuti l'uno nell'altro vengono trovati tutti"""
+    patterns = ["he", "she", "his", "hers", "assemblea", "assemblea ordinaria", "ordinaria"]
+    text = "ushers e this: l'assemblea ordinaria, assembleassemblea"
+    _, matches = KeywordAutomaton(patterns).scan(text)
+    assert sorted(matches) == naive_matches(patterns, text)
+    assert (1, 3, "she") in matches and (2, 3, "he") in matches and (2, 5, "hers") in matches
+
+
+def test_automaton_state_carries_across_calls():
+    """Lo stato finale permette di riprendere la scansione su un testo spezzato"""
+    automaton = KeywordAutomaton(["statuto sociale"])
+    state, first = automaton.scan("lo statuto so")
+    _, second = automaton.scan("ciale della società", state)
+    assert first == []
+    assert [pattern for _, _, pattern in second] == ["statuto sociale"]
+
+
+def test_keywords_match_whole_words_only():
+    """'rea' non deve essere trovato dentro 'area' o 'creare'"""
+    classifier = DocumentClassifier(keywords={"visura": {"rea": 5}, "generico": {"area": 5}})
+    ranking = classifier.classify(pages=["Area riservata: creare un nuovo utente nell'area clienti"])
+    assert [result.document_type for result in ranking] == ["generico"]
+
+    ranking = classifier.classify(pages=["Numero REA: TO-1234567"])
+    assert ranking[0].document_type == "visura"
+
+
+def test_classification_stops_reading_when_confident():
+    """Le pagine sono lette solo finché il tipo non è deciso"""
+    read = []
+
+    def pages():
+        for number in range(500):
+            read.append(number)
+            yield "VERBALE DI ASSEMBLEA ORDINARIA\nL'assemblea si è riunita alle ore 10, assume la presidenza il sig. Rossi"
+
+    ranking = DocumentClassifier().classify(pages=pages())
+    assert ranking[0].document_type == "verbale_assemblea"
+    assert len(read) == 1
+
+
+def test_classification_respects_max_pages():
+    read = []
+
+    def pages():
+        for number in range(100):
+            read.append(number)
+            yield "testo senza parole chiave"
+
+    DocumentClassifier().classify(pages=pages(), max_pages=5)
+    assert len(read) <= 6
+
+
+STATUTO = """STATUTO SOCIALE
+TITOLO I - DENOMINAZIONE, SEDE, OGGETTO E DURATA
+Articolo 1 - Denominazione. È costituita una società a responsabilità limitata.
+Articolo 2 - Oggetto sociale. La società ha per oggetto...
+Articolo 3 - Durata della società. La durata è fissata al 31 dicembre 2050.
+Articolo 10 - Decisioni dei soci. Le decisioni dei soci sono adottate con assemblea ordinaria
+o assemblea straordinaria secondo quanto previsto dalla legge.
+Articolo 12 - Trasferimento delle partecipazioni. Recesso del socio.
+Articolo 20 - Clausola compromissoria. Scioglimento e liquidazione."""
+
+VERBALE = """VERBALE DI ASSEMBLEA ORDINARIA DEI SOCI
+Il giorno 15 marzo 2024 alle ore 10:00 si è riunita l'assemblea ordinaria della società.
+Assume la presidenza il sig. Mario Rossi, che chiama a fungere da segretario il sig. Luigi Bianchi
+e dichiara validamente costituita l'assemblea per discutere il seguente ordine del giorno:
+1. modifica dell'articolo 3 dello statuto.
+L'assemblea approva all'unanimità. Null'altro essendovi da deliberare la seduta è tolta."""
+
+
+def test_statuto_and_verbale_are_told_apart():
+    """Un verbale che cita lo statuto resta un verbale, uno statuto che cita l'assemblea resta uno statuto"""
+    classifier = DocumentClassifier()
+    statuto = classifier.classify("documento.pdf", text_pages(STATUTO))
+    verbale = classifier.classify("documento.pdf", text_pages(VERBALE))
+    assert statuto[0].document_type == "statuto"
+    assert verbale[0].document_type == "verbale_assemblea"
+    assert statuto[0].confidence > 0.5 and verbale[0].confidence > 0.5
+
+
+def test_filename_is_a_prior_not_a_verdict():
+    """Il nome del file orienta la classificazione ma il contenuto prevale"""
+    classifier = DocumentClassifier()
+    assert classifier.classify("statuto.pdf")[0].document_type == "statuto"
+    assert classifier.classify("statuto.pdf", text_pages(VERBALE))[0].document_type == "verbale_assemblea"
+
+
+def test_empty_document_falls_back_to_generic():
+    ranking = DocumentClassifier().classify("scansione.pdf", [""])
+    assert ranking[0].document_type == "generico"
+    assert ranking[0].confidence == 0.0
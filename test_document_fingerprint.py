@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Test delle impronte usate per riconoscere i documenti duplicati
+"""
+
+import sys
+import os
+import random
+
+# Aggiungi i path necessari
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(current_dir, 'src')
+
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+from document_fingerprint import (MIN_WORDS, SKETCH_SIZE, content_hash, estimate_similarity, is_near_duplicate,
+                                  text_sketch)
+
+VOCABULARY = ("assemblea soci società capitale sociale amministratore verbale statuto bilancio esercizio "
+              "delibera presidente segretario ordine giorno approvazione quota socio sede legale durata").split()
+
+
+def make_text(seed: int, words: int = 600) -> str:
+    generator = random.Random(seed)
+    return " ".join(generator.choice(VOCABULARY) + str(generator.randint(0, 50)) for _ in range(words))
+
+
+def add_ocr_noise(text: str, rate: float, seed: int = 0) -> str:
+    """Sostituisce una parola su 1/rate con un errore di lettura"""
+    generator = random.Random(seed)
+    return " ".join(word[:-1] + "x" if generator.random() < rate else word for word in text.split())
+
+
+def test_content_hash_depends_only_on_bytes():
+    assert content_hash(b"%PDF-1.4 abc") == content_hash(b"%PDF-1.4 abc")
+    assert content_hash(b"%PDF-1.4 abc") != content_hash(b"%PDF-1.4 abd")
+
+
+def test_sketch_is_bounded_and_deterministic():
+    text = make_text(1)
+    sketch = text_sketch(text)
+    assert len(sketch) == SKETCH_SIZE
+    assert sketch == sorted(sketch)
+    assert sketch == text_sketch(text)
+
+
+def test_sketch_ignores_case_and_punctuation():
+    text = make_text(2)
+    assert text_sketch(text.upper().replace(" ", ", ")) == text_sketch(text)
+
+
+def test_short_texts_are_not_compared():
+    short = " ".join(["parola"] * (MIN_WORDS - 1))
+    assert text_sketch(short) == []
+    assert estimate_similarity(text_sketch(short), text_sketch(short)) == 0.0
+    assert not is_near_duplicate([], [])
+
+
+def test_identical_texts_are_fully_similar():
+    sketch = text_sketch(make_text(3))
+    assert estimate_similarity(sketch, sketch) == 1.0
+
+
+def test_rescan_with_ocr_errors_is_near_duplicate():
+    """Lo stesso documento riscansionato (2% di parole lette male) è un quasi duplicato"""
+    text = make_text(4)
+    original, rescan = text_sketch(text), text_sketch(add_ocr_noise(text, 0.02))
+    assert estimate_similarity(original, rescan) > 0.85
+    assert is_near_duplicate(original, rescan)
+
+
+def test_different_documents_are_not_near_duplicates():
+    first, second = text_sketch(make_text(5)), text_sketch(make_text(6))
+    assert estimate_similarity(first, second) < 0.1
+    assert not is_near_duplicate(first, second)
+
+
+def test_similarity_estimate_tracks_jaccard():
+    """La stima dallo sketch resta vicina alla similarità di Jaccard esatta sugli shingle"""
+    def shingles(text):
+        words = text.split()
+        return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+    text = make_text(7, words=2000)
+    edited = add_ocr_noise(text, 0.05, seed=1)
+    exact = len(shingles(text) & shingles(edited)) / len(shingles(text) | shingles(edited))
+    estimate = estimate_similarity(text_sketch(text), text_sketch(edited))
+    assert abs(estimate - exact) < 0.1
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Test della validazione di codice fiscale e partita IVA
+"""
+
+import sys
+import os
+
+# Aggiungi i path necessari
+current_dir = os.path.dirname(os.path.abspath(__file__))
+src_path = os.path.join(current_dir, 'src')
+
+if src_path not in sys.path:
+    sys.path.append(src_path)
+
+from fiscal_codes import (is_valid_codice_fiscale, is_valid_partita_iva, is_valid_personal_codice_fiscale,
+                          normalize_code)
+
+
+def test_partita_iva_check_digit():
+    assert is_valid_partita_iva("12877980016")
+    assert is_valid_partita_iva("01234567897")
+    # Cifra di controllo sbagliata, cifre scambiate
+    assert not is_valid_partita_iva("12877980015")
+    assert not is_valid_partita_iva("21877980016")
+
+
+def test_partita_iva_format():
+    assert not is_valid_partita_iva("00000000000")
+    assert not is_valid_partita_iva("1287798001")
+    assert not is_valid_partita_iva("128779800161")
+    assert not is_valid_partita_iva("1287798001A")
+    assert not is_valid_partita_iva("")
+
+
+def test_codes_are_normalized():
+    """Spazi, punti e trattini dell'OCR non invalidano il codice"""
+    assert normalize_code(" rss mra-85t10.a562s ") == "RSSMRA85T10A562S"
+    assert is_valid_partita_iva("128 779 800 16")
+    assert is_valid_personal_codice_fiscale("rssmra85t10a562s")
+
+
+def test_personal_codice_fiscale_check_character():
+    assert is_valid_personal_codice_fiscale("RSSMRA85T10A562S")
+    assert not is_valid_personal_codice_fiscale("RSSMRA85T10A562T")
+    # Una lettera del cognome sbagliata (errore OCR tipico)
+    assert not is_valid_personal_codice_fiscale("RSSMPA85T10A562S")
+
+
+def test_personal_codice_fiscale_omocodia():
+    """Le cifre sostituite da lettere (omocodia) sono accettate con il loro carattere di controllo"""
+    assert is_valid_personal_codice_fiscale("RSSMRA85T10A56NH")
+    assert not is_valid_personal_codice_fiscale("RSSMRA85T10A56NS")
+
+
+def test_personal_codice_fiscale_format():
+    assert not is_valid_personal_codice_fiscale("RSSMRA85T10A562")
+    assert not is_valid_personal_codice_fiscale("RSSMRA85Z10A562S")  # Z non è un mese
+    assert not is_valid_personal_codice_fiscale("12877980016")
+
+
+def test_codice_fiscale_accepts_both_forms():
+    """Il codice fiscale delle società è numerico come la partita IVA"""
+    assert is_valid_codice_fiscale("RSSMRA85T10A562S")
+    assert is_valid_codice_fiscale("12877980016")
+    assert not is_valid_codice_fiscale("12877980015")
+    assert not is_valid_codice_fiscale("RSSMRA85T10A562T")